@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+import time, sys, gc
+import json
+import optparse
+import struct
+import numpy as np
+
+from deserialize import RobotState, PackageType
+from framing import PacketFramer, MessageParser
+from trajectory import CompiledTrajectory, SetpointTable, validate_trajectory
+from protocol import MSG_OUT, MSG_JOINT_STATES_V2, ROBOT_MESSAGES, JOINT_STATES_V2, \
+    MULT_jointstate_v2, SERVO_BUFFER_SIZE, pack_servoj, pack_servoj_batch
+from mock_controller import pack_robot_state, HEADER, ROBOT_STATE
+import capture
+
+# Micro-benchmarks of the driver's hot paths, runnable without ROS or a
+# robot:
+#
+#   python benchmark.py -o results.json
+#   python benchmark.py -b results.json     # fails if anything got slower
+#
+# Every benchmark is a callable that processes a known number of
+# operations (packets, samples, messages); it is run for a number of
+# iterations, that is repeated, and the best and median time per
+# operation are reported.  With a baseline (the JSON output of an earlier
+# run), a benchmark whose best time exceeds the baseline's by more than
+# --max-slowdown is a regression, and the exit status is 1.
+
+JOINT_NAMES = ['shoulder_pan_joint', 'shoulder_lift_joint', 'elbow_joint',
+               'wrist_1_joint', 'wrist_2_joint', 'wrist_3_joint']
+
+# Sizes of the sub-packages of a real controller's RobotState packet,
+# besides the robot mode and joint data built by pack_robot_state
+FILLER_PACKAGES = [
+    (PackageType.TOOL_DATA, 37),
+    (PackageType.MASTERBOARD_DATA, 72),
+    (PackageType.CARTESIAN_INFO, 53),
+    (PackageType.KINEMATICS_INFO, 225),
+    (PackageType.CONFIGURATION_DATA, 445),
+    (PackageType.FORCE_MODE_DATA, 61),
+    (PackageType.ADDITIONAL_INFO, 10),
+]
+
+# Builds n RobotState packets as a real controller sends them (only the
+# robot mode and joint data have meaningful contents)
+def synthetic_packets(n):
+    packets = []
+    for i in range(n):
+        q = 0.1 * np.sin(0.01 * i + np.arange(6))
+        state = pack_robot_state(q, np.zeros(6), q, timestamp=8 * i)
+        body = state[HEADER.size:] + "".join(
+            HEADER.pack(size, ptype) + "\0" * (size - HEADER.size)
+            for ptype, size in FILLER_PACKAGES)
+        packets.append(HEADER.pack(HEADER.size + len(body), ROBOT_STATE) + body)
+    return packets
+
+# The RobotState packets of a capture file
+def recorded_packets(path):
+    return [str(payload) for stamp, stream, payload in capture.read_capture(path)
+            if stream == capture.STREAM_STATE]
+
+# What driverProg sends on the reverse port over one second: a
+# MSG_JOINT_STATES_V2 record per controller cycle, and a few log lines
+def commander_stream(cycles=125):
+    mult = int(MULT_jointstate_v2)
+    parts = []
+    for i in range(cycles):
+        values = (mult * 0.1 * np.sin(0.01 * i + np.arange(18))).astype(int).tolist()
+        parts.append(struct.pack("!i", MSG_JOINT_STATES_V2) +
+                     JOINT_STATES_V2.pack(i, i, mult, *values))
+        if i % 25 == 0:
+            parts.append(struct.pack("!i", MSG_OUT) + "Waypoint finished: %d~" % i)
+    return "".join(parts), cycles + (cycles + 24) // 25
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+# A trajectory through n points, as arrays
+def trajectory(n, dt=0.1):
+    times = dt * np.arange(n)
+    positions = np.sin(np.outer(times, np.arange(1, 7) * 0.3))
+    velocities = np.cos(np.outer(times, np.arange(1, 7) * 0.3)) * np.arange(1, 7) * 0.3
+    return times, positions, velocities
+
+# Stand-ins for the JointTrajectory message fields validate_trajectory()
+# reads, so that no ROS message packages are needed
+class _Duration(object):
+    def __init__(self, secs):
+        self.secs = secs
+    def to_sec(self):
+        return self.secs
+
+class _Point(object):
+    def __init__(self, positions, velocities, t):
+        self.positions = list(positions)
+        self.velocities = list(velocities)
+        self.accelerations = []
+        self.time_from_start = _Duration(t)
+
+class _Trajectory(object):
+    def __init__(self, joint_names, points):
+        self.joint_names = joint_names
+        self.points = points
+
+# A goal of n points with its joints in a different order than the
+# driver's, so that validation has to reorder them
+def goal(n):
+    times, positions, velocities = trajectory(n)
+    order = [2, 0, 1, 5, 3, 4]
+    return _Trajectory([JOINT_NAMES[j] for j in order],
+                       [_Point(p[order], v[order], t)
+                        for t, p, v in zip(times, positions, velocities)])
+
+# Returns [(name, fn, operations per call of fn)]
+def benchmarks(packets):
+    result = []
+
+    def unpack():
+        for p in packets:
+            RobotState.unpack(p)
+    result.append(("robot_state.unpack", unpack, len(packets)))
+
+    def unpack_access():
+        for p in packets:
+            state = RobotState.unpack(p)
+            state.robot_mode_data.robot_mode
+            state.joints['q_actual']
+    result.append(("robot_state.unpack_access", unpack_access, len(packets)))
+
+    stream = chunks("".join(packets), 4096)
+    framer = PacketFramer()
+    def frame():
+        for data in stream:
+            framer.feed(data)
+            for p in framer.packets():
+                pass
+    result.append(("primary.framing", frame, len(packets)))
+
+    for n in [10, 100, 1000]:
+        times, positions, velocities = trajectory(n)
+        result.append(("trajectory.compile.%d" % n,
+                       lambda times=times, positions=positions, velocities=velocities:
+                           CompiledTrajectory(times, positions, velocities), 1))
+        traj = CompiledTrajectory(times, positions, velocities)
+        ts = np.linspace(0, traj.duration, 100).tolist()
+        def sample(traj=traj, ts=ts):
+            for t in ts:
+                traj.sample(t)
+        result.append(("trajectory.sample.%d" % n, sample, len(ts)))
+        ts = np.arange(0, traj.duration, 0.008)
+        result.append(("trajectory.sample_many.%d" % n,
+                       lambda traj=traj, ts=ts: traj.sample_many(ts), len(ts)))
+        result.append(("trajectory.table.%d" % n,
+                       lambda traj=traj: SetpointTable(traj, 0.008), 1))
+        # Servo ticks don't line up with the setpoints
+        ticks = (ts + 0.003).tolist()
+        def table_sample(traj=traj, ticks=ticks):
+            table = SetpointTable(traj, 0.008)
+            for t in ticks:
+                table.sample(t)
+        result.append(("trajectory.table_sample.%d" % n, table_sample, len(ticks)))
+        msg = goal(n)
+        result.append(("trajectory.validate.%d" % n,
+                       lambda msg=msg: validate_trajectory(msg, JOINT_NAMES, 3.15,
+                                                           (-2 * np.pi, 2 * np.pi)), 1))
+
+    q = np.array([0.1, -1.2, 1.4, -0.3, 1.57, 0.2])
+    result.append(("servoj.pack", lambda: pack_servoj(7, q, 0.008, MULT_jointstate_v2), 1))
+    qs = np.tile(q, (SERVO_BUFFER_SIZE, 1))
+    result.append(("servoj.pack_batch",
+                   lambda: pack_servoj_batch(7, qs, 0.008, MULT_jointstate_v2),
+                   SERVO_BUFFER_SIZE))
+
+    data, messages = commander_stream()
+    handlers = {MSG_OUT: lambda s: None, MSG_JOINT_STATES_V2: lambda v: None}
+    for name, size in [("realistic", 4096), ("stress", 7)]:
+        parser = MessageParser(ROBOT_MESSAGES, handlers)
+        pieces = chunks(data, size)
+        def parse(parser=parser, pieces=pieces):
+            for piece in pieces:
+                parser.feed(piece)
+                parser.parse()
+        result.append(("commander.parse.%s" % name, parse, messages))
+    return result
+
+# Returns the seconds per operation of each of repeats runs
+def measure(fn, ops, iterations, repeats):
+    times = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        fn()  # Warm up
+        for r in range(repeats):
+            t0 = time.time()
+            for i in xrange(iterations):
+                fn()
+            times.append((time.time() - t0) / (iterations * ops))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return times
+
+# Picks the number of iterations so that one repeat takes about
+# target seconds
+def calibrate(fn, target):
+    iterations = 1
+    while True:
+        t0 = time.time()
+        for i in xrange(iterations):
+            fn()
+        elapsed = time.time() - t0
+        if elapsed >= target / 10 or iterations >= 1000000:
+            return max(int(iterations * target / max(elapsed, 1e-9)), 1)
+        iterations *= 10
+
+def run(selected, repeats, target):
+    results = {}
+    for name, fn, ops in selected:
+        iterations = calibrate(fn, target)
+        times = sorted(measure(fn, ops, iterations, repeats))
+        results[name] = {
+            'us_per_op': 1e6 * times[0],
+            'median_us_per_op': 1e6 * times[len(times) // 2],
+            'ops_per_sec': 1.0 / times[0],
+            'iterations': iterations,
+            'repeats': repeats,
+            'ops_per_iteration': ops,
+        }
+    return results
+
+# Adds each benchmark's threshold (the baseline's best time per
+# operation times max_slowdown, unless the baseline entry has its own
+# 'max_slowdown' for a noisy benchmark), and returns the names of those
+# that exceed it
+def check_regressions(results, baseline, max_slowdown):
+    regressions = []
+    for name, r in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        r['baseline_us_per_op'] = base['us_per_op']
+        r['threshold_us_per_op'] = base['us_per_op'] * base.get('max_slowdown', max_slowdown)
+        r['slowdown'] = r['us_per_op'] / base['us_per_op']
+        if r['us_per_op'] > r['threshold_us_per_op']:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="write the results to FILE as JSON")
+    parser.add_option("-b", "--baseline", metavar="FILE",
+                      help="compare against the results of an earlier run")
+    parser.add_option("-s", "--max-slowdown", type="float", default=1.25,
+                      help="slowdown relative to the baseline that is a regression [default: %default]")
+    parser.add_option("-c", "--capture", metavar="FILE",
+                      help="time RobotState packets recorded with capture.py instead of synthetic ones")
+    parser.add_option("-f", "--filter", default="",
+                      help="only run the benchmarks whose names contain this")
+    parser.add_option("-r", "--repeats", type="int", default=5,
+                      help="runs of every benchmark [default: %default]")
+    parser.add_option("-t", "--time", type="float", default=0.2,
+                      help="approximate seconds per run [default: %default]")
+    parser.add_option("-q", "--quick", action="store_true", default=False,
+                      help="fewer and shorter runs, for a smoke test")
+    (options, args) = parser.parse_args()
+    if options.quick:
+        options.repeats = 2
+        options.time = 0.02
+
+    if options.capture:
+        packets = recorded_packets(options.capture)
+        if not packets:
+            parser.error("%s has no RobotState packets" % options.capture)
+    else:
+        packets = synthetic_packets(125)
+
+    selected = [b for b in benchmarks(packets) if options.filter in b[0]]
+    results = run(selected, options.repeats, options.time)
+    report = {
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'packets': options.capture or 'synthetic',
+        'results': results,
+    }
+
+    regressions = []
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = check_regressions(results, baseline, options.max_slowdown)
+        report['baseline'] = options.baseline
+        report['max_slowdown'] = options.max_slowdown
+        report['regressions'] = regressions
+
+    for name in sorted(results):
+        r = results[name]
+        line = "%-32s %10.3f us/op  (median %.3f)" % (name, r['us_per_op'], r['median_us_per_op'])
+        if 'slowdown' in r:
+            line += "  x%.2f" % r['slowdown']
+            if name in regressions:
+                line += "  REGRESSION"
+        print line
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if regressions:
+        print "%d regression(s): %s" % (len(regressions), ', '.join(regressions))
+        sys.exit(1)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+import time, sys, threading
+import socket, select
+import struct
+import mmap
+import optparse
+
+# Captures the streams that the robot sends to the driver, and serves
+# them back over TCP so the driver can be run against a recording.
+#
+# A capture file starts with MAGIC and is followed by records, each of
+# which is a RECORD header (receive time, stream, payload length) and the
+# payload itself:
+#
+#   STREAM_STATE:     one RobotState packet from the primary interface (30002)
+#   STREAM_COMMANDER: bytes received from driverProg on the reverse port (50001)
+
+MAGIC = "URCAP001"
+RECORD = struct.Struct("!dBI")
+
+STREAM_STATE = 1
+STREAM_COMMANDER = 2
+
+# Appends records to a memory-mapped capture file.  The file is grown in
+# CHUNK sized steps and truncated to its contents on close().  Safe to
+# call from several threads.
+class CaptureWriter(object):
+    CHUNK = 16 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__file = open(path, 'w+b')
+        self.__size = 0
+        self.__map = None
+        self.__pos = 0
+        self.__grow(len(MAGIC))
+        self.__map[0:len(MAGIC)] = MAGIC
+        self.__pos = len(MAGIC)
+
+    def record(self, stream, data, stamp=None):
+        if stamp is None:
+            stamp = time.time()
+        if not isinstance(data, str):
+            data = memoryview(data).tobytes()
+        with self.__lock:
+            if not self.__map:
+                return
+            end = self.__pos + RECORD.size + len(data)
+            if end > self.__size:
+                self.__grow(end - self.__size)
+            RECORD.pack_into(self.__map, self.__pos, stamp, stream, len(data))
+            self.__map[self.__pos + RECORD.size:end] = data
+            self.__pos = end
+
+    def close(self):
+        with self.__lock:
+            if not self.__map:
+                return
+            self.__map.flush()
+            self.__map.close()
+            self.__map = None
+            self.__file.truncate(self.__pos)
+            self.__file.close()
+
+    def __grow(self, n):
+        if self.__map:
+            self.__map.flush()
+            self.__map.close()
+        self.__size += max(n, self.CHUNK)
+        self.__file.truncate(self.__size)
+        self.__map = mmap.mmap(self.__file.fileno(), self.__size)
+
+# Yields (stamp, stream, payload) for every record of a capture file.
+# The payloads are buffers into a read-only mapping of the file.
+def read_capture(path):
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if m[:len(MAGIC)] != MAGIC:
+        raise Exception("%s is not a capture file" % path)
+    pos = len(MAGIC)
+    while pos + RECORD.size <= len(m):
+        stamp, stream, length = RECORD.unpack_from(m, pos)
+        pos += RECORD.size
+        if stream == 0 or pos + length > len(m):
+            break  # Unfinished capture (the writer did not close the file)
+        yield stamp, stream, buffer(m, pos, length)
+        pos += length
+
+# Plays a list of (stamp, payload) records out on sock.  With speed > 0
+# the original spacing is reproduced (scaled by speed), otherwise records
+# are sent as fast as possible.  poll is called with the time left until
+# the next record, and should wait at most that long.
+def play_records(sock, records, speed=1.0, poll=time.sleep):
+    if not records:
+        return
+    t0 = time.time()
+    stamp0 = records[0][0]
+    for stamp, payload in records:
+        if speed > 0:
+            delay = (stamp - stamp0) / speed - (time.time() - t0)
+            if delay > 0:
+                poll(delay)
+        sock.sendall(payload)
+
+# Serves a capture as if it came from a robot.
+#
+# The driver connects to port and receives the recorded RobotState
+# stream.  Once the driver uploads driverProg, the server connects back
+# to the driver on reverse_port and plays the recorded commander stream,
+# so the whole UR5Connection/CommanderTCPHandler path is exercised.
+# Whatever the driver sends on that connection is discarded.
+class ReplayServer(object):
+    def __init__(self, path, port=30002, reverse_port=50001, speed=1.0, loop=False):
+        self.port = port
+        self.reverse_port = reverse_port
+        self.speed = speed
+        self.loop = loop
+        self.state_records = []
+        self.commander_records = []
+        for stamp, stream, payload in read_capture(path):
+            if stream == STREAM_STATE:
+                self.state_records.append((stamp, payload))
+            elif stream == STREAM_COMMANDER:
+                self.commander_records.append((stamp, payload))
+
+    def serve_forever(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("", self.port))
+        server.listen(1)
+        print "Replaying %d state and %d commander records on port %d" % \
+            (len(self.state_records), len(self.commander_records), self.port)
+        while True:
+            conn, addr = server.accept()
+            print "Driver connected from %s:%d" % addr
+            try:
+                self.__serve_state(conn, addr[0])
+            except socket.error, ex:
+                print "Driver disconnected:", ex
+            finally:
+                conn.close()
+
+    def __serve_state(self, conn, driver_host):
+        received = [""]
+        def poll(timeout):
+            deadline = time.time() + timeout
+            while True:
+                r, _, _ = select.select([conn], [], [], max(deadline - time.time(), 0))
+                if not r:
+                    return
+                more = conn.recv(4096)
+                if not more:
+                    raise socket.error("EOF")
+                received[0] += more
+                if "def driverProg" in received[0]:
+                    received[0] = ""
+                    self.__start_commander(driver_host)
+
+        while True:
+            play_records(conn, self.state_records, self.speed, poll)
+            if not self.loop:
+                break
+
+    def __start_commander(self, driver_host):
+        thread = threading.Thread(name="ReplayCommander", target=self.__serve_commander,
+                                  args=(driver_host,))
+        thread.daemon = True
+        thread.start()
+
+    def __serve_commander(self, driver_host):
+        sock = socket.create_connection((driver_host, self.reverse_port))
+        def poll(timeout):
+            r, _, _ = select.select([sock], [], [], timeout)
+            if r and not sock.recv(4096):
+                raise socket.error("EOF")
+        try:
+            play_records(sock, self.commander_records, self.speed, poll)
+        except socket.error, ex:
+            print "Commander connection closed:", ex
+        finally:
+            sock.close()
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options] capture_file")
+    parser.add_option("-p", "--port", type="int", default=30002,
+                      help="port to serve the RobotState stream on [default: %default]")
+    parser.add_option("-r", "--reverse-port", type="int", default=50001,
+                      help="driver port to play the commander stream to [default: %default]")
+    parser.add_option("-s", "--speed", type="float", default=1.0,
+                      help="playback speed, 0 for as fast as possible [default: %default]")
+    parser.add_option("-l", "--loop", action="store_true", default=False,
+                      help="replay the RobotState stream forever")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("You must specify the capture file")
+    server = ReplayServer(args[0], options.port, options.reverse_port,
+                          options.speed, options.loop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__': main()
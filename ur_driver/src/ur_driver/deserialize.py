@@ -1,4 +1,5 @@
 import struct
+import numpy as np
 
 class PackageType(object):
     ROBOT_MODE_DATA = 0
@@ -72,46 +73,62 @@ class RobotModeData(object):
                  'power_on_robot', 'emergency_stopped',
                  'security_stopped', 'program_running', 'program_paused',
                  'robot_mode', 'speed_fraction']
+    _struct = struct.Struct("!IBQ???????Bd")
     @staticmethod
-    def unpack(buf):
+    def unpack(buf, offset=0):
         rmd = RobotModeData()
         (_, _,
          rmd.timestamp, rmd.robot_connected, rmd.real_robot_enabled,
          rmd.power_on_robot, rmd.emergency_stopped, rmd.security_stopped,
          rmd.program_running, rmd.program_paused, rmd.robot_mode,
-         rmd.speed_fraction) = struct.unpack_from("!IBQ???????Bd", buf)
+         rmd.speed_fraction) = RobotModeData._struct.unpack_from(buf, offset)
         return rmd
 
+# Layout of one joint in the JOINT_DATA package, for decoding all six
+# joints as a single structured array.
+JOINT_DTYPE = np.dtype([('q_actual', '>f8'), ('q_target', '>f8'), ('qd_actual', '>f8'),
+                        ('I_actual', '>f4'), ('V_actual', '>f4'), ('T_motor', '>f4'),
+                        ('T_micro', '>f4'), ('joint_mode', 'u1')])
+
 # Don't use T_micro (obsolete). For retrocompatibility purposes. 
 class JointData(object):
     __slots__ = ['q_actual', 'q_target', 'qd_actual',
                  'I_actual', 'V_actual', 'T_motor', 'T_micro', 'joint_mode']
+    _struct = struct.Struct("!dddffffB")
     @staticmethod
-    def unpack(buf):
+    def unpack(buf, offset=0):
         all_joints = []
-        offset = 5
+        offset += 5
         for i in range(6):
             jd = JointData()
             (jd.q_actual, jd.q_target, jd.qd_actual, jd.I_actual, jd.V_actual,
              jd.T_motor, jd.T_micro, 
-             jd.joint_mode) = struct.unpack_from("!dddffffB", buf, offset)
-            offset += 41
+             jd.joint_mode) = JointData._struct.unpack_from(buf, offset)
+            offset += JointData._struct.size
             all_joints.append(jd)
         return all_joints
 
+    # Returns the six joints as one read-only structured array (see
+    # JOINT_DTYPE) viewing buf, so joints['q_actual'] is the vector of
+    # joint positions.  No per-joint objects are created.
+    @staticmethod
+    def unpack_array(buf, offset=0):
+        return np.frombuffer(buf, dtype=JOINT_DTYPE, count=6, offset=offset+5)
+
 class ToolData(object):
     __slots__ = ['analog_input_range2', 'analog_input_range3',
                  'analog_input2', 'analog_input3',
                  'tool_voltage_48V', 'tool_output_voltage', 'tool_current',
                  'tool_temperature', 'tool_mode']
+    _struct = struct.Struct("!IBbbddfBffB")
     @staticmethod
-    def unpack(buf):
+    def unpack(buf, offset=0):
         td = ToolData()
         (_, _,
          td.analog_input_range2, td.analog_input_range3,
          td.analog_input2, td.analog_input3,
          td.tool_voltage_48V, td.tool_output_voltage, td.tool_current,
-         td.tool_temperature, td.tool_mode) = struct.unpack_from("!IBbbddfBffB", buf)
+         td.tool_temperature, td.tool_mode) = ToolData._struct.unpack_from(buf, offset)
         return td
 
 class MasterboardData(object):
@@ -124,8 +141,9 @@ class MasterboardData(object):
                  'robot_voltage_48V', 'robot_current',
                  'master_io_current', 'master_safety_state',
                  'master_onoff_state']
+    _struct = struct.Struct("!IBhhbbddbbddffffBB")
     @staticmethod
-    def unpack(buf):
+    def unpack(buf, offset=0):
         md = MasterboardData()
         (_, _,
          md.digital_input_bits, md.digital_output_bits,
@@ -136,21 +154,22 @@ class MasterboardData(object):
          md.masterboard_temperature,
          md.robot_voltage_48V, md.robot_current,
          md.master_io_current, md.master_safety_state,
-         md.master_onoff_state) = struct.unpack_from("!IBhhbbddbbddffffBB", buf)
+         md.master_onoff_state) = MasterboardData._struct.unpack_from(buf, offset)
         return md
 
 class CartesianInfo(object):
     __slots__ = ['x', 'y', 'z', 'rx', 'ry', 'rz']
+    _struct = struct.Struct("!IB6d")
     @staticmethod
-    def unpack(buf):
+    def unpack(buf, offset=0):
         ci = CartesianInfo()
         (_, _,
-         ci.x, ci.y, ci.z, ci.rx, ci.ry, ci.rz) = struct.unpack_from("!IB6d", buf)
+         ci.x, ci.y, ci.z, ci.rx, ci.ry, ci.rz) = CartesianInfo._struct.unpack_from(buf, offset)
         return ci
 
 class KinematicsInfo(object):
     @staticmethod
-    def unpack(buf):
+    def unpack(buf, offset=0):
         return KinematicsInfo()
 
 class JointLimitData(object):
@@ -163,94 +182,142 @@ class ConfigurationData(object):
                  'dh_a', 'dh_d', 'dh_alpha', 'dh_theta',
                  'masterboard_version', 'controller_box_type',
                  'robot_type', 'robot_subtype']
+    _limits_struct = struct.Struct("!dd")
+    _defaults_struct = struct.Struct("!ddddd")
+    _dh_struct = struct.Struct("!6d")
+    _versions_struct = struct.Struct("!iiii")
     @staticmethod
-    def unpack(buf):
+    def unpack(buf, offset=0):
         cd = ConfigurationData()
         cd.joint_limit_data = []
         for i in range(6):
             jld = JointLimitData()
-            (jld.min_limit, jld.max_limit) = struct.unpack_from("!dd", buf, 5+16*i)
-            (jld.max_speed, jld.max_acceleration) = struct.unpack_from("!dd", buf, 5+16*6+16*i)
+            (jld.min_limit, jld.max_limit) = \
+                ConfigurationData._limits_struct.unpack_from(buf, offset+5+16*i)
+            (jld.max_speed, jld.max_acceleration) = \
+                ConfigurationData._limits_struct.unpack_from(buf, offset+5+16*6+16*i)
             cd.joint_limit_data.append(jld)
         (cd.v_joint_default, cd.a_joint_default, cd.v_tool_default, cd.a_tool_default,
-         cd.eq_radius) = struct.unpack_from("!ddddd", buf, 5+32*6)
+         cd.eq_radius) = ConfigurationData._defaults_struct.unpack_from(buf, offset+5+32*6)
+        dh_offset = offset+5+32*6+5*8
+        cd.dh_a = list(ConfigurationData._dh_struct.unpack_from(buf, dh_offset))
+        cd.dh_d = list(ConfigurationData._dh_struct.unpack_from(buf, dh_offset+48))
+        cd.dh_alpha = list(ConfigurationData._dh_struct.unpack_from(buf, dh_offset+2*48))
+        cd.dh_theta = list(ConfigurationData._dh_struct.unpack_from(buf, dh_offset+3*48))
         (cd.masterboard_version, cd.controller_box_type, cd.robot_type,
-         cd.robot_subtype) = struct.unpack_from("!iiii", buf, 5+32*6+5*8+6*32)
+         cd.robot_subtype) = ConfigurationData._versions_struct.unpack_from(buf, offset+5+32*6+5*8+6*32)
         return cd
 
 class ForceModeData(object):
     __slots__ = ['x', 'y', 'z', 'rx', 'ry', 'rz', 'robot_dexterity']
+    _struct = struct.Struct("!IBddddddd")
     @staticmethod
-    def unpack(buf):
+    def unpack(buf, offset=0):
         fmd = ForceModeData()
         (_, _, fmd.x, fmd.y, fmd.z, fmd.rx, fmd.ry, fmd.rz,
-         fmd.robot_dexterity) = struct.unpack_from("!IBddddddd", buf)
+         fmd.robot_dexterity) = ForceModeData._struct.unpack_from(buf, offset)
         return fmd
 
 class AdditionalInfo(object):
     __slots__ = ['ctrl_bits', 'teach_button']
+    _struct = struct.Struct("!IBIB")
     @staticmethod
-    def unpack(buf):
+    def unpack(buf, offset=0):
         ai = AdditionalInfo()
-        (_, _, ai.ctrl_bits, ai.teach_button) = struct.unpack_from("!IBIB", buf)
+        (_, _, ai.ctrl_bits, ai.teach_button) = AdditionalInfo._struct.unpack_from(buf, offset)
         return ai
 
+# Maps each package type to the RobotState attribute holding it, and to
+# the class that decodes it.
+PACKAGE_ATTRIBUTES = {
+    PackageType.ROBOT_MODE_DATA: ('robot_mode_data', RobotModeData),
+    PackageType.JOINT_DATA: ('joint_data', JointData),
+    PackageType.TOOL_DATA: ('tool_data', ToolData),
+    PackageType.MASTERBOARD_DATA: ('masterboard_data', MasterboardData),
+    PackageType.CARTESIAN_INFO: ('cartesian_info', CartesianInfo),
+    PackageType.KINEMATICS_INFO: ('kinematics_info', KinematicsInfo),
+    PackageType.CONFIGURATION_DATA: ('configuration_data', ConfigurationData),
+    PackageType.FORCE_MODE_DATA: ('force_mode_data', ForceModeData),
+    PackageType.ADDITIONAL_INFO: ('additional_info', AdditionalInfo),
+}
+
+# Lazily decoded RobotState attributes: { attribute : (ptype, decoder) }
+_LAZY_ATTRIBUTES = dict((attr, (ptype, cls.unpack))
+                        for ptype, (attr, cls) in PACKAGE_ATTRIBUTES.items())
+_LAZY_ATTRIBUTES['joints'] = (PackageType.JOINT_DATA, JointData.unpack_array)
+
+# unpack() only walks the package headers and records where each
+# sub-package starts.  A sub-package is decoded the first time its
+# attribute is read; the result is then stored in the slot, so later
+# reads are plain attribute lookups.
+#
+# A packet given as a str is kept as it is.  Any other buffer (such as a
+# view handed out by PacketFramer) may be reused once unpack() returns,
+# so the sub-packages are copied out of it, and only those of the types
+# in ptypes (by default, all of them): the others read as missing.
+#
+# The joint package can be read either as joint_data (a list of six
+# JointData objects) or as joints (a structured array, see JOINT_DTYPE).
 class RobotState(object):
     __slots__ = ['robot_mode_data', 'joint_data', 'tool_data',
                  'masterboard_data', 'cartesian_info',
                  'kinematics_info', 'configuration_data',
                  'force_mode_data', 'additional_info',
-                 'unknown_ptypes']
+                 'joints', 'unknown_ptypes', '_packages']
+
+    _header_struct = struct.Struct("!IB")
 
     def __init__(self):
         self.unknown_ptypes = []
+        self._packages = {}  # ptype -> (buffer, offset of the sub-package)
+
+    def __getattr__(self, name):
+        ptype, decode = _LAZY_ATTRIBUTES.get(name, (None, None))
+        if ptype is None or ptype not in self._packages:
+            raise AttributeError("'RobotState' object has no attribute '%s'" % name)
+        value = decode(*self._packages[ptype])
+        setattr(self, name, value)
+        return value
 
     @staticmethod
-    def unpack(buf):
-        length, mtype = struct.unpack_from("!IB", buf)
+    def unpack(buf, ptypes=None):
+        length, mtype = RobotState._header_struct.unpack_from(buf)
         if length != len(buf):
             raise Exception("Could not unpack packet: length field is incorrect")
         if mtype != 16:
             if mtype == 20:
                 print "Likely a syntax error:"
-                print buf[:2048]
+                print str(bytearray(buf[:2048]))
             raise Exception("Fatal error when unpacking RobotState packet")
 
+        copy = not isinstance(buf, str)
+        if copy:
+            buf = memoryview(buf)
+
         rs = RobotState()
         offset = 5
-        while offset < len(buf):
-            length, ptype = struct.unpack_from("!IB", buf, offset)
-            assert offset + length <= len(buf)
-            package_buf = buffer(buf, offset, length)
-            offset += length
-
-            if ptype == PackageType.ROBOT_MODE_DATA:
-                rs.robot_mode_data = RobotModeData.unpack(package_buf)
-            elif ptype == PackageType.JOINT_DATA:
-                rs.joint_data = JointData.unpack(package_buf)
-            elif ptype == PackageType.TOOL_DATA:
-                rs.tool_data = ToolData.unpack(package_buf)
-            elif ptype == PackageType.MASTERBOARD_DATA:
-                rs.masterboard_data = MasterboardData.unpack(package_buf)
-            elif ptype == PackageType.CARTESIAN_INFO:
-                rs.cartesian_info = CartesianInfo.unpack(package_buf)
-            elif ptype == PackageType.KINEMATICS_INFO:
-                rs.kinematics_info = KinematicsInfo.unpack(package_buf)
-            elif ptype == PackageType.CONFIGURATION_DATA:
-                rs.configuration_data = ConfigurationData.unpack(package_buf)
-            elif ptype == PackageType.FORCE_MODE_DATA:
-                rs.force_mode_data = ForceModeData.unpack(package_buf)
-            elif ptype == PackageType.ADDITIONAL_INFO:
-                rs.additional_info = AdditionalInfo.unpack(package_buf)
+        while offset < length:
+            package_length, ptype = RobotState._header_struct.unpack_from(buf, offset)
+            assert package_length > 0 and offset + package_length <= length
+            if ptype in PACKAGE_ATTRIBUTES:
+                if not copy:
+                    rs._packages[ptype] = (buf, offset)
+                elif ptypes is None or ptype in ptypes:
+                    rs._packages[ptype] = (buf[offset:offset + package_length].tobytes(), 0)
             else:
                 rs.unknown_ptypes.append(ptype)
+            offset += package_length
         return rs
 
 def pstate(o, indent=''):
     for s in o.__slots__:
+        if s.startswith('_'):
+            continue
         child = getattr(o, s, None)
         if child is None:
             print "%s%s: None" % (indent, s)
+        elif isinstance(child, np.ndarray):
+            print "%s%s: %s" % (indent, s, child)
         elif hasattr(child, '__slots__'):
             print "%s%s:" % (indent, s)
             pstate(child, indent + '    ')
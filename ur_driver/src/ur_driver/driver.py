@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 import roslib; roslib.load_manifest('ur_driver')
 import time, sys, threading, math
-import copy
 import datetime
 import socket, select
 import struct
@@ -9,39 +8,42 @@ import traceback, code
 import optparse
 import SocketServer
 from BeautifulSoup import BeautifulSoup
+import numpy as np
 
 import rospy
 import actionlib
-from sensor_msgs.msg import JointState
-from control_msgs.msg import FollowJointTrajectoryAction
+from control_msgs.msg import FollowJointTrajectoryAction, FollowJointTrajectoryFeedback
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 from trajectory_msgs.msg import JointTrajectory, JointTrajectoryPoint
 
-from deserialize import RobotState, RobotMode
+from deserialize import RobotState, RobotMode, PackageType
+from framing import PacketFramer, MessageParser
+from capture import CaptureWriter, STREAM_STATE, STREAM_COMMANDER
+from scheduler import PeriodicThread
+from reactor import Reactor
+from publisher import JointStatePublisher, JointStateSnapshot
+from instrumentation import Metrics, EchoTracker, thread_stacks
+from supervision import EventSource, Liveness, Backoff, ROBOT_CONNECTED, ROBOT_READY, \
+    ROBOT_HALTED, ROBOT_DISCONNECTED, PROGRAM_SENT, COMMANDER_CONNECTED, COMMANDER_DISCONNECTED
+from trajectory import CompiledTrajectory, SetpointTable, InvalidTrajectory, validate_trajectory, \
+    splice_table
+from kinematics import Kinematics, dh_from_configuration, dh_from_urdf, make_kinematics, \
+    path_arrays, solve_path
+from protocol import PORT, REVERSE_PORT, MSG_OUT, MSG_QUIT, MSG_JOINT_STATES, \
+    MSG_MOVEJ, MSG_WAYPOINT_FINISHED, MSG_STOPJ, MSG_SERVOJ, MSG_MOVEL, \
+    MSG_SERVOJ_BATCH, MSG_JOINT_STATES_V2, SERVO_BUFFER_SIZE, MULT_jointstate, \
+    MULT_time, MULT_blend, PROTOCOL_VERSION, MULT_jointstate_v2, \
+    JOINT_STATES_V2, ROBOT_MESSAGES, pack_servoj, pack_servoj_batch
+
+# The Cartesian trajectory action is generated by the build; without it,
+# the driver only serves joint trajectories
+try:
+    from ur_driver.msg import FollowCartesianTrajectoryAction
+except ImportError:
+    FollowCartesianTrajectoryAction = None
 
 prevent_programming = False
 
-# Joint offsets, pulled from calibration information stored in the URDF
-#
-# { "joint_name" : offset }
-#
-# q_actual = q_from_driver + offset
-joint_offsets = {}
-
-PORT=30002
-REVERSE_PORT = 50001
-
-MSG_OUT = 1
-MSG_QUIT = 2
-MSG_JOINT_STATES = 3
-MSG_MOVEJ = 4
-MSG_WAYPOINT_FINISHED = 5
-MSG_STOPJ = 6
-MSG_SERVOJ = 7
-MSG_MOVEL = 8
-MULT_jointstate = 10000.0
-MULT_time = 1000000.0
-MULT_blend = 1000.0
-
 JOINT_NAMES = ['shoulder_pan_joint', 'shoulder_lift_joint', 'elbow_joint',
                'wrist_1_joint', 'wrist_2_joint', 'wrist_3_joint']
 
@@ -50,24 +52,12 @@ Q2 = [1.5,0,-1.57,0,0,0]
 Q3 = [1.5,-0.2,-1.57,0,0,0]
   
 
-connected_robot = None
-connected_robot_lock = threading.Lock()
-connected_robot_cond = threading.Condition(connected_robot_lock)
-pub_joint_states = rospy.Publisher('joint_states', JointState)
 #dump_state = open('dump_state', 'wb')
 
 class EOF(Exception): pass
 
 def dumpstacks():
-    id2name = dict([(th.ident, th.name) for th in threading.enumerate()])
-    code = []
-    for threadId, stack in sys._current_frames().items():
-        code.append("\n# Thread: %s(%d)" % (id2name.get(threadId,""), threadId))
-        for filename, lineno, name, line in traceback.extract_stack(stack):
-            code.append('File: "%s", line %d, in %s' % (filename, lineno, name))
-            if line:
-                code.append("  %s" % (line.strip()))
-    print "\n".join(code)
+    print thread_stacks()
 
 def log(s):
     print "[%s] %s" % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), s)
@@ -78,50 +68,86 @@ RESET_PROGRAM = '''def resetProg():
 end
 '''
 #RESET_PROGRAM = ''
+
+# Prefix of the counters of packages of unknown types, by type
+UNKNOWN_PACKAGES = 'primary.unknown_packages.'
     
 class UR5Connection(object):
-    TIMEOUT = 1.0
+    CONNECT_TIMEOUT = 0.5
     
     DISCONNECTED = 0
     CONNECTED = 1
     READY_TO_PROGRAM = 2
     EXECUTING = 3
     
-    def __init__(self, hostname, port, program):
+    # With a reactor, the connection is read on its event loop rather than
+    # on a thread of its own.  The connection is dropped when no packet
+    # arrives for the arm's primary_timeout.  Changes of state are emitted
+    # as the arm's events (see supervision.py).
+    def __init__(self, arm, program, reactor=None):
         self.__thread = None
         self.__sock = None
         self.robot_state = self.DISCONNECTED
-        self.hostname = hostname
-        self.port = port
+        self.arm = arm
+        self.hostname = arm.hostname
+        self.port = arm.port
         self.program = program
         self.last_state = None
-
-    def connect(self):
+        self.timeout = arm.primary_timeout
+        self.__framer = PacketFramer()
+        self.__liveness = Liveness(self.timeout)
+        self.__reactor = reactor
+        self.__watchdog = None
+        self.__last_received = 0.0
+
+    # Opens a connection to the robot's primary interface.  Raises
+    # socket.error if the robot can't be reached.
+    def open(self):
+        sock = socket.create_connection((self.hostname, self.port), self.CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        return sock
+
+    # Starts reading the robot's primary interface from sock (as returned
+    # by open()), or from a new connection
+    def connect(self, sock=None):
         if self.__sock:
             self.disconnect()
-        self.__buf = ""
+        if sock is None:
+            sock = self.open()
+        self.__framer.reset()
+        self.__liveness = Liveness(self.timeout)
+        self.__liveness.heard(time.time())
         self.robot_state = self.CONNECTED
-        self.__sock = socket.create_connection((self.hostname, self.port))
+        self.__sock = sock
         self.__keep_running = True
-        self.__thread = threading.Thread(name="UR5Connection", target=self.__run)
-        self.__thread.daemon = True
-        self.__thread.start()
+        if self.__reactor:
+            self.__reactor.add_reader(self.__sock, self.__on_readable)
+            self.__watchdog = self.__reactor.periodic(self.timeout / 4, self.__check_timeout)
+            self.__watchdog.start()
+        else:
+            self.__thread = threading.Thread(name="UR5Connection", target=self.__run)
+            self.__thread.daemon = True
+            self.__thread.start()
+        self.arm.events.emit(ROBOT_CONNECTED)
 
+    # Returns whether the program was sent
     def send_program(self):
         global prevent_programming
         if prevent_programming:
             rospy.loginfo("Programming is currently prevented")
-            return
+            return False
         assert self.robot_state in [self.READY_TO_PROGRAM, self.EXECUTING]
         rospy.loginfo("Programming the robot at %s" % self.hostname)
         self.__sock.sendall(self.program)
         self.robot_state = self.EXECUTING
+        return True
 
     def send_reset_program(self):
         self.__sock.sendall(RESET_PROGRAM)
         self.robot_state = self.READY_TO_PROGRAM
         
     def disconnect(self):
+        self.__detach()
         if self.__thread:
             self.__keep_running = False
             self.__thread.join()
@@ -132,20 +158,37 @@ class UR5Connection(object):
         self.last_state = None
         self.robot_state = self.DISCONNECTED
 
+    def connected(self):
+        return self.robot_state != self.DISCONNECTED
+
     def ready_to_program(self):
         return self.robot_state in [self.READY_TO_PROGRAM, self.EXECUTING]
 
-    def __trigger_disconnected(self):
-        log("Robot disconnected")
+    def __trigger_disconnected(self, reason):
+        log("Robot disconnected: %s" % reason)
+        if self.__framer.pending():
+            self.arm.metrics.incr('primary.dropped_partial')
         self.robot_state = self.DISCONNECTED
+        self.arm.events.emit(ROBOT_DISCONNECTED, reason=reason)
     def __trigger_ready_to_program(self):
         rospy.loginfo("Robot ready to program")
+        self.arm.events.emit(ROBOT_READY)
     def __trigger_halted(self):
         log("Halted")
+        self.arm.events.emit(ROBOT_HALTED)
+
+    # The sub-packages __on_packet reads (see RobotState.unpack); the
+    # configuration only until it has provided the kinematic parameters
+    PACKAGES = frozenset([PackageType.ROBOT_MODE_DATA, PackageType.JOINT_DATA])
+    PACKAGES_WITH_CONFIGURATION = PACKAGES | frozenset([PackageType.CONFIGURATION_DATA])
 
     def __on_packet(self, buf):
-        state = RobotState.unpack(buf)
+        metrics = self.arm.metrics
+        metrics.rate('primary.packets').add(len(buf), self.__last_received)
+        state = RobotState.unpack(buf, self.PACKAGES if self.arm.dh_params else
+                                  self.PACKAGES_WITH_CONFIGURATION)
         self.last_state = state
+        metrics.histogram('primary.unpack').add(time.time() - self.__last_received)
         #import deserialize; deserialize.pstate(self.last_state)
 
         #log("Packet.  Mode=%s" % state.robot_mode_data.robot_mode)
@@ -159,17 +202,10 @@ class UR5Connection(object):
         # needs to publish joint states using information from the
         # robot state packet.
         if self.robot_state != self.EXECUTING:
-            msg = JointState()
-            msg.header.stamp = rospy.get_rostime()
-            msg.header.frame_id = "From binary state data"
-            msg.name = joint_names
-            msg.position = [0.0] * 6
-            for i, jd in enumerate(state.joint_data):
-                msg.position[i] = jd.q_actual + joint_offsets.get(joint_names[i], 0.0)
-            msg.velocity = [jd.qd_actual for jd in state.joint_data]
-            msg.effort = [0]*6
-            pub_joint_states.publish(msg)
-            self.last_joint_states = msg
+            joints = state.joints
+            self.last_joint_states = JointStateSnapshot(self.arm.joint_state_publisher.publish(
+                joints['q_actual'], joints['qd_actual'], frame_id="From binary state data"))
+            metrics.histogram('primary.publish').add(time.time() - self.__last_received)
 
         # Updates the state machine that determines whether we can program the robot.
         can_execute = (state.robot_mode_data.robot_mode in [RobotMode.READY, RobotMode.RUNNING])
@@ -185,139 +221,182 @@ class UR5Connection(object):
                 self.__trigger_halted()
                 self.robot_state = self.CONNECTED
 
-        # Report on any unknown packet types that were received
-        if len(state.unknown_ptypes) > 0:
-            state.unknown_ptypes.sort()
-            s_unknown_ptypes = [str(ptype) for ptype in state.unknown_ptypes]
-            self.throttle_warn_unknown(1.0, "Ignoring unknown pkt type(s): %s. "
-                          "Please report." % ", ".join(s_unknown_ptypes))
-
-    def throttle_warn_unknown(self, period, msg):
-        self.__dict__.setdefault('_last_hit', 0.0)
-        # this only works for a single caller
-        if (self._last_hit + period) <= rospy.get_time():
-            self._last_hit = rospy.get_time()
-            rospy.logwarn(msg)
+        # Remembers the arm's kinematic parameters, which the controller
+        # sends in some of the packets
+        if self.arm.dh_params is None:
+            try:
+                self.arm.dh_params = dh_from_configuration(state.configuration_data)
+            except AttributeError:
+                pass
+
+        # Counts the packages of unknown types that were received, by type
+        # (reported on the diagnostics topic)
+        for ptype in state.unknown_ptypes:
+            metrics.incr('%s%d' % (UNKNOWN_PACKAGES, ptype))
+
+    # Receives what is available and handles every complete packet
+    # received so far.  Returns False if the robot disconnected.
+    def __receive(self):
+        if not self.__framer.recv_from(self.__sock):
+            self.__trigger_disconnected("Connection closed by the robot")
+            return False
+        self.__last_received = time.time()
+        self.__liveness.heard(self.__last_received)
+        for packet in self.__framer.packets():
+            if self.arm.capture_log:
+                self.arm.capture_log.record(STREAM_STATE, packet)
+            self.__on_packet(packet)
+        return True
+
+    # Returns True (after triggering the disconnection) if the robot has
+    # been silent for too long
+    def __timed_out(self):
+        now = time.time()
+        if not self.__liveness.expired(now):
+            return False
+        self.__trigger_disconnected("No packets for %.3f sec" % self.__liveness.age(now))
+        return True
 
     def __run(self):
         while self.__keep_running:
-            r, _, _ = select.select([self.__sock], [], [], self.TIMEOUT)
+            r, _, _ = select.select([self.__sock], [], [], self.timeout / 4)
             if r:
-                more = self.__sock.recv(4096)
-                if more:
-                    self.__buf = self.__buf + more
-
-                    # Attempts to extract a packet
-                    packet_length, ptype = struct.unpack_from("!IB", self.__buf)
-                    if len(self.__buf) >= packet_length:
-                        packet, self.__buf = self.__buf[:packet_length], self.__buf[packet_length:]
-                        self.__on_packet(packet)
-                else:
-                    self.__trigger_disconnected()
+                if not self.__receive():
                     self.__keep_running = False
-                    
-            else:
-                self.__trigger_disconnected()
+            elif self.__timed_out():
                 self.__keep_running = False
 
+    def __on_readable(self):
+        if not self.__receive():
+            self.__detach()
+
+    def __check_timeout(self):
+        if self.__timed_out():
+            self.__detach()
 
-def setConnectedRobot(r):
-    global connected_robot, connected_robot_lock
-    with connected_robot_lock:
-        connected_robot = r
-        connected_robot_cond.notify()
+    # Stops reading the connection on the reactor
+    def __detach(self):
+        if self.__watchdog:
+            self.__watchdog.stop()
+            self.__watchdog = None
+        if self.__reactor and self.__sock:
+            self.__reactor.remove_reader(self.__sock)
 
-def getConnectedRobot(wait=False, timeout=-1):
-    started = time.time()
-    with connected_robot_lock:
-        if wait:
-            while not connected_robot:
-                if timeout >= 0 and time.time() > started + timeout:
-                    break
-                connected_robot_cond.wait(0.2)
-        return connected_robot
 
-# Receives messages from the robot over the socket
+# Receives messages from the robot over the socket.  The connection is
+# dropped when its joint states stop arriving for the arm's
+# liveness_timeout (see supervision.Liveness), which is checked
+# CHECKS_PER_TIMEOUT times per timeout.
 class CommanderTCPHandler(SocketServer.BaseRequestHandler):
 
+    CHECKS_PER_TIMEOUT = 4
+
+    # Waits for more data from the robot and parses it
     def recv_more(self):
         while True:
-            r, _, _ = select.select([self.request], [], [], 0.2)
+            r, _, _ = select.select([self.request], [], [], self.check_period)
             if r:
-                more = self.request.recv(4096)
-                if not more:
-                    raise EOF("EOF on recv")
-                return more
+                self.receive()
+                return
             else:
-                now = rospy.get_rostime()
-                if self.last_joint_states and \
-                        self.last_joint_states.header.stamp < now - rospy.Duration(1.0):
-                    rospy.logerr("Stopped hearing from robot (last heard %.3f sec ago).  Disconnected" % \
-                                     (now - self.last_joint_states.header.stamp).to_sec())
-                    raise EOF()
+                self.check_alive()
+
+    # Receives what is available and handles every complete message.
+    # Raises EOF when the robot closes the connection.
+    def receive(self):
+        n = self.__parser.recv_from(self.request)
+        if not n:
+            if self.__parser.pending():
+                self.arm.metrics.incr('commander.dropped_partial')
+            raise EOF("EOF on recv")
+        self.__received_at = time.time()
+        self.arm.metrics.rate('commander.reads').add(n, self.__received_at)
+        if self.arm.capture_log:
+            self.arm.capture_log.record(STREAM_COMMANDER, self.__parser.last_received())
+        self.__parser.parse()
+        self.check_alive()
+
+    # Raises EOF if the robot stopped sending joint states
+    def check_alive(self):
+        now = time.time()
+        if self.liveness.expired(now):
+            rospy.logerr("Stopped hearing from robot (last state %.3f sec old).  Disconnected" % \
+                             self.liveness.age(now))
+            raise EOF("Stopped hearing from robot")
 
     def handle(self):
+        self.start_session()
+        try:
+            while True:
+                self.recv_more()
+        except (EOF, socket.error), ex:
+            print "Connection closed (command):", ex
+            self.arm.set_disconnected(self, str(ex))
+
+    # The arm is connected to this driverProg once its first joint state
+    # has been received
+    def start_session(self):
+        self.arm = self.server.arm
         self.socket_lock = threading.Lock()
+        self.__received_at = time.time()
+        self.__streaming = False
+        self.liveness = Liveness(self.arm.liveness_timeout)
+        self.check_period = self.arm.liveness_timeout / self.CHECKS_PER_TIMEOUT
         self.last_joint_states = None
-        setConnectedRobot(self)
+        self.last_state_seq = None
+        self.last_state_loop = None
+        self.states_dropped = 0
+        self.__parser = MessageParser(ROBOT_MESSAGES, {
+            MSG_OUT: self.__on_out,
+            MSG_JOINT_STATES: self.__on_joint_states,
+            MSG_JOINT_STATES_V2: self.__on_joint_states_v2,
+            MSG_QUIT: self.__on_quit,
+            MSG_WAYPOINT_FINISHED: self.__on_waypoint_finished,
+        })
         print "Handling a request"
-        try:
-            buf = self.recv_more()
-            if not buf: return
 
-            while True:
-                #print "Buf:", [ord(b) for b in buf]
-
-                # Unpacks the message type
-                mtype = struct.unpack_from("!i", buf, 0)[0]
-                buf = buf[4:]
-                #print "Message type:", mtype
-
-                if mtype == MSG_OUT:
-                    # Unpacks string message, terminated by tilde
-                    i = buf.find("~")
-                    while i < 0:
-                        buf = buf + self.recv_more()
-                        i = buf.find("~")
-                        if len(buf) > 2000:
-                            raise Exception("Probably forgot to terminate a string: %s..." % buf[:150])
-                    s, buf = buf[:i], buf[i+1:]
-                    log("Out: %s" % s)
-
-                elif mtype == MSG_JOINT_STATES:
-                    while len(buf) < 3*(6*4):
-                        buf = buf + self.recv_more()
-                    state_mult = struct.unpack_from("!%ii" % (3*6), buf, 0)
-                    buf = buf[3*6*4:]
-                    state = [s / MULT_jointstate for s in state_mult]
-
-                    msg = JointState()
-                    msg.header.stamp = rospy.get_rostime()
-                    msg.name = joint_names
-                    msg.position = [0.0] * 6
-                    for i, q_meas in enumerate(state[:6]):
-                        msg.position[i] = q_meas + joint_offsets.get(joint_names[i], 0.0)
-                    msg.velocity = state[6:12]
-                    msg.effort = state[12:18]
-                    self.last_joint_states = msg
-                    pub_joint_states.publish(msg)
-                elif mtype == MSG_QUIT:
-                    print "Quitting"
-                    raise EOF("Received quit")
-                elif mtype == MSG_WAYPOINT_FINISHED:
-                    while len(buf) < 4:
-                        buf = buf + self.recv_more()
-                    waypoint_id = struct.unpack_from("!i", buf, 0)[0]
-                    buf = buf[4:]
-                    print "Waypoint finished (not handled)"
-                else:
-                    raise Exception("Unknown message type: %i" % mtype)
-
-                if not buf:
-                    buf = buf + self.recv_more()
-        except EOF, ex:
-            print "Connection closed (command):", ex
-            setConnectedRobot(None)
+    def __on_out(self, s):
+        log("Out: %s" % s)
+
+    def __on_joint_states(self, state_mult):
+        self.last_joint_states = JointStateSnapshot(self.arm.joint_state_publisher.publish(
+            state_mult[:6], state_mult[6:12], state_mult[12:18], 1.0 / self.arm.mult_jointstate))
+        self.liveness.heard(self.__received_at)
+        self.__state_published()
+
+    def __on_joint_states_v2(self, record):
+        seq, loops, mult = record[:3]
+        self.last_state_seq = seq
+        self.last_state_loop = loops
+        missed = self.liveness.heard(self.__received_at, seq)
+        if missed:
+            self.states_dropped += missed
+            self.arm.metrics.incr('commander.states_dropped', missed)
+        self.last_joint_states = JointStateSnapshot(self.arm.joint_state_publisher.publish(
+            record[3:9], record[9:15], record[15:21], 1.0 / mult))
+        self.__state_published()
+
+    # Times a joint state from its arrival to its publication, and against
+    # the servo setpoints that were sent
+    def __state_published(self):
+        now = time.time()
+        metrics = self.arm.metrics
+        metrics.rate('commander.states').add(0, now)
+        metrics.histogram('commander.publish').add(now - self.__received_at)
+        echo = self.arm.echo.observed(self.last_joint_states.position, self.__received_at)
+        if echo is not None:
+            metrics.histogram('servo.echo').add(echo)
+        if not self.__streaming:
+            self.__streaming = True
+            self.arm.set_connected(self)
+
+    def __on_quit(self, params):
+        print "Quitting"
+        raise EOF("Received quit")
+
+    def __on_waypoint_finished(self, params):
+        waypoint_id = params[0]
+        print "Waypoint finished (not handled)"
 
     def send_quit(self):
         with self.socket_lock:
@@ -325,16 +404,26 @@ class CommanderTCPHandler(SocketServer.BaseRequestHandler):
             
     def send_servoj(self, waypoint_id, q_actual, t):
         assert(len(q_actual) == 6)
-        q_robot = [0.0] * 6
-        for i, q in enumerate(q_actual):
-            q_robot[i] = q - joint_offsets.get(joint_names[i], 0.0)
-        params = [MSG_SERVOJ, waypoint_id] + \
-                 [MULT_jointstate * qq for qq in q_robot] + \
-                 [MULT_time * t]
-        buf = struct.pack("!%ii" % len(params), *params)
+        buf = pack_servoj(waypoint_id, np.asarray(q_actual) - self.arm.joint_offset_vector, t,
+                          self.arm.mult_jointstate)
         with self.socket_lock:
             self.request.send(buf)
-        
+        self.arm.echo.sent(q_actual)
+
+    # Sends a horizon of setpoints (one row of q_actual each), which the
+    # robot buffers and servos through in order, reaching each one t
+    # after the previous one.  Replaces any setpoints still buffered.
+    def send_servoj_batch(self, waypoint_id, q_actual, t):
+        q_actual = np.asarray(q_actual)[:SERVO_BUFFER_SIZE]
+        assert(q_actual.shape[1] == 6)
+        buf = pack_servoj_batch(waypoint_id, q_actual - self.arm.joint_offset_vector, t,
+                                self.arm.mult_jointstate)
+        with self.socket_lock:
+            self.request.sendall(buf)
+        now = time.time()
+        for i, q in enumerate(q_actual):
+            self.arm.echo.sent(q, now + i * t)
+
 
     def send_stopj(self):
         with self.socket_lock:
@@ -343,15 +432,68 @@ class CommanderTCPHandler(SocketServer.BaseRequestHandler):
     def set_waypoint_finished_cb(self, cb):
         self.waypoint_finished_cb = cb
 
-    # Returns the last JointState message sent out
+    # Returns a JointStateSnapshot of the last joint state published,
+    # which later states leave as it is
     def get_joint_states(self):
         return self.last_joint_states
     
 
+# A CommanderTCPHandler that is driven by a Reactor instead of running
+# on a thread of its own
+class AsyncCommanderHandler(CommanderTCPHandler):
+    def __init__(self, request, client_address, server, reactor):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.reactor = reactor
+        self.start_session()
+        reactor.add_reader(request, self.__on_readable)
+        self.__watchdog = reactor.periodic(self.check_period, self.__on_timer)
+        self.__watchdog.start()
+
+    def __on_readable(self):
+        self.__closing_on_error(self.receive)
+
+    def __on_timer(self):
+        self.__closing_on_error(self.check_alive)
+
+    def __closing_on_error(self, f):
+        try:
+            f()
+        except (EOF, socket.error), ex:
+            print "Connection closed (command):", ex
+            self.close(str(ex))
+
+    def close(self, reason="Closed by the driver"):
+        self.reactor.remove_reader(self.request)
+        self.__watchdog.stop()
+        self.request.close()
+        self.arm.set_disconnected(self, reason)
+
+# Accepts the connections of arm's driverProg on a Reactor
+class CommanderServer(object):
+    def __init__(self, server_address, arm, reactor):
+        self.arm = arm
+        self.reactor = reactor
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(5)
+        reactor.add_reader(self.socket, self.__on_accept)
+
+    def __on_accept(self):
+        request, client_address = self.socket.accept()
+        AsyncCommanderHandler(request, client_address, self, self.reactor)
+
+# Handles the connections of arm's driverProg, with a thread per connection
 class TCPServer(SocketServer.TCPServer):
     allow_reuse_address = True  # Allows the program to restart gracefully on crash
     timeout = 5
 
+    def __init__(self, server_address, RequestHandlerClass, arm):
+        SocketServer.TCPServer.__init__(self, server_address, RequestHandlerClass)
+        self.arm = arm
+
 
 # Waits until all threads have completed.  Allows KeyboardInterrupt to occur
 def joinAll(threads):
@@ -366,77 +508,6 @@ def get_segment_duration(traj, index):
         return traj.points[0].time_from_start.to_sec()
     return (traj.points[index].time_from_start - traj.points[index-1].time_from_start).to_sec()
 
-# Reorders the JointTrajectory traj according to the order in
-# joint_names.  Destructive.
-def reorder_traj_joints(traj, joint_names):
-    order = [traj.joint_names.index(j) for j in joint_names]
-
-    new_points = []
-    for p in traj.points:
-        new_points.append(JointTrajectoryPoint(
-            positions = [p.positions[i] for i in order],
-            velocities = [p.velocities[i] for i in order] if p.velocities else [],
-            accelerations = [p.accelerations[i] for i in order] if p.accelerations else [],
-            time_from_start = p.time_from_start))
-    traj.joint_names = joint_names
-    traj.points = new_points
-
-def interp_cubic(p0, p1, t_abs):
-    T = (p1.time_from_start - p0.time_from_start).to_sec()
-    t = t_abs - p0.time_from_start.to_sec()
-    q = [0] * 6
-    qdot = [0] * 6
-    qddot = [0] * 6
-    for i in range(len(p0.positions)):
-        a = p0.positions[i]
-        b = p0.velocities[i]
-        c = (-3*p0.positions[i] + 3*p1.positions[i] - 2*T*p0.velocities[i] - T*p1.velocities[i]) / T**2
-        d = (2*p0.positions[i] - 2*p1.positions[i] + T*p0.velocities[i] + T*p1.velocities[i]) / T**3
-
-        q[i] = a + b*t + c*t**2 + d*t**3
-        qdot[i] = b + 2*c*t + 3*d*t**2
-        qddot[i] = 2*c + 6*d*t
-    return JointTrajectoryPoint(positions=q, velocities=qdot, accelerations=qddot, time_from_start=rospy.Duration(t_abs))
-
-# Returns (q, qdot, qddot) for sampling the JointTrajectory at time t.
-# The time t is the time since the trajectory was started.
-def sample_traj(traj, t):
-    # First point
-    if t <= 0.0:
-        return copy.deepcopy(traj.points[0])
-    # Last point
-    if t >= traj.points[-1].time_from_start.to_sec():
-        return copy.deepcopy(traj.points[-1])
-    
-    # Finds the (middle) segment containing t
-    i = 0
-    while traj.points[i+1].time_from_start.to_sec() < t:
-        i += 1
-    return interp_cubic(traj.points[i], traj.points[i+1], t)
-
-def traj_is_finite(traj):
-    for pt in traj.points:
-        for p in pt.positions:
-            if math.isinf(p) or math.isnan(p):
-                return False
-        for v in pt.velocities:
-            if math.isinf(v) or math.isnan(v):
-                return False
-    return True
-        
-def has_limited_velocities(traj):
-    for p in traj.points:
-        for v in p.velocities:
-            if math.fabs(v) > max_velocity:
-                return False
-    return True
-
-def has_velocities(traj):
-    for p in traj.points:
-        if len(p.velocities) != len(p.positions):
-            return False
-    return True
-
 def within_tolerance(a_vec, b_vec, tol_vec):
     for a, b, tol in zip(a_vec, b_vec, tol_vec):
         if abs(a - b) > tol:
@@ -444,26 +515,66 @@ def within_tolerance(a_vec, b_vec, tol_vec):
     return True
 
 class UR5TrajectoryFollower(object):
-    RATE = 0.02
-    def __init__(self, robot, goal_time_tolerance=None):
+    CONTROLLER_RATE = 125.0
+    # Feedback on the current goal is published this often (in seconds)
+    FEEDBACK_PERIOD = 0.1
+    # With a reactor, the servo loop runs on its event loop, and the
+    # action server's callbacks are handed over to it.  Goals are checked
+    # and compiled on actionlib's thread first, so that only splicing
+    # them onto the current setpoint (which takes the same time however
+    # long they are) holds up the servo loop.
+    def __init__(self, arm, robot, goal_time_tolerance=None, rate=50.0, lookahead_cycles=4,
+                 batch_size=1, reactor=None):
+        self.arm = arm
+        # The servo rate can't usefully exceed the controller's rate.  The
+        # robot is given lookahead_cycles servo periods to reach each
+        # setpoint.
+        self.rate = min(rate, self.CONTROLLER_RATE)
+        self.period = 1.0 / self.rate
+        self.lookahead = lookahead_cycles * self.period
+
+        # With batch_size > 1, the next batch_size setpoints (one servo
+        # period apart) are sent together and buffered by the robot.  A
+        # new batch is sent every batch_size/2 cycles.
+        self.batch_size = min(batch_size, SERVO_BUFFER_SIZE)
+        self.batch_interval = max(self.batch_size // 2, 1)
+        self.cycles_since_batch = self.batch_interval
         self.goal_time_tolerance = goal_time_tolerance or rospy.Duration(0.0)
         self.joint_goal_tolerances = [0.05, 0.05, 0.05, 0.05, 0.05, 0.05]
         self.following_lock = threading.Lock()
         self.T0 = time.time()
         self.robot = robot
-        self.server = actionlib.ActionServer("follow_joint_trajectory",
+        self.reactor = reactor
+        on_cancel = self.on_cancel
+        if reactor:
+            on_cancel = lambda goal_handle: reactor.call_soon_threadsafe(self.on_cancel, goal_handle)
+        self.server = actionlib.ActionServer(arm.namespace + "follow_joint_trajectory",
                                              FollowJointTrajectoryAction,
-                                             self.on_goal, self.on_cancel, auto_start=False)
+                                             self.on_goal, on_cancel, auto_start=False)
+
+        # Cartesian goals are solved for the joints (see kinematics.py),
+        # and then replace the current goal like joint goals do
+        self.cartesian_server = None
+        if FollowCartesianTrajectoryAction and Kinematics:
+            self.cartesian_server = actionlib.ActionServer(
+                arm.namespace + "follow_cartesian_trajectory", FollowCartesianTrajectoryAction,
+                self.on_cartesian_goal, on_cancel, auto_start=False)
 
         self.goal_handle = None
+        self.goal_points = 0
         self.traj = None
         self.traj_t0 = 0.0
         self.first_waypoint_id = 10
-        self.tracking_i = 0
         self.pending_i = 0
+        self.goal_feedback = False
+        self.next_feedback = 0.0
         self.last_point_sent = True
 
-        self.update_timer = rospy.Timer(rospy.Duration(self.RATE), self._update)
+        if reactor:
+            self.update_thread = reactor.periodic(self.period, self._update)
+        else:
+            self.update_thread = PeriodicThread(self.period, self._update, name="ServoScheduler")
+        arm.metrics.add_source('servo.scheduler', self.update_thread.stats.as_dict)
 
     def set_robot(self, robot):
         # Cancels any goals in progress
@@ -485,17 +596,15 @@ class UR5TrajectoryFollower(object):
             time.sleep(0.1)
             state = self.robot.get_joint_states()
         self.traj_t0 = time.time()
-        self.traj = JointTrajectory()
-        self.traj.joint_names = joint_names
-        self.traj.points = [JointTrajectoryPoint(
-            positions = state.position,
-            velocities = [0] * 6,
-            accelerations = [0] * 6,
-            time_from_start = rospy.Duration(0.0))]
+        self.traj = SetpointTable(CompiledTrajectory([0.0], [state.position], [[0.0] * 6]),
+                                  self.period)
 
     def start(self):
         self.init_traj_from_robot()
+        self.update_thread.start()
         self.server.start()
+        if self.cartesian_server:
+            self.cartesian_server.start()
         print "The action server for this driver has been started"
 
     def on_goal(self, goal_handle):
@@ -507,51 +616,85 @@ class UR5TrajectoryFollower(object):
             goal_handle.set_rejected()
             return
 
-        # Checks if the joints are just incorrect
-        if set(goal_handle.get_goal().trajectory.joint_names) != set(joint_names):
-            rospy.logerr("Received a goal with incorrect joint names: (%s)" % \
-                         ', '.join(goal_handle.get_goal().trajectory.joint_names))
-            goal_handle.set_rejected()
+        # Checks the trajectory, and converts it to arrays with the
+        # joints ordered according to joint_names.  With time scaling,
+        # goals that are too fast are slowed down instead of rejected.
+        max_velocity = np.inf if self.arm.time_scaling else self.arm.max_velocity
+        try:
+            times, positions, velocities, accelerations = validate_trajectory(
+                goal_handle.get_goal().trajectory, self.arm.joint_names, max_velocity,
+                self.arm.joint_limits)
+        except InvalidTrajectory, ex:
+            rospy.logerr(str(ex))
+            goal_handle.set_rejected(text=str(ex))
             return
 
-        if not traj_is_finite(goal_handle.get_goal().trajectory):
-            rospy.logerr("Received a goal with infinites or NaNs")
-            goal_handle.set_rejected(text="Received a goal with infinites or NaNs")
+        self.accept_goal(goal_handle, CompiledTrajectory(times, positions, velocities,
+                                                         accelerations))
+
+    def on_cartesian_goal(self, goal_handle):
+        log("on_cartesian_goal")
+
+        # Checks that the robot is connected and its kinematics are known
+        if not self.robot:
+            rospy.logerr("Received a goal, but the robot is not connected")
+            goal_handle.set_rejected()
             return
-        
-        # Checks that the trajectory has velocities
-        if not has_velocities(goal_handle.get_goal().trajectory):
-            rospy.logerr("Received a goal without velocities")
-            goal_handle.set_rejected(text="Received a goal without velocities")
+        kin = self.arm.get_kinematics()
+        if kin is None:
+            rospy.logerr("Received a Cartesian goal, but the arm's kinematics are unknown")
+            goal_handle.set_rejected(text="The arm's kinematics are unknown")
             return
 
-        # Checks that the velocities are withing the specified limits
-        if not has_limited_velocities(goal_handle.get_goal().trajectory):
-            message = "Received a goal with velocities that are higher than %f" % max_velocity
-            rospy.logerr(message)
-            goal_handle.set_rejected(text=message)
+        # Solves the path from the current setpoint
+        goal = goal_handle.get_goal()
+        try:
+            with self.following_lock:
+                q_start = self.traj.sample(time.time() - self.traj_t0)[0]
+            times, positions, quaternions = path_arrays(goal.poses, goal.time_from_start)
+            times, positions, velocities = solve_path(kin, times, positions, quaternions, q_start,
+                                                      self.period, self.arm.max_velocity,
+                                                      self.arm.joint_limits)
+        except InvalidTrajectory, ex:
+            rospy.logerr(str(ex))
+            goal_handle.set_rejected(text=str(ex))
             return
 
-        # Orders the joints of the trajectory according to joint_names
-        reorder_traj_joints(goal_handle.get_goal().trajectory, joint_names)
-                
+        self.accept_goal(goal_handle, CompiledTrajectory(times, positions, velocities),
+                         feedback=False)
+
+    # Hands a goal's compiled trajectory over to replace_goal, on the event
+    # loop if there is one.  Feedback (see publish_feedback) is only
+    # published for goals whose action has it.
+    def accept_goal(self, goal_handle, traj, feedback=True):
+        if self.arm.time_scaling:
+            traj.peak_rates()  # Computed once, before splicing
+        if self.reactor:
+            self.reactor.call_soon_threadsafe(self.replace_goal, goal_handle, traj, feedback)
+        else:
+            self.replace_goal(goal_handle, traj, feedback)
+
+    # Cancels the current goal (if any), and follows the trajectory of
+    # goal_handle from the current setpoint
+    def replace_goal(self, goal_handle, traj, feedback=True):
         with self.following_lock:
             if self.goal_handle:
                 # Cancels the existing goal
                 self.goal_handle.set_canceled()
-                self.first_waypoint_id += len(self.goal_handle.get_goal().trajectory.points)
+                self.first_waypoint_id += self.goal_points
                 self.goal_handle = None
 
-            # Inserts the current setpoint at the head of the trajectory
+            # Splices the trajectory onto the current setpoint
             now = time.time()
-            point0 = sample_traj(self.traj, now)
-            point0.time_from_start = rospy.Duration(0.0)
-            goal_handle.get_goal().trajectory.points.insert(0, point0)
+            q0, qd0, qdd0 = self.traj.sample(now - self.traj_t0)
             self.traj_t0 = now
+            self.cycles_since_batch = self.batch_interval
 
             # Replaces the goal
             self.goal_handle = goal_handle
-            self.traj = goal_handle.get_goal().trajectory
+            self.goal_points = len(traj)
+            self.goal_feedback = feedback
+            self.traj = self.make_table(traj, q0, qd0, qdd0)
             self.goal_handle.set_accepted()
 
     def on_cancel(self, goal_handle):
@@ -561,72 +704,119 @@ class UR5TrajectoryFollower(object):
                 # Uses the next little bit of trajectory to slow to a stop
                 STOP_DURATION = 0.5
                 now = time.time()
-                point0 = sample_traj(self.traj, now - self.traj_t0)
-                point0.time_from_start = rospy.Duration(0.0)
-                point1 = sample_traj(self.traj, now - self.traj_t0 + STOP_DURATION)
-                point1.velocities = [0] * 6
-                point1.accelerations = [0] * 6
-                point1.time_from_start = rospy.Duration(STOP_DURATION)
+                q0, qd0, qdd0 = self.traj.sample(now - self.traj_t0)
+                q1 = self.traj.sample(now - self.traj_t0 + STOP_DURATION)[0]
                 self.traj_t0 = now
-                self.traj = JointTrajectory()
-                self.traj.joint_names = joint_names
-                self.traj.points = [point0, point1]
+                self.cycles_since_batch = self.batch_interval
+                self.traj = SetpointTable(CompiledTrajectory([0.0, STOP_DURATION], [q0, q1],
+                                                             [qd0, np.zeros(6)],
+                                                             [qdd0, np.zeros(6)]),
+                                          self.period)
                 
                 self.goal_handle.set_canceled()
                 self.goal_handle = None
         else:
             goal_handle.set_canceled()
 
+    # Tabulates the setpoints of a goal's trajectory spliced onto the
+    # setpoint (q0, qd0, qdd0) (see splice_table), slowed down to the
+    # arm's limits with time scaling
+    def make_table(self, traj, q0, qd0, qdd0):
+        if self.arm.time_scaling:
+            return splice_table(traj, q0, qd0, qdd0, self.period, self.arm.max_velocity,
+                                self.arm.max_acceleration)
+        return splice_table(traj, q0, qd0, qdd0, self.period)
+
+    # Sends the setpoint(s) for time t along the trajectory
+    def send_setpoints(self, t, force=False):
+        if self.batch_size <= 1:
+            self.robot.send_servoj(999, self.traj.sample(t)[0], self.lookahead)
+            return
+        self.cycles_since_batch += 1
+        if self.cycles_since_batch >= self.batch_interval or force:
+            self.robot.send_servoj_batch(999, self.traj.sample_ahead(t, self.batch_size)[0],
+                                         self.period)
+            self.cycles_since_batch = 0
+
+    # Publishes how the robot follows the current goal: the setpoint of
+    # its table for now, the robot's latest joint state and their
+    # difference.  The setpoint's time_from_start, along the table (and
+    # so in wall-clock time, with time scaling), is the goal's progress.
+    def publish_feedback(self, now):
+        state = self.robot.get_joint_states()
+        if not state:
+            return
+        self.next_feedback = now + self.FEEDBACK_PERIOD
+        t = min(max(now - self.traj_t0, 0.0), self.traj.duration)
+        q, qd, qdd = self.traj.sample(t)
+        position, velocity = np.asarray(state.position), np.asarray(state.velocity)
+
+        feedback = FollowJointTrajectoryFeedback()
+        feedback.header.stamp = rospy.Time.from_sec(now)
+        feedback.joint_names = self.arm.joint_names
+        for point, positions, velocities in [(feedback.desired, q, qd),
+                                             (feedback.actual, position, velocity),
+                                             (feedback.error, position - q, velocity - qd)]:
+            point.positions = positions.tolist()
+            point.velocities = velocities.tolist()
+            point.time_from_start = rospy.Duration(t)
+        feedback.desired.accelerations = qdd.tolist()
+        self.goal_handle.publish_feedback(feedback)
+
     last_now = time.time()
-    def _update(self, event):
+    def _update(self):
+        # Goals replace (and sample) the setpoint table on other threads
+        with self.following_lock:
+            self.__update()
+
+    def __update(self):
         if self.robot and self.traj:
             now = time.time()
-            if (now - self.traj_t0) <= self.traj.points[-1].time_from_start.to_sec():
+            if self.goal_handle and self.goal_feedback and now >= self.next_feedback:
+                self.publish_feedback(now)
+            if (now - self.traj_t0) <= self.traj.duration:
                 self.last_point_sent = False #sending intermediate points
-                setpoint = sample_traj(self.traj, now - self.traj_t0)
                 try:
-                    self.robot.send_servoj(999, setpoint.positions, 4 * self.RATE)
+                    self.send_setpoints(now - self.traj_t0)
+                    self.arm.metrics.histogram('servo.sample_to_write').add(time.time() - now)
                 except socket.error:
                     pass
-                    
+                
             elif not self.last_point_sent:
                 # All intermediate points sent, sending last point to make sure we
                 # reach the goal.
                 # This should solve an issue where the robot does not reach the final
                 # position and errors out due to not reaching the goal point.
-                last_point = self.traj.points[-1]
+                last_point = self.traj.final_position
                 state = self.robot.get_joint_states()
-                position_in_tol = within_tolerance(state.position, last_point.positions, self.joint_goal_tolerances)
+                position_in_tol = within_tolerance(state.position, last_point, self.joint_goal_tolerances)
                 # Performing this check to try and catch our error condition.  We will always
                 # send the last point just in case.
                 if not position_in_tol:
                     rospy.logwarn("Trajectory time exceeded and current robot state not at goal, last point required")
                     rospy.logwarn("Current trajectory time: %s, last point time: %s" % \
-                                (now - self.traj_t0, self.traj.points[-1].time_from_start.to_sec()))
+                                (now - self.traj_t0, self.traj.duration))
                     rospy.logwarn("Desired: %s\nactual: %s\nvelocity: %s" % \
-                                          (last_point.positions, state.position, state.velocity))
-                setpoint = sample_traj(self.traj, self.traj.points[-1].time_from_start.to_sec())
-
+                                          (last_point, state.position, state.velocity))
                 try:
-                    self.robot.send_servoj(999, setpoint.positions, 4 * self.RATE)
+                    self.send_setpoints(self.traj.duration, force=True)
                     self.last_point_sent = True
                 except socket.error:
                     pass
-                    
+                
             else:  # Off the end
                 if self.goal_handle:
-                    last_point = self.traj.points[-1]
                     state = self.robot.get_joint_states()
-                    position_in_tol = within_tolerance(state.position, last_point.positions, [0.1]*6)
-                    velocity_in_tol = within_tolerance(state.velocity, last_point.velocities, [0.05]*6)
+                    position_in_tol = within_tolerance(state.position, self.traj.final_position, [0.1]*6)
+                    velocity_in_tol = within_tolerance(state.velocity, self.traj.final_velocity, [0.05]*6)
                     if position_in_tol and velocity_in_tol:
                         # The arm reached the goal (and isn't moving).  Succeeding
                         self.goal_handle.set_succeeded()
                         self.goal_handle = None
-                    #elif now - (self.traj_t0 + last_point.time_from_start.to_sec()) > self.goal_time_tolerance.to_sec():
+                    #elif now - (self.traj_t0 + self.traj.duration) > self.goal_time_tolerance.to_sec():
                     #    # Took too long to reach the goal.  Aborting
                     #    rospy.logwarn("Took too long to reach the goal.\nDesired: %s\nactual: %s\nvelocity: %s" % \
-                    #                      (last_point.positions, state.position, state.velocity))
+                    #                      (self.traj.positions[-1], state.position, state.velocity))
                     #    self.goal_handle.set_aborted(text="Took too long to reach the goal")
                     #    self.goal_handle = None
 
@@ -647,93 +837,521 @@ def load_joint_offsets(joint_names):
             rospy.logwarn("No calibration offset for joint \"%s\"" % joint)
     return result
 
+# prefix: prefix of the arm's joint names
+#
+# returns: the arm's kinematic parameters in the URDF (see
+# kinematics.py), or None
+def load_dh_params(prefix):
+    try:
+        return dh_from_urdf(rospy.get_param("robot_description"), prefix)
+    except Exception, ex:
+        rospy.logwarn("No kinematic parameters in the URDF: %s" % ex)
+        return None
+
+# joint_names: list of joints
+#
+# returns: (lower, upper) position limits, as vectors in joint_names
+# order.  Joints without limits in the URDF are unbounded.
+def load_joint_limits(joint_names):
+    robot_description = rospy.get_param("robot_description")
+    soup = BeautifulSoup(robot_description)
+
+    lower = np.repeat(-np.inf, len(joint_names))
+    upper = np.repeat(np.inf, len(joint_names))
+    for i, joint in enumerate(joint_names):
+        try:
+            limit_elt = soup.find('joint', attrs={'name': joint}).limit
+            lower[i] = float(limit_elt["lower"])
+            upper[i] = float(limit_elt["upper"])
+        except Exception, ex:
+            rospy.logwarn("No position limits for joint \"%s\"" % joint)
+    return lower, upper
+
 def get_my_ip(robot_ip, port):
     s = socket.create_connection((robot_ip, port))
     tmp = s.getsockname()[0]
     s.close()
     return tmp
 
+# Everything the driver knows about one robot: where it is, its
+# configuration (joint names, calibration, limits, protocol) and the
+# commander connection of the driverProg running on it.  A driver
+# process serves one or more arms.
+class Arm(object):
+    def __init__(self, hostname, port=PORT, reverse_port=REVERSE_PORT, prefix="",
+                 namespace="", max_velocity=2.0, protocol_version=PROTOCOL_VERSION,
+                 mult_jointstate=MULT_jointstate_v2, capture_log=None, time_scaling=False,
+                 max_acceleration=None, liveness_timeout=0.1, primary_timeout=1.0,
+                 reconnect_delay=(1.0, 10.0)):
+        self.hostname = hostname
+        self.port = port
+        self.reverse_port = reverse_port
+        self.prefix = prefix
+        self.namespace = namespace
+        self.max_velocity = max_velocity
+        # With time_scaling, goals are slowed down to max_velocity (and
+        # max_acceleration, if set) rather than rejected
+        self.time_scaling = time_scaling
+        self.max_acceleration = max_acceleration
+        self.joint_names = [prefix + name for name in JOINT_NAMES]
+
+        # driverProg's connection is dropped when its joint states stop
+        # arriving for liveness_timeout, and the primary interface's
+        # when it is silent for primary_timeout.  Lost connections are
+        # retried with delays from reconnect_delay = (initial, maximum)
+        # (see supervision.py).
+        self.liveness_timeout = liveness_timeout
+        self.primary_timeout = primary_timeout
+        self.backoff = Backoff(*reconnect_delay)
+
+        # Reverse-port protocol version spoken with driverProg, and the
+        # multiplier for joint values sent in either direction (see
+        # protocol.py)
+        self.protocol_version = protocol_version
+        self.mult_jointstate = mult_jointstate
+
+        # When set, the streams received from the robot are recorded (see
+        # capture.py)
+        self.capture_log = capture_log
+
+        # Joint offsets, pulled from calibration information stored in the URDF
+        #
+        # { "joint_name" : offset }
+        #
+        # q_actual = q_from_driver + offset
+        self.joint_offsets = load_joint_offsets(self.joint_names)
+        rospy.logerr("Loaded calibration offsets: %s" % self.joint_offsets)
+        # The same offsets as a vector, in joint_names order
+        self.joint_offset_vector = np.array([self.joint_offsets.get(name, 0.0)
+                                             for name in self.joint_names])
+        # Reads the joint position limits from the URDF
+        self.joint_limits = load_joint_limits(self.joint_names)
+
+        self.joint_state_publisher = JointStatePublisher(self.joint_names,
+                                                         self.joint_offset_vector)
+
+        # Counters and latencies of the arm's pipeline (see diagnostics())
+        self.metrics = Metrics()
+        self.echo = EchoTracker()
+
+        # The arm's connection events, which are counted, and the last
+        # one kept for the diagnostics
+        self.events = EventSource()
+        self.events.subscribe(self.__on_event)
+        self.last_event = None
+        self.__lost_at = None
+
+        # The D-H parameters the controller reports (see kinematics.py),
+        # or None until they have been received, and those of the URDF
+        self.dh_params = None
+        self.urdf_dh_params = load_dh_params(prefix)
+        self.__kinematics = None
+
+        self.connection = None
+        self.__connected = None
+        self.__connected_lock = threading.Lock()
+        self.__connected_cond = threading.Condition(self.__connected_lock)
+
+    # Returns a ur_kin_py.Kinematics for the arm, with the parameters the
+    # controller reports or else those of the URDF, or None without
+    # either or without ur_kinematics
+    def get_kinematics(self):
+        params = self.dh_params or self.urdf_dh_params
+        if params is None or Kinematics is None:
+            return None
+        if self.__kinematics is None or self.__kinematics[0] != params:
+            self.__kinematics = (params, make_kinematics(params))
+        return self.__kinematics[1]
+
+    # Returns the driverProg program for this arm
+    def make_program(self):
+        with open(roslib.packages.get_pkg_dir('ur_driver') + '/prog') as fin:
+            return fin.read() % {"driver_hostname": get_my_ip(self.hostname, self.port),
+                                 "reverse_port": self.reverse_port,
+                                 "protocol_version": self.protocol_version,
+                                 "mult_jointstate": self.mult_jointstate}
+
+    # Returns the arm's counters and latency statistics (the same values
+    # that are published on /diagnostics), as a dict
+    def diagnostics(self):
+        result = self.metrics.snapshot()
+        for topic, counts in self.joint_state_publisher.topic_stats().items():
+            for k, v in counts.items():
+                result['topic.%s.%s' % (topic, k)] = v
+        result['connected'] = self.get_connected() is not None
+        if self.connection:
+            result['robot_state'] = self.connection.robot_state
+        if self.last_event:
+            event, details = self.last_event
+            result['last_event'] = event
+            if 'reason' in details:
+                result['last_event.reason'] = details['reason']
+        return result
+
+    # The types of the unknown packages the controller has sent
+    def unknown_ptypes(self):
+        return sorted(int(name[len(UNKNOWN_PACKAGES):]) for name in self.metrics.counters.keys()
+                      if name.startswith(UNKNOWN_PACKAGES))
+
+    # Returns the arm's diagnostics as a DiagnosticStatus
+    def diagnostic_status(self):
+        status = DiagnosticStatus()
+        status.name = "ur_driver: %s%s" % (self.namespace, self.hostname)
+        status.hardware_id = self.hostname
+        values = self.diagnostics()
+        unknown_ptypes = self.unknown_ptypes()
+        if not values['connected']:
+            status.level = DiagnosticStatus.WARN
+            status.message = "driverProg not connected"
+        elif unknown_ptypes:
+            status.level = DiagnosticStatus.WARN
+            status.message = "Ignoring unknown pkt type(s): %s. Please report." % \
+                ", ".join(str(ptype) for ptype in unknown_ptypes)
+        else:
+            status.level = DiagnosticStatus.OK
+            status.message = "OK"
+        status.values = [KeyValue(str(k), str(v)) for k, v in sorted(values.items())]
+        return status
+
+    # Sets the commander connection of the arm's driverProg, once it
+    # streams joint states
+    def set_connected(self, r):
+        with self.__connected_lock:
+            self.__connected = r
+            self.__connected_cond.notify()
+        self.events.emit(COMMANDER_CONNECTED)
+
+    # Forgets the commander connection r, unless it has been replaced
+    # already
+    def set_disconnected(self, r, reason):
+        with self.__connected_lock:
+            if self.__connected is not r:
+                return
+            self.__connected = None
+        self.events.emit(COMMANDER_DISCONNECTED, reason=reason)
+
+    def get_connected(self, wait=False, timeout=-1):
+        started = time.time()
+        with self.__connected_lock:
+            if wait:
+                while not self.__connected:
+                    if timeout >= 0 and time.time() > started + timeout:
+                        break
+                    self.__connected_cond.wait(0.2)
+            return self.__connected
+
+    # Counts the arm's events, and times how long driverProg takes to be
+    # back after losing it
+    def __on_event(self, event, details):
+        self.metrics.incr('events.' + event)
+        self.last_event = (event, details)
+        if event == COMMANDER_DISCONNECTED:
+            self.__lost_at = details['time']
+        elif event == COMMANDER_CONNECTED and self.__lost_at is not None:
+            self.metrics.histogram('connection.recovery').add(details['time'] - self.__lost_at)
+            self.__lost_at = None
+
+# Keeps arm connected and programmed, and its trajectory follower
+# connected to its driverProg, until ROS shuts down.  make_follower(r)
+# creates the follower once driverProg has connected (as r).
+#
+# The supervisor is a state machine: step() does whatever the arm's
+# connections need, and returns the time by which it wants to be stepped
+# again.  It is stepped on its own thread by run(), or on reactor once
+# start()ed, and right away on every connection event of the arm rather
+# than by polling.  A lost connection is retried at once, and then after
+# the delays of arm.backoff, which starts over once driverProg has stayed
+# connected for the longest of them.
+class ConnectionSupervisor(object):
+    PERIOD = 0.2
+
+    def __init__(self, arm, make_follower, reactor=None):
+        self.arm = arm
+        self.connection = arm.connection
+        self.make_follower = make_follower
+        self.reactor = reactor
+        self.backoff = arm.backoff
+        self.robot = None
+        self.follower = None
+        self.connected_at = None
+        self.retry_at = 0.0
+        self.opening = False
+        self.waiting_to_program = False
+        self.timer = None
+
+    def run(self):
+        wakeup = threading.Event()
+        self.arm.events.subscribe(lambda event, details: wakeup.set())
+        while not rospy.is_shutdown():
+            wakeup.clear()
+            wakeup.wait(max(self.step(time.time()) - time.time(), 0.0))
+
+    def start(self):
+        self.arm.events.subscribe(
+            lambda event, details: self.reactor.call_soon_threadsafe(self.__step_on_loop))
+        self.reactor.call_soon_threadsafe(self.__step_on_loop)
+
+    def __step_on_loop(self):
+        if rospy.is_shutdown():
+            self.reactor.stop()
+            return
+        if self.timer:
+            self.timer.cancel()
+        self.timer = self.reactor.call_at(self.step(time.time()), self.__step_on_loop)
+
+    def step(self, now):
+        global prevent_programming
+        prevent_programming = rospy.get_param("prevent_programming", False)
+
+        r = self.arm.get_connected()
+        if r:
+            if r is not self.robot:
+                rospy.loginfo("Robot connected")
+                self.robot = r
+                self.connected_at = now
+                self.retry_at = now
+                self.waiting_to_program = False
+                if self.follower:
+                    self.follower.set_robot(r)
+                else:
+                    self.follower = self.make_follower(r)
+                    self.follower.start()
+            if self.backoff.attempts and now - self.connected_at > self.backoff.maximum:
+                self.backoff.reset()
+        elif self.robot:
+            print "Disconnected.  Reconnecting"
+            self.robot = None
+            if self.follower:
+                self.follower.set_robot(None)
+            self.retry_at = now
+        if self.opening or now < self.retry_at:
+            return min(self.retry_at, now + self.PERIOD)
+
+        # Reconnects to the primary interface, if it was lost
+        if not self.connection.connected():
+            self.retry_at = now + self.backoff.next()
+            self.__reconnect()
+            return self.retry_at
+
+        if r:
+            if prevent_programming:
+                print "Programming now prevented"
+                self.__sending(self.connection.send_reset_program)
+            return now + self.PERIOD
+
+        if not self.connection.ready_to_program():
+            if not self.waiting_to_program:
+                print "Waiting to program"
+            self.waiting_to_program = True
+            return now + self.PERIOD
+        self.waiting_to_program = False
+        rospy.loginfo("Programming the robot")
+        if not self.__sending(self.connection.send_program):
+            return now + self.PERIOD
+        delay = self.backoff.next()
+        self.retry_at = now + delay
+        self.arm.events.emit(PROGRAM_SENT, attempt=self.backoff.attempts, retry_in=delay)
+        return self.retry_at
+
+    # Calls send() (which sends on the primary interface), and returns its
+    # result, or None after dropping the connection if sending failed
+    def __sending(self, send):
+        try:
+            return send()
+        except socket.error, ex:
+            rospy.logerr("Lost the connection to the robot at %s: %s" % (self.arm.hostname, ex))
+            self.connection.disconnect()
+            self.arm.events.emit(ROBOT_DISCONNECTED, reason=str(ex))
+            return None
+
+    # Connects to the primary interface again.  With a reactor, the
+    # connection is opened on a thread of its own, so that an unreachable
+    # robot does not hold up the event loop.
+    def __reconnect(self):
+        if not self.reactor:
+            sock = self.__open()
+            if sock:
+                self.connection.connect(sock)
+            return
+        self.opening = True
+        thread = threading.Thread(name="Reconnect", target=self.__open_for_loop)
+        thread.daemon = True
+        thread.start()
+
+    def __open(self):
+        rospy.loginfo("Connecting to the robot at %s" % self.arm.hostname)
+        try:
+            return self.connection.open()
+        except socket.error, ex:
+            rospy.logwarn("Cannot connect to the robot at %s: %s" % (self.arm.hostname, ex))
+            return None
+
+    def __open_for_loop(self):
+        sock = self.__open()
+        self.reactor.call_soon_threadsafe(self.__opened, sock)
+
+    def __opened(self, sock):
+        self.opening = False
+        if sock:
+            self.connection.connect(sock)
+
+# Runs the driver on reactor until ROS shuts down: the robot connections,
+# the command servers and the servo loops (all set up to use reactor) and
+# the supervisors of every arm all run as callbacks on this thread.
+def run_event_loop(reactor, supervisors):
+    for supervisor in supervisors:
+        supervisor.start()
+    reactor.run()
+
+# Reads the configuration of an arm.  Settings missing from config are
+# read from the ~ parameter of the same name.
+def load_arm(config, default_reverse_port, default_namespace):
+    def setting(name, default):
+        return config.get(name, rospy.get_param("~" + name, default))
+
+    prefix = config.get('prefix', rospy.get_param("~prefix", ""))
+    print "Setting prefix to %s" % prefix
+    capture_log = None
+    if config.get('record'):
+        capture_log = CaptureWriter(config['record'])
+        rospy.loginfo("Recording robot streams to %s" % config['record'])
+
+    # Version 1 is the original protocol, at a fixed 0.1 mrad
+    protocol_version = setting('protocol_version', PROTOCOL_VERSION)
+    if protocol_version >= 2:
+        mult_jointstate = float(setting('joint_precision_multiplier', MULT_jointstate_v2))
+    else:
+        mult_jointstate = MULT_jointstate
+
+    # How quickly lost connections are noticed and retried (see Arm)
+    reconnect_delay = (setting('reconnect_min_delay', 1.0), setting('reconnect_max_delay', 10.0))
+
+    return Arm(config['hostname'], config.get('port', PORT),
+               config.get('reverse_port', default_reverse_port), prefix,
+               config.get('namespace', default_namespace),
+               setting('max_velocity', 2.0), protocol_version, mult_jointstate, capture_log,
+               setting('time_scaling', False), setting('max_acceleration', 0.0) or None,
+               setting('liveness_timeout', 0.1), setting('primary_timeout', 1.0),
+               reconnect_delay)
+
 def main():
     rospy.init_node('ur_driver', disable_signals=True)
     if rospy.get_param("use_sim_time", False):
         rospy.logwarn("use_sim_time is set!!!")
     global prevent_programming
     prevent_programming = rospy.get_param("prevent_programming", False)
-    prefix = rospy.get_param("~prefix", "")
-    print "Setting prefix to %s" % prefix
-    global joint_names
-    joint_names = [prefix + name for name in JOINT_NAMES]
 
     # Parses command line arguments
-    parser = optparse.OptionParser(usage="usage: %prog robot_hostname")
+    parser = optparse.OptionParser(usage="usage: %prog [options] robot_hostname")
+    parser.add_option("-p", "--port", type="int", default=PORT,
+                      help="port of the robot's primary interface [default: %default]")
+    parser.add_option("--record", metavar="FILE",
+                      help="record the streams received from the robot to FILE")
     (options, args) = parser.parse_args(rospy.myargv()[1:])
-    if len(args) != 1:
-        parser.error("You must specify the robot hostname")
-    robot_hostname = args[0]
-
-    # Reads the calibrated joint offsets from the URDF
-    global joint_offsets
-    joint_offsets = load_joint_offsets(joint_names)
-    rospy.logerr("Loaded calibration offsets: %s" % joint_offsets)
-
-    # Reads the maximum velocity
-    global max_velocity
-    max_velocity = rospy.get_param("~max_velocity", 2.0)
-
-    # Sets up the server for the robot to connect to
-    server = TCPServer(("", 50001), CommanderTCPHandler)
-    thread_commander = threading.Thread(name="CommanderHandler", target=server.serve_forever)
-    thread_commander.daemon = True
-    thread_commander.start()
-
-    with open(roslib.packages.get_pkg_dir('ur_driver') + '/prog') as fin:
-        program = fin.read() % {"driver_hostname": get_my_ip(robot_hostname, PORT)}
-    connection = UR5Connection(robot_hostname, PORT, program)
-    connection.connect()
-    connection.send_reset_program()
-    
-    action_server = None
-    try:
-        while not rospy.is_shutdown():
-            # Checks for disconnect
-            if getConnectedRobot(wait=False):
-                time.sleep(0.2)
-                prevent_programming = rospy.get_param("prevent_programming", False)
-                if prevent_programming:
-                    print "Programming now prevented"
-                    connection.send_reset_program()
+
+    # Either one robot, given on the command line, or the list of robots
+    # in ~robots.  Each entry of ~robots is a dict with the robot's
+    # 'hostname' and optionally its 'port', 'reverse_port' (default 50001
+    # for the first robot, 50002 for the second...), 'prefix',
+    # 'namespace' of its action server (default robot0/, robot1/...),
+    # 'record' file, and any of the per-robot ~ parameters below.
+    robots = rospy.get_param("~robots", None)
+    if robots:
+        arms = [load_arm(config, REVERSE_PORT + i, "robot%d/" % i)
+                for i, config in enumerate(robots)]
+    else:
+        if len(args) != 1:
+            parser.error("You must specify the robot hostname")
+        arms = [load_arm({'hostname': args[0], 'port': options.port,
+                          'record': options.record}, REVERSE_PORT, "")]
+
+    # Sets up joint state publishing.  ~joint_state_topics maps each topic
+    # to either its maximum rate (0 for every state) or a dict with
+    # 'max_rate' and/or 'decimation'.
+    #
+    # With ~use_event_loop, the driver runs on a single event loop (see
+    # run_event_loop) and messages are handed to rospy's sending threads.
+    reactor = Reactor() if rospy.get_param("~use_event_loop", False) else None
+    queue_size = 10 if reactor else None
+    for i, arm in enumerate(arms):
+        topics = rospy.get_param("~joint_state_topics", {'joint_states': 0})
+        if robots:
+            topics = robots[i].get('joint_state_topics', topics)
+        for topic, limit in sorted(topics.items()):
+            if isinstance(limit, dict):
+                arm.joint_state_publisher.add_topic(topic, limit.get('max_rate', 0.0),
+                                                    limit.get('decimation', 1), queue_size)
             else:
-                print "Disconnected.  Reconnecting"
-                if action_server:
-                    action_server.set_robot(None)
-
-                rospy.loginfo("Programming the robot")
-                while True:
-                    # Sends the program to the robot
-                    while not connection.ready_to_program():
-                        print "Waiting to program"
-                        time.sleep(1.0)
-                    prevent_programming = rospy.get_param("prevent_programming", False)
-                    connection.send_program()
-
-                    r = getConnectedRobot(wait=True, timeout=1.0)
-                    if r:
-                        break
-                rospy.loginfo("Robot connected")
+                arm.joint_state_publisher.add_topic(topic, limit, queue_size=queue_size)
 
-                if action_server:
-                    action_server.set_robot(r)
-                else:
-                    action_server = UR5TrajectoryFollower(r, rospy.Duration(1.0))
-                    action_server.start()
+    # Reads the rate at which setpoints are streamed to the robot
+    servo_rate = rospy.get_param("~servo_rate", 50.0)
+    servo_lookahead_cycles = rospy.get_param("~servo_lookahead_cycles", 4)
+    servo_batch_size = rospy.get_param("~servo_batch_size", 1)
+
+    # Sets up the servers for the robots to connect to
+    for arm in arms:
+        if reactor:
+            CommanderServer(("", arm.reverse_port), arm, reactor)
+        else:
+            server = TCPServer(("", arm.reverse_port), CommanderTCPHandler, arm)
+            thread_commander = threading.Thread(name="CommanderHandler", target=server.serve_forever)
+            thread_commander.daemon = True
+            thread_commander.start()
+
+    for arm in arms:
+        arm.connection = UR5Connection(arm, arm.make_program(), reactor)
+        arm.connection.connect()
+        arm.connection.send_reset_program()
+
+    # Publishes the arms' diagnostics
+    pub_diagnostics = rospy.Publisher('/diagnostics', DiagnosticArray)
+    def publish_diagnostics():
+        msg = DiagnosticArray()
+        msg.header.stamp = rospy.get_rostime()
+        msg.status = [arm.diagnostic_status() for arm in arms]
+        pub_diagnostics.publish(msg)
+    diagnostics_period = 1.0 / rospy.get_param("~diagnostics_rate", 1.0)
+    if reactor:
+        reactor.periodic(diagnostics_period, publish_diagnostics).start()
+    else:
+        PeriodicThread(diagnostics_period, publish_diagnostics, name="Diagnostics").start()
+
+    # ...and right away whenever a connection changes state
+    for arm in arms:
+        arm.events.subscribe(lambda event, details: publish_diagnostics())
+
+    def make_follower(arm):
+        return lambda r: UR5TrajectoryFollower(arm, r, rospy.Duration(1.0), servo_rate,
+                                               servo_lookahead_cycles, servo_batch_size,
+                                               reactor)
+    supervisors = [ConnectionSupervisor(arm, make_follower(arm), reactor) for arm in arms]
+    try:
+        if reactor:
+            run_event_loop(reactor, supervisors)
+        elif len(arms) == 1:
+            supervisors[0].run()
+        else:
+            threads = []
+            for supervisor in supervisors:
+                thread = threading.Thread(name="Supervisor", target=supervisor.run)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            joinAll(threads)
 
     except KeyboardInterrupt:
         try:
-            r = getConnectedRobot(wait=False)
             rospy.signal_shutdown("KeyboardInterrupt")
-            if r: r.send_quit()
+            for arm in arms:
+                r = arm.get_connected(wait=False)
+                if r: r.send_quit()
         except:
             pass
         raise
+    finally:
+        for arm in arms:
+            if arm.capture_log:
+                arm.capture_log.close()
 
 if __name__ == '__main__': main()
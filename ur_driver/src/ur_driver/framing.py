@@ -0,0 +1,160 @@
+import struct
+
+# A preallocated receive buffer that data is read into with recv_into()
+# and consumed from by advancing an offset.  The only bytes that ever move
+# are those of a trailing partial message, which are shifted back to the
+# front of the buffer when the free space at the end runs low.
+class ReceiveBuffer(object):
+    def __init__(self, capacity=65536, recv_size=4096):
+        self.recv_size = recv_size
+        self._buf = bytearray(max(capacity, recv_size))
+        self._view = memoryview(self._buf)
+        self._start = 0  # First byte that has not been consumed
+        self._end = 0    # One past the last byte received
+        self.__received = 0
+
+    def reset(self):
+        self._start = 0
+        self._end = 0
+        self.__received = 0
+
+    # Number of received bytes that are not yet part of a complete message
+    def pending(self):
+        return self._end - self._start
+
+    # Receives whatever is available on sock.  Returns the number of
+    # bytes received, which is 0 when the peer closed the connection.
+    def recv_from(self, sock):
+        self._make_room(max(self.recv_size, self._missing()))
+        n = sock.recv_into(self._view[self._end:])
+        self._end += n
+        self.__received = n
+        return n
+
+    # The bytes received by the last recv_from() (e.g. for recording
+    # them), valid until the buffer is used again
+    def last_received(self):
+        return self._view[self._end - self.__received:self._end]
+
+    # Appends data that was obtained elsewhere (e.g. a recording)
+    def feed(self, data):
+        self._make_room(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+        self.__received = len(data)
+
+    # Bytes known to be missing from the message at the head of the buffer
+    def _missing(self):
+        return 0
+
+    # Forgets the consumed bytes once everything has been consumed
+    def _consumed_all(self):
+        if self._start == self._end:
+            self._start = 0
+            self._end = 0
+            self.__received = 0
+
+    # Ensures that at least n bytes can be written after the end of the
+    # buffered data, compacting (or, for oversized messages, growing) the
+    # buffer as necessary.
+    def _make_room(self, n):
+        if len(self._buf) - self._end >= n:
+            return
+        pending = self._view[self._start:self._end].tobytes()
+        if len(pending) + n > len(self._buf):
+            self._buf = bytearray(max(2 * len(self._buf), len(pending) + n))
+            self._view = memoryview(self._buf)
+        self._buf[0:len(pending)] = pending
+        self._start = 0
+        self._end = len(pending)
+
+# Frames the length-prefixed packets of the robot's primary interface
+# (port 30002).
+#
+# Complete packets are handed out as memoryviews into the receive buffer,
+# so nothing is copied on the way to RobotState.unpack.  A packet view is
+# only valid until the next call to recv_from(); copy it (view.tobytes())
+# if it has to outlive that.
+class PacketFramer(ReceiveBuffer):
+    HEADER = struct.Struct("!IB")
+
+    # Yields every complete packet currently in the buffer
+    def packets(self):
+        header_size = self.HEADER.size
+        while self._end - self._start >= header_size:
+            length = self.HEADER.unpack_from(self._buf, self._start)[0]
+            if length < header_size:
+                raise Exception("Could not frame packet: length field is %d" % length)
+            if self._end - self._start < length:
+                break
+            packet = self._view[self._start:self._start + length]
+            self._start += length
+            yield packet
+        self._consumed_all()
+
+    def _missing(self):
+        pending = self._end - self._start
+        if pending < self.HEADER.size:
+            return 0
+        length = self.HEADER.unpack_from(self._buf, self._start)[0]
+        return max(length - pending, 0)
+
+# Parses the messages driverProg sends on the reverse port: a message
+# type (int) followed by a body.  formats maps each message type to the
+# struct of its body, or to None for a string terminated by '~'.
+#
+# parse() calls handlers[type] with every complete message (the tuple
+# unpacked from the body, or the string).  A partial message stays in the
+# buffer and parsing resumes where it stopped, so the search for a '~'
+# continues after the bytes that were already scanned.
+class MessageParser(ReceiveBuffer):
+    MESSAGE_TYPE = struct.Struct("!i")
+    MAX_STRING = 2000
+
+    def __init__(self, formats, handlers, capacity=8192, recv_size=4096):
+        ReceiveBuffer.__init__(self, capacity, recv_size)
+        self.formats = formats
+        self.handlers = handlers
+        self.__mtype = None  # Type of the message being parsed
+        self.__scanned = 0   # Bytes of a string body already searched for '~'
+
+    def reset(self):
+        ReceiveBuffer.reset(self)
+        self.__mtype = None
+        self.__scanned = 0
+
+    def parse(self):
+        buf = self._buf
+        while True:
+            if self.__mtype is None:
+                if self._end - self._start < self.MESSAGE_TYPE.size:
+                    break
+                mtype = self.MESSAGE_TYPE.unpack_from(buf, self._start)[0]
+                if mtype not in self.formats:
+                    raise Exception("Unknown message type: %i" % mtype)
+                self._start += self.MESSAGE_TYPE.size
+                self.__mtype = mtype
+                self.__scanned = 0
+
+            body = self.formats[self.__mtype]
+            if body is None:
+                i = buf.find("~", self._start + self.__scanned, self._end)
+                if i < 0:
+                    self.__scanned = self._end - self._start
+                    if self.__scanned > self.MAX_STRING:
+                        raise Exception("Probably forgot to terminate a string: %s..." % \
+                                        str(buf[self._start:self._start + 150]))
+                    break
+                payload = str(buf[self._start:i])
+                self._start = i + 1
+            else:
+                if self._end - self._start < body.size:
+                    break
+                payload = body.unpack_from(buf, self._start)
+                self._start += body.size
+
+            mtype, self.__mtype = self.__mtype, None
+            handler = self.handlers.get(mtype)
+            if handler:
+                handler(payload)
+        self._consumed_all()
@@ -0,0 +1,221 @@
+import time, sys, threading
+import bisect
+import traceback
+import numpy as np
+
+# Counters and latency histograms for the driver's pipeline.
+#
+# Everything here is cheap enough to update on every packet: a histogram
+# sample is a bisect into fixed bucket bounds, a counter is an addition.
+# Statistics are rolling: each histogram and rate keeps the current and
+# the previous window, and reports over both.
+
+# Bucket bounds of the latency histograms, in seconds: 10 us to 10 s,
+# 4 buckets per decade
+LATENCY_BOUNDS = [10.0 ** (e / 4.0) for e in range(-20, 5)]
+
+class LatencyHistogram(object):
+    def __init__(self, window=10.0, bounds=LATENCY_BOUNDS):
+        self.window = window
+        self.bounds = list(bounds)
+        self.__current = [0] * (len(self.bounds) + 1)
+        self.__previous = [0] * (len(self.bounds) + 1)
+        self.__window_start = time.time()
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, latency, now=None):
+        if now is None:
+            now = time.time()
+        if now - self.__window_start > self.window:
+            self.__roll(now)
+        self.__current[bisect.bisect_left(self.bounds, latency)] += 1
+        self.count += 1
+        if latency > self.max:
+            self.max = latency
+
+    # Bucket counts over the last one to two windows
+    def counts(self):
+        return [a + b for a, b in zip(self.__current, self.__previous)]
+
+    # Upper bound of the bucket containing the p'th percentile (0 to 100,
+    # capped at the maximum), or None without samples
+    def percentile(self, p):
+        counts = self.counts()
+        total = sum(counts)
+        if not total:
+            return None
+        rank = total * p / 100.0
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count, 'max': self.max, 'p50': self.percentile(50),
+                'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+    def __roll(self, now):
+        self.__previous = self.__current
+        self.__current = [0] * (len(self.bounds) + 1)
+        self.__window_start = now
+
+# Counts events (e.g. packets) and their sizes, and reports their rates
+# over the last one to two windows.
+class RateCounter(object):
+    def __init__(self, window=10.0):
+        self.window = window
+        self.count = 0
+        self.bytes = 0
+        self.__window_start = time.time()
+        self.__current = [0, 0]
+        self.__previous = [0, 0]
+        self.__previous_length = 0.0
+
+    def add(self, size=0, now=None):
+        if now is None:
+            now = time.time()
+        if now - self.__window_start > self.window:
+            self.__previous = self.__current
+            self.__previous_length = now - self.__window_start
+            self.__current = [0, 0]
+            self.__window_start = now
+        self.count += 1
+        self.bytes += size
+        self.__current[0] += 1
+        self.__current[1] += size
+
+    # Returns (events/s, bytes/s)
+    def rates(self, now=None):
+        if now is None:
+            now = time.time()
+        elapsed = now - self.__window_start + self.__previous_length
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return ((self.__current[0] + self.__previous[0]) / elapsed,
+                (self.__current[1] + self.__previous[1]) / elapsed)
+
+    def as_dict(self):
+        per_sec, bytes_per_sec = self.rates()
+        return {'count': self.count, 'bytes': self.bytes,
+                'per_sec': per_sec, 'bytes_per_sec': bytes_per_sec}
+
+# Measures how long the robot takes to reach the servo setpoints: sent()
+# remembers each setpoint with the time it was written, and observed()
+# matches reported positions against the pending setpoints.  When the
+# robot is within tolerance of a setpoint, the time since it was sent is
+# the latency, and that setpoint and all older ones are forgotten.
+# Setpoints that repeat the previous one (a stationary arm) are ignored.
+#
+# sent() and observed() are called from different threads (the servo
+# loop and the commander), so the pending setpoints are guarded by a
+# lock.
+class EchoTracker(object):
+    def __init__(self, tolerance=1e-3, capacity=64):
+        self.tolerance = tolerance
+        self.__q = None
+        self.__t = np.zeros(capacity)
+        self.__pending = 0
+        self.__last = None
+        self.__lock = threading.Lock()
+
+    def sent(self, q, now=None):
+        if now is None:
+            now = time.time()
+        q = np.asarray(q, dtype=float)
+        if self.__last is not None and np.abs(q - self.__last).max() < self.tolerance:
+            return
+        self.__last = q.copy()
+        with self.__lock:
+            if self.__q is None:
+                self.__q = np.zeros((len(self.__t), len(q)))
+            if self.__pending == len(self.__t):
+                # Drops the oldest
+                self.__q[:-1] = self.__q[1:]
+                self.__t[:-1] = self.__t[1:]
+                self.__pending -= 1
+            self.__q[self.__pending] = q
+            self.__t[self.__pending] = now
+            self.__pending += 1
+
+    # Returns the latency of the newest setpoint that q reaches, or None
+    def observed(self, q, now=None):
+        if not self.__pending:
+            return None
+        if now is None:
+            now = time.time()
+        with self.__lock:
+            pending = self.__q[:self.__pending]
+            reached = np.flatnonzero(np.abs(pending - q).max(axis=1) < self.tolerance)
+            if not len(reached):
+                return None
+            i = reached[-1]
+            latency = now - self.__t[i]
+            remaining = self.__pending - i - 1
+            self.__q[:remaining] = self.__q[i + 1:self.__pending]
+            self.__t[:remaining] = self.__t[i + 1:self.__pending]
+            self.__pending = remaining
+        return latency
+
+# The named counters, rates and histograms of one robot.  snapshot() is
+# the query API: a dict of plain values, which is also what the
+# diagnostics topic publishes.
+class Metrics(object):
+    def __init__(self, window=10.0):
+        self.window = window
+        self.counters = {}
+        self.rates = {}
+        self.histograms = {}
+        self.sources = {}
+        self.__lock = threading.Lock()
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def rate(self, name):
+        r = self.rates.get(name)
+        if r is None:
+            with self.__lock:
+                r = self.rates.setdefault(name, RateCounter(self.window))
+        return r
+
+    def histogram(self, name):
+        h = self.histograms.get(name)
+        if h is None:
+            with self.__lock:
+                h = self.histograms.setdefault(name, LatencyHistogram(self.window))
+        return h
+
+    # Adds a callable that returns a dict of values to include in
+    # snapshots under name (e.g. the servo scheduler's statistics)
+    def add_source(self, name, source):
+        self.sources[name] = source
+
+    def snapshot(self):
+        result = {}
+        for name, n in self.counters.items():
+            result[name] = n
+        for name, r in self.rates.items():
+            for k, v in r.as_dict().items():
+                result['%s.%s' % (name, k)] = v
+        for name, h in self.histograms.items():
+            for k, v in h.as_dict().items():
+                result['%s.%s' % (name, k)] = v
+        for name, source in self.sources.items():
+            for k, v in source().items():
+                result['%s.%s' % (name, k)] = v
+        return result
+
+# Returns the current stack of every thread, as text
+def thread_stacks():
+    id2name = dict([(th.ident, th.name) for th in threading.enumerate()])
+    code = []
+    for threadId, stack in sys._current_frames().items():
+        code.append("\n# Thread: %s(%d)" % (id2name.get(threadId,""), threadId))
+        for filename, lineno, name, line in traceback.extract_stack(stack):
+            code.append('File: "%s", line %d, in %s' % (filename, lineno, name))
+            if line:
+                code.append("  %s" % (line.strip()))
+    return "\n".join(code)
@@ -0,0 +1,168 @@
+from BeautifulSoup import BeautifulSoup
+import numpy as np
+
+from trajectory import InvalidTrajectory, check_limits
+
+# ur_kinematics is only needed for computing kinematics, not for reading
+# the parameters
+try:
+    from ur_kin_py import Kinematics, PATH_BRANCH_CHANGED, PATH_UNREACHABLE, PATH_JUMP
+except ImportError:
+    Kinematics = None
+
+# The kinematic parameters of a UR arm are the non-zero D-H parameters,
+# as a tuple (d1, a2, a3, d4, d5, d6) in meters; that is what
+# ur_kin_py.Kinematics takes.  They can come from the controller or from
+# the URDF, so the kinematics match the arm (or its model) rather than
+# nominal values (which are ur_kin_py.UR5 and ur_kin_py.UR10).
+
+# From the ConfigurationData package of a RobotState (see deserialize.py)
+def dh_from_configuration(configuration_data):
+    a, d = configuration_data.dh_a, configuration_data.dh_d
+    return (d[0], a[1], a[2], d[3], d[4], d[5])
+
+# From a URDF like ur_description's: the distances are read from the
+# origins of the joints (joint names start with prefix)
+def dh_from_urdf(robot_description, prefix=""):
+    soup = BeautifulSoup(robot_description)
+    def xyz(joint):
+        joint_elt = soup.find('joint', attrs={'name': prefix + joint})
+        if joint_elt is None or joint_elt.origin is None:
+            raise Exception("No origin for joint \"%s\" in the URDF" % (prefix + joint))
+        return [float(v) for v in joint_elt.origin["xyz"].split()]
+
+    d1 = xyz('shoulder_pan_joint')[2]
+    a2 = -xyz('elbow_joint')[2]
+    a3 = -xyz('wrist_1_joint')[2]
+    # The shoulder, elbow and wrist 1 offsets along the (parallel) joint
+    # axes add up to d4
+    d4 = xyz('shoulder_lift_joint')[1] + xyz('elbow_joint')[1] + xyz('wrist_2_joint')[1]
+    d5 = xyz('wrist_3_joint')[2]
+    d6 = xyz('ee_fixed_joint')[1]
+    return (d1, a2, a3, d4, d5, d6)
+
+# Returns a ur_kin_py.Kinematics with the given parameters
+def make_kinematics(params):
+    if Kinematics is None:
+        raise Exception("ur_kinematics' Python module (ur_kin_py) is not available")
+    return Kinematics(*params)
+
+# Tool paths
+#
+# A tool path is a sequence of poses of the end effector (ee_link, in
+# base_link) with the times to reach them.  Between two poses the tool
+# moves along a straight line and turns about a fixed axis, both at a
+# constant rate.  solve_path() samples the path at the servo period and
+# solves all the samples with one call to Kinematics.inverse_path(), which
+# keeps the arm in the configuration (branch) it starts in, so that the
+# result is an ordinary joint trajectory for CompiledTrajectory.
+
+# Converts the poses of a goal (geometry_msgs/Pose[] and duration[]) to
+# arrays: (times, positions (N x 3), quaternions (N x 4, as x y z w))
+def path_arrays(poses, times_from_start):
+    if len(poses) != len(times_from_start):
+        raise InvalidTrajectory("Received a goal with %d poses but %d times" % \
+                                (len(poses), len(times_from_start)))
+    times = np.array([t.to_sec() for t in times_from_start])
+    positions = np.array([(p.position.x, p.position.y, p.position.z) for p in poses])
+    quaternions = np.array([(p.orientation.x, p.orientation.y, p.orientation.z,
+                             p.orientation.w) for p in poses])
+    return times, positions, quaternions
+
+# Returns the N x 4 x 4 homogeneous transforms of N positions and unit
+# quaternions
+def pose_matrices(positions, quaternions):
+    x, y, z, w = quaternions.T
+    T = np.zeros((len(positions), 4, 4))
+    T[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    T[:, 0, 1] = 2 * (x * y - z * w)
+    T[:, 0, 2] = 2 * (x * z + y * w)
+    T[:, 1, 0] = 2 * (x * y + z * w)
+    T[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    T[:, 1, 2] = 2 * (y * z - x * w)
+    T[:, 2, 0] = 2 * (x * z - y * w)
+    T[:, 2, 1] = 2 * (y * z + x * w)
+    T[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    T[:, :3, 3] = positions
+    T[:, 3, 3] = 1.0
+    return T
+
+# Samples a path at times ts (within times[0]..times[-1]): positions are
+# interpolated linearly, and orientations spherically (slerp) the
+# shorter way around.  Returns (positions, quaternions).
+def interpolate_poses(times, positions, quaternions, ts):
+    if len(times) == 1:
+        return (np.tile(positions[0], (len(ts), 1)), np.tile(quaternions[0], (len(ts), 1)))
+    i = np.clip(np.searchsorted(times, ts, side='right') - 1, 0, len(times) - 2)
+    u = ((ts - times[i]) / (times[i + 1] - times[i]))[:, np.newaxis]
+    p = positions[i] + u * (positions[i + 1] - positions[i])
+
+    q0, q1 = quaternions[i], quaternions[i + 1]
+    cos_theta = np.sum(q0 * q1, axis=1)[:, np.newaxis]
+    q1 = np.where(cos_theta < 0, -q1, q1)
+    theta = np.arccos(np.minimum(np.abs(cos_theta), 1.0))
+    sin_theta = np.sin(theta)
+    # Nearly equal orientations are interpolated linearly
+    near = sin_theta < 1e-9
+    sin_theta[near] = 1.0
+    w0 = np.where(near, 1 - u, np.sin((1 - u) * theta) / sin_theta)
+    w1 = np.where(near, u, np.sin(u * theta) / sin_theta)
+    q = w0 * q0 + w1 * q1
+    q /= np.sqrt(np.sum(q * q, axis=1))[:, np.newaxis]
+    return p, q
+
+# Solves a tool path (as returned by path_arrays) for the joints, from
+# the joint positions q_start (the arm's current setpoint), and checks
+# the result against the velocity and position limits.  The first pose
+# is solved in the configuration of q_start, and every later sample
+# within twice the step that max_velocity allows between samples.
+# Returns the (times, positions, velocities) of a joint trajectory; raises
+# InvalidTrajectory if the path leaves the workspace, needs a change of
+# configuration, or is too fast.
+def solve_path(kin, times, positions, quaternions, q_start, period, max_velocity,
+               position_limits=None):
+    if not len(times):
+        raise InvalidTrajectory("Received a goal without poses")
+    if not (np.isfinite(times).all() and np.isfinite(positions).all() and
+            np.isfinite(quaternions).all()):
+        raise InvalidTrajectory("Received a goal with non-finite values")
+    if times[0] < 0 or (np.diff(times) <= 0).any():
+        raise InvalidTrajectory("Received a goal whose times are not increasing")
+    norms = np.sqrt(np.sum(quaternions * quaternions, axis=1))
+    if (norms < 1e-6).any():
+        raise InvalidTrajectory("Received a goal with an invalid orientation")
+    quaternions = quaternions / norms[:, np.newaxis]
+
+    # Samples the path about every period, from the first pose to the last
+    n = max(int(round((times[-1] - times[0]) / period)), 1) if len(times) > 1 else 0
+    ts = np.linspace(times[0], times[-1], n + 1)
+    T = pose_matrices(*interpolate_poses(times, positions, quaternions, ts))
+
+    q_first, status, branches = kin.inverse_path(T[:1], q_start, 2 * np.pi)
+    if status[0] & (PATH_UNREACHABLE | PATH_BRANCH_CHANGED):
+        raise InvalidTrajectory("The first pose of the goal %s" % \
+                                ("is out of reach" if status[0] & PATH_UNREACHABLE else
+                                 "needs a different arm configuration than the current one"))
+    q = q_first
+    if len(T) > 1:
+        q_rest, status, branches = kin.inverse_path(T[1:], q_first[0],
+                                                    2 * max_velocity * (ts[1] - ts[0]))
+        bad = np.flatnonzero(status & (PATH_UNREACHABLE | PATH_BRANCH_CHANGED | PATH_JUMP))
+        if len(bad):
+            flags = status[bad[0]]
+            if flags & PATH_UNREACHABLE:
+                reason = "leaves the workspace"
+            elif flags & PATH_BRANCH_CHANGED:
+                reason = "needs a change of arm configuration"
+            else:
+                reason = "moves a joint too far in one step (too fast, or through a singularity)"
+            raise InvalidTrajectory("The goal's path %s at t=%.3f" % (reason, ts[1 + bad[0]]))
+        q = np.vstack((q_first, q_rest))
+
+    if len(ts) > 1:
+        velocities = np.gradient(q, ts, axis=0)
+        velocities[0] = velocities[-1] = 0.0
+    else:
+        velocities = np.zeros_like(q)
+    check_limits(q, velocities, max_velocity, position_limits)
+    return ts, q, velocities
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+import time, sys, threading, re
+import socket, select
+import struct
+import optparse
+import numpy as np
+
+from deserialize import PackageType, RobotMode, JointMode
+from protocol import PORT, MSG_OUT, MSG_QUIT, MSG_JOINT_STATES, MSG_MOVEJ, \
+    MSG_WAYPOINT_FINISHED, MSG_STOPJ, MSG_SERVOJ, MSG_MOVEL, MSG_SERVOJ_BATCH, \
+    MSG_JOINT_STATES_V2, SERVO_BUFFER_SIZE, MULT_jointstate, MULT_time, MULT_blend, \
+    JOINT_STATES_V2
+
+# A stand-in for a UR controller, for exercising the driver without an
+# arm.
+#
+# It serves a RobotState stream on the primary port, and when driverProg
+# is uploaded there it runs that program's side of the reverse-port
+# protocol: it connects back to the driver, streams MSG_JOINT_STATES (or
+# MSG_JOINT_STATES_V2, as the program asks) at the controller rate and executes the servoj/movej/stopj commands it
+# receives on a simple joint model.
+
+HEADER = struct.Struct("!IB")
+ROBOT_MODE_DATA = struct.Struct("!IBQ???????Bd")
+JOINT_DATA = struct.Struct("!dddffffB")
+MESSAGE_TYPE = struct.Struct("!i")
+JOINT_STATES = struct.Struct("!%ii" % (1 + 3*6))
+
+ROBOT_STATE = 16
+
+# Number of integer parameters following each message type.
+# MSG_SERVOJ_BATCH has 2 (id and count), followed by 7 per setpoint.
+PARAM_COUNTS = {
+    MSG_QUIT: 0,
+    MSG_STOPJ: 0,
+    MSG_SERVOJ: 1 + 6 + 1,
+    MSG_MOVEJ: 1 + 6 + 4,
+    MSG_MOVEL: 1 + 6 + 4,
+    MSG_SERVOJ_BATCH: 1 + 1,
+}
+
+# Builds a RobotState packet holding robot mode and joint data
+def pack_robot_state(q, qd, q_target, robot_mode=RobotMode.RUNNING, timestamp=0):
+    parts = [ROBOT_MODE_DATA.pack(ROBOT_MODE_DATA.size, PackageType.ROBOT_MODE_DATA,
+                                  timestamp, True, True, True, False, False,
+                                  robot_mode == RobotMode.RUNNING, False,
+                                  robot_mode, 1.0),
+             HEADER.pack(HEADER.size + 6*JOINT_DATA.size, PackageType.JOINT_DATA)]
+    for i in range(6):
+        parts.append(JOINT_DATA.pack(q[i], q_target[i], qd[i], 0.0, 48.0, 30.0, 30.0,
+                                     JointMode.RUNNING))
+    body = "".join(parts)
+    return HEADER.pack(HEADER.size + len(body), ROBOT_STATE) + body
+
+# Joints that follow servo/move setpoints with a velocity limit.
+#
+# Like servoThread in prog, a servo setpoint is latched for its duration
+# t; when that time runs out, the next buffered setpoint (from a batch)
+# is latched, or else the newest single setpoint.  If there is neither,
+# the arm brakes.
+class JointModel(object):
+    def __init__(self, q0, max_velocity=3.0):
+        self.q = np.array(q0, dtype=float)
+        self.qd = np.zeros(6)
+        self.q_target = self.q.copy()
+        self.max_velocity = max_velocity
+        self.lock = threading.Lock()
+        self.__pending = None
+        self.__buffer = []
+        self.__busy_until = 0.0
+        self.__servoing = False
+
+    def set_setpoint(self, q, t):
+        with self.lock:
+            self.__pending = (np.array(q, dtype=float), max(t, 1e-3))
+
+    # Replaces the buffered setpoints with [(q, t), ...]
+    def set_buffer(self, setpoints):
+        with self.lock:
+            self.__buffer = [(np.array(q, dtype=float), max(t, 1e-3))
+                             for q, t in setpoints[:SERVO_BUFFER_SIZE]]
+
+    def stop(self):
+        with self.lock:
+            self.__pending = None
+            self.__buffer = []
+            self.__busy_until = 0.0
+            self.__servoing = False
+            self.q_target = self.q.copy()
+            self.qd[:] = 0.0
+
+    # Advances the model to time now.  Returns True when the arm started
+    # braking because no new setpoint arrived in time.
+    def step(self, now, dt):
+        braked = False
+        with self.lock:
+            if now >= self.__busy_until:
+                if self.__buffer:
+                    self.__pending = self.__buffer.pop(0)
+                if self.__pending is not None:
+                    q, t = self.__pending
+                    self.__pending = None
+                    self.q_target = q
+                    self.qd = np.clip((q - self.q) / t, -self.max_velocity, self.max_velocity)
+                    self.__busy_until = now + t
+                    self.__servoing = True
+                elif self.__servoing:
+                    self.qd[:] = 0.0
+                    self.__servoing = False
+                    braked = True
+            self.q += self.qd * dt
+            return braked
+
+    def snapshot(self):
+        with self.lock:
+            return self.q.copy(), self.qd.copy(), self.q_target.copy()
+
+class MockController(object):
+    def __init__(self, port=PORT, rate=125.0, state_rate=10.0,
+                 q0=(0.0, -1.57, 1.57, 0.0, 0.0, 0.0), max_velocity=3.0):
+        self.port = port
+        self.rate = rate
+        self.state_rate = state_rate
+        self.model = JointModel(q0, max_velocity)
+        self.robot_mode = RobotMode.READY
+        self.programs_received = 0
+        self.stalled_until = 0.0
+        self.__program = None
+        self.__program_lock = threading.Lock()
+
+    # Serves the primary port from a background thread
+    def start(self):
+        self.__server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__server.bind(("", self.port))
+        self.__server.listen(1)
+        thread = threading.Thread(name="MockController:%d" % self.port,
+                                  target=self.__serve_primary)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    # Stops both connections, in both directions, for duration seconds,
+    # as a network outage would
+    def stall(self, duration):
+        self.stalled_until = time.time() + duration
+
+    # Sleeps until the end of any stall, and returns whether there was one
+    def wait_out_stall(self):
+        delay = self.stalled_until - time.time()
+        if delay <= 0:
+            return False
+        time.sleep(delay)
+        return True
+
+    def __serve_primary(self):
+        while True:
+            conn, addr = self.__server.accept()
+            try:
+                self.__stream_state(conn)
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+                self.__stop_program()
+
+    def __stream_state(self, conn):
+        program = ""
+        period = 1.0 / self.state_rate
+        deadline = time.time()
+        while True:
+            if self.wait_out_stall():
+                deadline = time.time()
+            q, qd, q_target = self.model.snapshot()
+            conn.sendall(pack_robot_state(q, qd, q_target, self.robot_mode,
+                                          int(time.time() * 1000)))
+            deadline += period
+            while True:
+                r, _, _ = select.select([conn], [], [], max(deadline - time.time(), 0))
+                if not r:
+                    break
+                more = conn.recv(4096)
+                if not more:
+                    return
+                program = self.__parse_programs(program + more)
+
+    # Runs every complete program in text, and returns what is left over.
+    # A program is a top-level def, which ends with an unindented 'end';
+    # the line calling it is skipped.
+    def __parse_programs(self, text):
+        while True:
+            text = text.lstrip()
+            if text.startswith("def "):
+                m = re.match(r"def \w+\(\):.*?^end$", text, re.M | re.S)
+                if not m:
+                    return text
+                self.__run_program(m.group(0))
+                text = text[m.end():]
+            elif "\n" in text:
+                text = text[text.index("\n") + 1:]
+            else:
+                return text
+
+    def __run_program(self, text):
+        self.__stop_program()
+        self.programs_received += 1
+        if "def driverProg" not in text:
+            return
+        host = re.search(r'HOSTNAME = "([^"]*)"', text).group(1)
+        port = int(re.search(r"^\s*socket_open\(HOSTNAME, (\d+)\)", text, re.M).group(1))
+        version = re.search(r"^\s*PROTOCOL_VERSION = (\d+)", text, re.M)
+        mult = re.search(r"^\s*MULT_jointstate = (\S+)", text, re.M)
+        program = DriverProgram(self, host, port,
+                                int(version.group(1)) if version else 1,
+                                float(mult.group(1)) if mult else MULT_jointstate)
+        with self.__program_lock:
+            self.__program = program
+        program.start()
+
+    def __stop_program(self):
+        with self.__program_lock:
+            program, self.__program = self.__program, None
+        if program:
+            program.stop()
+        self.robot_mode = RobotMode.READY
+
+# The mock's side of driverProg: connects back to the driver, streams
+# joint states and executes received commands.
+class DriverProgram(object):
+    def __init__(self, controller, host, port, protocol_version=1,
+                 mult_jointstate=MULT_jointstate):
+        self.controller = controller
+        self.model = controller.model
+        self.host = host
+        self.port = port
+        self.protocol_version = protocol_version
+        self.mult_jointstate = mult_jointstate
+        self.__keep_running = True
+        self.__sock = None
+
+    def start(self):
+        self.__thread = threading.Thread(name="DriverProgram", target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__keep_running = False
+        if threading.current_thread() is not self.__thread:
+            self.__thread.join()
+
+    def __send_out(self, msg):
+        self.__sock.sendall(MESSAGE_TYPE.pack(MSG_OUT) + msg + "~")
+
+    def __run(self):
+        try:
+            self.__sock = socket.create_connection((self.host, self.port))
+        except socket.error:
+            return
+        self.controller.robot_mode = RobotMode.RUNNING
+        try:
+            self.__send_out("hello")
+            self.__loop()
+        except socket.error:
+            pass
+        finally:
+            self.__sock.close()
+            self.controller.robot_mode = RobotMode.READY
+
+    def __loop(self):
+        period = 1.0 / self.controller.rate
+        mult = self.mult_jointstate
+        # Counted as driverProg counts them: once per run of the loop, so
+        # a stall holds the count back for good
+        seq = 0
+        loops = 0
+        buf = ""
+        pending_waypoint = None
+        last = deadline = time.time()
+        while self.__keep_running:
+            self.controller.wait_out_stall()
+            # Advances the joint model and publishes its state
+            now = time.time()
+            if self.model.step(now, now - last):
+                self.__send_out("Braking")
+            last = now
+            q, qd, _ = self.model.snapshot()
+            state = np.concatenate((q, qd, np.zeros(6)))
+            values = np.floor(mult * state).astype(int).tolist()
+            if self.protocol_version >= 2:
+                self.__sock.sendall(MESSAGE_TYPE.pack(MSG_JOINT_STATES_V2) +
+                                    JOINT_STATES_V2.pack(seq, loops, int(mult), *values))
+            else:
+                self.__sock.sendall(JOINT_STATES.pack(MSG_JOINT_STATES, *values))
+            seq += 1
+            loops += 1
+            if pending_waypoint is not None and not self.model.qd.any():
+                self.__sock.sendall(struct.pack("!ii", MSG_WAYPOINT_FINISHED, pending_waypoint))
+                pending_waypoint = None
+
+            # Receives commands until the next cycle
+            deadline += period
+            while True:
+                r, _, _ = select.select([self.__sock], [], [], max(deadline - time.time(), 0))
+                if not r:
+                    break
+                more = self.__sock.recv(4096)
+                if not more:
+                    return
+                buf += more
+                while len(buf) >= 4:
+                    mtype = MESSAGE_TYPE.unpack_from(buf)[0]
+                    if mtype not in PARAM_COUNTS:
+                        self.__send_out("Received unknown message type")
+                        buf = ""
+                        break
+                    count = PARAM_COUNTS[mtype]
+                    if mtype == MSG_SERVOJ_BATCH and len(buf) >= 12:
+                        count += 7 * struct.unpack_from("!i", buf, 8)[0]
+                    size = 4 * (1 + count)
+                    if len(buf) < size:
+                        break
+                    params = struct.unpack_from("!%ii" % count, buf, 4)
+                    buf = buf[size:]
+                    if mtype == MSG_QUIT:
+                        self.__send_out("Received QUIT")
+                        self.__sock.sendall(MESSAGE_TYPE.pack(MSG_QUIT))
+                        return
+                    elif mtype == MSG_SERVOJ:
+                        q = np.array(params[1:7]) / mult
+                        self.model.set_setpoint(q, params[7] / MULT_time)
+                    elif mtype == MSG_SERVOJ_BATCH:
+                        setpoints = np.array(params[2:], dtype=float).reshape(-1, 7)
+                        self.model.set_buffer([(sp[:6] / mult, sp[6] / MULT_time)
+                                               for sp in setpoints])
+                    elif mtype == MSG_MOVEJ:
+                        q = np.array(params[1:7]) / mult
+                        v = params[8] / mult
+                        t = params[9] / MULT_time
+                        if t <= 0:
+                            t = np.max(np.abs(q - self.model.q)) / max(v, 1e-3)
+                        self.model.set_setpoint(q, t)
+                        pending_waypoint = params[0]
+                    elif mtype == MSG_MOVEL:
+                        self.__send_out("Received movel")
+                        self.__sock.sendall(struct.pack("!ii", MSG_WAYPOINT_FINISHED, params[0]))
+                    elif mtype == MSG_STOPJ:
+                        self.__send_out("Received stopj")
+                        self.model.stop()
+            if deadline < time.time() - period:
+                deadline = time.time()  # Fell behind; don't try to catch up
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-p", "--port", type="int", default=PORT,
+                      help="primary port of the first arm [default: %default]")
+    parser.add_option("-n", "--arms", type="int", default=1,
+                      help="number of arms, on consecutive ports [default: %default]")
+    parser.add_option("-r", "--rate", type="float", default=125.0,
+                      help="joint state rate of driverProg in Hz [default: %default]")
+    parser.add_option("-s", "--state-rate", type="float", default=10.0,
+                      help="RobotState rate of the primary port in Hz [default: %default]")
+    parser.add_option("--stall", type="float", default=0.0,
+                      help="seconds the connections stall for, now and then [default: %default]")
+    parser.add_option("--stall-interval", type="float", default=10.0,
+                      help="seconds between stalls [default: %default]")
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error("Unexpected arguments: %s" % " ".join(args))
+
+    controllers = []
+    for i in range(options.arms):
+        c = MockController(options.port + i, options.rate, options.state_rate)
+        c.start()
+        controllers.append(c)
+        print "Mock controller listening on port %d" % c.port
+    try:
+        while True:
+            if options.stall > 0:
+                time.sleep(options.stall_interval)
+                print "Stalling for %.3f sec" % options.stall
+                for c in controllers:
+                    c.stall(options.stall)
+            else:
+                time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__': main()
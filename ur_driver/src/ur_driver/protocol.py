@@ -0,0 +1,72 @@
+import struct
+import numpy as np
+
+# Ports and message types shared by the driver and the URScript program
+# (prog) it uploads to the robot.  These must match the constants at the
+# top of driverProg.
+
+PORT = 30002
+REVERSE_PORT = 50001
+
+MSG_OUT = 1
+MSG_QUIT = 2
+MSG_JOINT_STATES = 3
+MSG_MOVEJ = 4
+MSG_WAYPOINT_FINISHED = 5
+MSG_STOPJ = 6
+MSG_SERVOJ = 7
+MSG_MOVEL = 8
+MSG_SERVOJ_BATCH = 9
+MSG_JOINT_STATES_V2 = 10
+MULT_jointstate = 10000.0
+MULT_time = 1000000.0
+MULT_blend = 1000.0
+
+# Number of setpoints driverProg can buffer from one MSG_SERVOJ_BATCH
+SERVO_BUFFER_SIZE = 8
+
+# Version of the reverse-port protocol.  Version 1 streams MSG_JOINT_STATES
+# (18 values, always scaled by MULT_jointstate), version 2 streams
+# MSG_JOINT_STATES_V2 records.  driverProg is told which one to use when
+# it is uploaded.
+PROTOCOL_VERSION = 2
+
+# Scale of the joint values (positions, velocities, efforts and servo
+# setpoints) in version 2, i.e. 1 urad.  Any multiplier works as long as
+# the scaled values fit in 32 bits; 1e6 leaves room for efforts up to
+# 2000 Nm.
+MULT_jointstate_v2 = 1000000.0
+
+# Body of MSG_JOINT_STATES_V2: sequence number, the number of loops the
+# state publisher of driverProg has run (not a time: a loop that overruns
+# its cycle is still counted once), the multiplier the values were scaled
+# by, then q, qd and effort.
+JOINT_STATES_V2 = struct.Struct("!3i18i")
+
+# Bodies of the messages driverProg sends, by message type: a struct, or
+# None for a string terminated by '~'
+ROBOT_MESSAGES = {
+    MSG_OUT: None,
+    MSG_QUIT: struct.Struct(""),
+    MSG_JOINT_STATES: struct.Struct("!18i"),
+    MSG_WAYPOINT_FINISHED: struct.Struct("!i"),
+    MSG_JOINT_STATES_V2: JOINT_STATES_V2,
+}
+
+SERVOJ = struct.Struct("!9i")
+SERVOJ_BATCH_HEADER = struct.Struct("!3i")
+
+# Packs a MSG_SERVOJ to the robot joint positions q (i.e. without the
+# calibration offsets), to be reached in t seconds
+def pack_servoj(waypoint_id, q, t, mult_jointstate=MULT_jointstate):
+    q = (mult_jointstate * np.asarray(q, dtype=float)).astype(int)
+    return SERVOJ.pack(MSG_SERVOJ, waypoint_id, *(q.tolist() + [int(MULT_time * t)]))
+
+# Packs a MSG_SERVOJ_BATCH of (up to SERVO_BUFFER_SIZE) rows of robot
+# joint positions, each one to be reached t after the previous one
+def pack_servoj_batch(waypoint_id, q, t, mult_jointstate=MULT_jointstate):
+    params = np.empty((len(q), 7))
+    params[:, :6] = mult_jointstate * np.asarray(q)
+    params[:, 6] = MULT_time * t
+    return SERVOJ_BATCH_HEADER.pack(MSG_SERVOJ_BATCH, waypoint_id, len(q)) + \
+        params.astype('>i4').tostring()
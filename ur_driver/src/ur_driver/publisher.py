@@ -0,0 +1,109 @@
+import time
+import numpy as np
+
+import rospy
+from sensor_msgs.msg import JointState
+
+# Publishes JointState messages built from arrays of robot joint values.
+#
+# The joint offsets are kept as a vector and added to the positions in
+# one step.  Messages come from a small pool that is reused round-robin:
+# position, velocity and effort are preallocated arrays that are filled
+# in place, so publishing a state allocates (almost) nothing.  A message
+# returned by publish() stays valid until POOL_SIZE - 1 more states have
+# been published; keep a JointStateSnapshot of it if it has to be kept
+# longer, or read from another thread.
+#
+# Every state is offered to each topic added with add_topic(), which may
+# forward only every decimation'th state and/or cap its rate, so
+# consumers that can't keep up with the controller rate get a thinned
+# out stream.
+class JointStatePublisher(object):
+    POOL_SIZE = 4
+
+    def __init__(self, joint_names, offsets=None):
+        self.joint_names = list(joint_names)
+        n = len(self.joint_names)
+        self.offsets = np.zeros(n) if offsets is None else np.asarray(offsets, dtype=float)
+        self.last = None
+        self.__topics = []
+        self.__pool = []
+        for i in range(self.POOL_SIZE):
+            msg = JointState()
+            msg.name = self.joint_names
+            msg.position = np.zeros(n)
+            msg.velocity = np.zeros(n)
+            msg.effort = np.zeros(n)
+            self.__pool.append(msg)
+        self.__next = 0
+
+    # Publishes on topic every decimation'th state, but at most max_rate
+    # times per second (0 for no cap).  With a queue_size, rospy
+    # serializes the message and hands it to its own sending thread,
+    # instead of writing to every subscriber before publish() returns.
+    def add_topic(self, topic, max_rate=0.0, decimation=1, queue_size=None):
+        if queue_size is None:
+            publisher = rospy.Publisher(topic, JointState)
+        else:
+            publisher = rospy.Publisher(topic, JointState, queue_size=queue_size)
+        self.__topics.append(_Topic(publisher, max_rate, decimation))
+
+    # Publishes one state.  q, qd and effort are the robot's joint values
+    # (before the offsets are applied), scaled by scale.  effort may be
+    # None.  Returns the message.
+    def publish(self, q, qd, effort=None, scale=1.0, frame_id=""):
+        msg = self.__pool[self.__next]
+        self.__next = (self.__next + 1) % len(self.__pool)
+
+        np.multiply(q, scale, out=msg.position)
+        msg.position += self.offsets
+        np.multiply(qd, scale, out=msg.velocity)
+        if effort is None:
+            msg.effort.fill(0.0)
+        else:
+            np.multiply(effort, scale, out=msg.effort)
+        msg.header.stamp = rospy.get_rostime()
+        msg.header.frame_id = frame_id
+        self.last = msg
+
+        now = time.time()
+        for topic in self.__topics:
+            topic.offer(msg, now)
+        return msg
+
+    # Per-topic publishing counters, e.g. for diagnostics
+    def topic_stats(self):
+        return dict((t.publisher.name, {'offered': t.offered, 'published': t.published})
+                    for t in self.__topics)
+
+# The joint values of a published JointState, copied out of the pooled
+# message, so that they stay as they were (and consistent with each
+# other) while later states are published
+class JointStateSnapshot(object):
+    __slots__ = ['stamp', 'name', 'position', 'velocity', 'effort']
+
+    def __init__(self, msg):
+        self.stamp = msg.header.stamp
+        self.name = msg.name
+        self.position = msg.position.copy()
+        self.velocity = msg.velocity.copy()
+        self.effort = msg.effort.copy()
+
+class _Topic(object):
+    def __init__(self, publisher, max_rate, decimation):
+        self.publisher = publisher
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.decimation = max(int(decimation), 1)
+        self.offered = 0
+        self.published = 0
+        self.last_time = 0.0
+
+    def offer(self, msg, now):
+        self.offered += 1
+        if self.offered % self.decimation:
+            return
+        if now - self.last_time < self.min_interval:
+            return
+        self.last_time = now
+        self.published += 1
+        self.publisher.publish(msg)
@@ -0,0 +1,144 @@
+import time, threading
+import os, select
+import heapq, itertools, collections
+import traceback
+
+from scheduler import SchedulerStats
+
+# A single threaded event loop: sockets are watched with select() and
+# timers are kept in a heap, and every callback runs on the thread that
+# called run(), one at a time and in a deterministic order.
+#
+# Other threads must not touch anything owned by the loop directly;
+# call_soon_threadsafe() queues a callback and wakes the loop up.  An
+# exception escaping a callback is printed and the loop carries on.
+class Reactor(object):
+    MAX_TIMEOUT = 1.0
+
+    def __init__(self):
+        self.thread = None
+        self.__readers = {}  # fileno -> (sock, callback)
+        self.__timers = []   # heap of (when, seq, Timer)
+        self.__seq = itertools.count()
+        self.__pending = collections.deque()
+        self.__wake_r, self.__wake_w = os.pipe()
+        self.__running = False
+
+    def add_reader(self, sock, callback):
+        self.__readers[sock.fileno()] = (sock, callback)
+
+    def remove_reader(self, sock):
+        self.__readers.pop(sock.fileno(), None)
+
+    # Calls callback(*args) at time when (as returned by time.time())
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.__timers, (when, next(self.__seq), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time() + delay, callback, *args)
+
+    # Returns a PeriodicTimer, which like a PeriodicThread has to be
+    # start()ed
+    def periodic(self, period, callback):
+        return PeriodicTimer(self, period, callback)
+
+    # May be called from any thread
+    def call_soon_threadsafe(self, callback, *args):
+        self.__pending.append((callback, args))
+        os.write(self.__wake_w, "x")
+
+    def in_loop(self):
+        return threading.current_thread() is self.thread
+
+    def stop(self):
+        self.call_soon_threadsafe(self.__stop)
+
+    def run(self):
+        self.thread = threading.current_thread()
+        self.__running = True
+        while self.__running:
+            timeout = self.MAX_TIMEOUT
+            if self.__timers:
+                timeout = min(max(self.__timers[0][0] - time.time(), 0.0), timeout)
+            fds = self.__readers.keys() + [self.__wake_r]
+            r, _, _ = select.select(fds, [], [], timeout)
+
+            if self.__wake_r in r:
+                os.read(self.__wake_r, 4096)
+            while self.__pending:
+                callback, args = self.__pending.popleft()
+                self.__call(callback, args)
+            for fd in r:
+                reader = self.__readers.get(fd)
+                if reader:
+                    self.__call(reader[1], ())
+
+            now = time.time()
+            while self.__timers and self.__timers[0][0] <= now:
+                timer = heapq.heappop(self.__timers)[2]
+                if not timer.cancelled:
+                    self.__call(timer.callback, timer.args)
+        self.thread = None
+
+    def __stop(self):
+        self.__running = False
+
+    def __call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc()
+
+class Timer(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+# Calls callback every period seconds on a Reactor, with the same
+# absolute deadlines, skipping and statistics as PeriodicThread.
+# start() and stop() may be called from any thread.
+class PeriodicTimer(object):
+    def __init__(self, reactor, period, callback):
+        self.reactor = reactor
+        self.period = period
+        self.callback = callback
+        self.stats = SchedulerStats()
+        self.__timer = None
+        self.__deadline = None
+
+    def start(self):
+        self.reactor.call_soon_threadsafe(self.__start)
+
+    def stop(self):
+        self.reactor.call_soon_threadsafe(self.__stop)
+
+    def __start(self):
+        self.__stop()
+        self.__deadline = time.time()
+        self.__timer = self.reactor.call_at(self.__deadline, self.__fire)
+
+    def __stop(self):
+        if self.__timer:
+            self.__timer.cancel()
+            self.__timer = None
+
+    def __fire(self):
+        self.stats.add(time.time() - self.__deadline)
+        try:
+            self.callback()
+        finally:
+            self.__deadline += self.period
+            late = time.time() - self.__deadline
+            if late > 0:
+                self.stats.overruns += 1
+                missed = int(late / self.period) + 1
+                self.stats.skipped += missed - 1
+                self.__deadline += (missed - 1) * self.period
+            self.__timer = self.reactor.call_at(self.__deadline, self.__fire)
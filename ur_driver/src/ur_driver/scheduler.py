@@ -0,0 +1,83 @@
+import time, threading
+import math
+
+# Timing statistics of a PeriodicThread.  Jitter is how late a cycle
+# started relative to its deadline; an overrun is a cycle whose callback
+# did not finish before the next deadline.
+class SchedulerStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter_max = 0.0
+        self.__jitter_sum = 0.0
+        self.__jitter_sq_sum = 0.0
+
+    def add(self, jitter):
+        self.cycles += 1
+        self.jitter_max = max(self.jitter_max, jitter)
+        self.__jitter_sum += jitter
+        self.__jitter_sq_sum += jitter * jitter
+
+    def jitter_mean(self):
+        return self.__jitter_sum / self.cycles if self.cycles else 0.0
+
+    def jitter_std(self):
+        if not self.cycles:
+            return 0.0
+        mean = self.jitter_mean()
+        return math.sqrt(max(self.__jitter_sq_sum / self.cycles - mean * mean, 0.0))
+
+    def as_dict(self):
+        return {'cycles': self.cycles, 'overruns': self.overruns, 'skipped': self.skipped,
+                'jitter_mean': self.jitter_mean(), 'jitter_std': self.jitter_std(),
+                'jitter_max': self.jitter_max}
+
+# Calls callback every period seconds on a dedicated thread.
+#
+# Deadlines are absolute (start + k * period), so the error of one
+# wakeup does not carry over into the next.  When a cycle overruns, the
+# deadlines that have already passed are skipped rather than run back to
+# back.
+class PeriodicThread(object):
+    def __init__(self, period, callback, name="PeriodicThread"):
+        self.period = period
+        self.callback = callback
+        self.name = name
+        self.stats = SchedulerStats()
+        self.__thread = None
+        self.__keep_running = False
+
+    def start(self):
+        self.__keep_running = True
+        self.__thread = threading.Thread(name=self.name, target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__keep_running = False
+        if self.__thread and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.__thread = None
+
+    def __run(self):
+        deadline = time.time()
+        while self.__keep_running:
+            now = time.time()
+            if deadline > now:
+                time.sleep(deadline - now)
+                now = time.time()
+            self.stats.add(now - deadline)
+
+            self.callback()
+
+            deadline += self.period
+            late = time.time() - deadline
+            if late > 0:
+                self.stats.overruns += 1
+                missed = int(late / self.period) + 1
+                self.stats.skipped += missed - 1
+                deadline += (missed - 1) * self.period
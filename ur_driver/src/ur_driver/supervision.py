@@ -0,0 +1,102 @@
+import time, threading
+import random
+import traceback
+
+# Keeping the connections to a robot alive: deciding quickly that a
+# stream from the robot has died, pacing the attempts to bring it back,
+# and telling whoever is interested when a connection changes state.
+
+# The connection events of an arm, given to its listeners (see
+# EventSource) with a dict of details
+ROBOT_CONNECTED = 'robot_connected'              # Primary interface connected
+ROBOT_READY = 'robot_ready'                      # The robot can be programmed
+ROBOT_HALTED = 'robot_halted'                    # The robot stopped running a program
+ROBOT_DISCONNECTED = 'robot_disconnected'        # Primary interface lost ('reason')
+PROGRAM_SENT = 'program_sent'                    # driverProg sent ('attempt', 'retry_in')
+COMMANDER_CONNECTED = 'commander_connected'      # driverProg connected back and is streaming
+COMMANDER_DISCONNECTED = 'commander_disconnected'  # driverProg lost ('reason')
+
+# Calls its listeners with (event, details) whenever emit() is called.
+# Listeners run on the thread that emits the event, so they should only
+# take note of it (or hand it over to their own thread) and return.
+class EventSource(object):
+    def __init__(self):
+        self.__listeners = []
+        self.__lock = threading.Lock()
+
+    def subscribe(self, listener):
+        with self.__lock:
+            self.__listeners = self.__listeners + [listener]
+
+    def unsubscribe(self, listener):
+        with self.__lock:
+            self.__listeners = [l for l in self.__listeners if l is not listener]
+
+    def emit(self, event, **details):
+        details.setdefault('time', time.time())
+        for listener in self.__listeners:
+            try:
+                listener(event, details)
+            except Exception:
+                traceback.print_exc()
+
+# Decides whether a stream of states from the robot is alive: it is dead
+# when its newest state arrived more than timeout ago.
+#
+# Only arrival times are used.  driverProg has no clock of its own to
+# stamp its states with (its loop count falls behind the controller
+# whenever a loop overruns its cycle or blocks on the socket), so a
+# stream is judged by when its states arrive and not by when they were
+# sent.  States missing from the sequence numbers are counted in gaps.
+class Liveness(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.last_heard = None
+        self.last_seq = None
+        self.gaps = 0
+
+    # Records a state that arrived at now, with its sequence number if
+    # the stream has them.  Returns the number of states missing just
+    # before it.
+    def heard(self, now, seq=None):
+        missed = 0
+        if seq is not None:
+            if self.last_seq is not None and seq > self.last_seq + 1:
+                missed = seq - self.last_seq - 1
+                self.gaps += missed
+            self.last_seq = seq
+        self.last_heard = now
+        return missed
+
+    # Seconds since the newest state arrived, or None before any state
+    def age(self, now):
+        if self.last_heard is None:
+            return None
+        return now - self.last_heard
+
+    def expired(self, now):
+        age = self.age(now)
+        return age is not None and age > self.timeout
+
+# Delays between attempts to reconnect: the first attempt is made right
+# away, and the delay before each later one doubles from initial up to
+# maximum.  Every delay is randomly shortened by up to jitter (a
+# fraction of it), so that several arms that lost their connections
+# together do not retry in lockstep.
+class Backoff(object):
+    def __init__(self, initial=1.0, maximum=10.0, jitter=0.25, factor=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self.factor = factor
+        self.attempts = 0
+
+    # Counts an attempt, and returns how long to wait for it to succeed
+    # before the next one
+    def next(self):
+        delay = min(self.initial * self.factor ** self.attempts, self.maximum)
+        self.attempts += 1
+        return delay * (1.0 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
@@ -0,0 +1,420 @@
+import bisect
+import copy
+import numpy as np
+
+class InvalidTrajectory(Exception): pass
+
+# Stacks one field (e.g. 'positions') of every point into a (points x
+# joints) array.  Returns None if the points have different lengths.
+def _field_array(points, field, n):
+    try:
+        values = np.array([getattr(p, field) for p in points], dtype=float)
+    except ValueError:
+        return None
+    return values.reshape(len(points), -1) if len(points) else np.zeros((0, n))
+
+# Converts a JointTrajectory message into arrays: (times, positions,
+# velocities, accelerations), where times has one entry per point and
+# the others are (points x joints).  Missing accelerations are zero;
+# velocities is None if the points have different numbers of them.
+def trajectory_arrays(traj):
+    n = len(traj.joint_names)
+    times = np.array([p.time_from_start.to_sec() for p in traj.points], dtype=float)
+    positions = _field_array(traj.points, 'positions', n)
+    if positions is None:
+        raise ValueError("Trajectory points have different numbers of positions")
+    velocities = _field_array(traj.points, 'velocities', n)
+    accelerations = _field_array(traj.points, 'accelerations', n)
+    if accelerations is None or accelerations.shape != positions.shape:
+        accelerations = np.zeros_like(positions)
+        for i, p in enumerate(traj.points):
+            if p.accelerations:
+                accelerations[i] = p.accelerations
+    return times, positions, velocities, accelerations
+
+# Checks a JointTrajectory goal and converts it into arrays (see
+# trajectory_arrays) with the joints ordered as in joint_names.
+#
+# max_velocity and the optional (lower, upper) position limits are either
+# scalars or per-joint vectors in joint_names order.  Raises
+# InvalidTrajectory, with a message suitable for rejecting the goal.
+def validate_trajectory(traj, joint_names, max_velocity, position_limits=None):
+    if set(traj.joint_names) != set(joint_names) or len(traj.joint_names) != len(joint_names):
+        raise InvalidTrajectory("Received a goal with incorrect joint names: (%s)" % \
+                                ', '.join(traj.joint_names))
+    if not traj.points:
+        raise InvalidTrajectory("Received a goal without points")
+    try:
+        times, positions, velocities, accelerations = trajectory_arrays(traj)
+    except ValueError:
+        raise InvalidTrajectory("Received a goal with points of the wrong size")
+    if positions.shape[1] != len(joint_names):
+        raise InvalidTrajectory("Received a goal with points of the wrong size")
+    if velocities is None or velocities.shape != positions.shape:
+        raise InvalidTrajectory("Received a goal without velocities")
+    if not (np.isfinite(positions).all() and np.isfinite(velocities).all()):
+        raise InvalidTrajectory("Received a goal with infinites or NaNs")
+
+    # Orders the joints according to joint_names
+    order = [traj.joint_names.index(j) for j in joint_names]
+    if order != range(len(order)):
+        positions = positions[:, order]
+        velocities = velocities[:, order]
+        accelerations = accelerations[:, order]
+
+    check_limits(positions, velocities, max_velocity, position_limits)
+    return times, positions, velocities, accelerations
+
+# Checks (points x joints) arrays of positions and velocities against the
+# limits (as for validate_trajectory), raising InvalidTrajectory
+def check_limits(positions, velocities, max_velocity, position_limits=None):
+    if (np.abs(velocities) > max_velocity).any():
+        raise InvalidTrajectory("Received a goal with velocities that are higher than %s" % \
+                                max_velocity)
+    if position_limits is not None:
+        lower, upper = position_limits
+        if ((positions < lower) | (positions > upper)).any():
+            raise InvalidTrajectory("Received a goal with positions outside the joint limits")
+
+# Returns the coefficients (constant term first, along the last axis) of
+# the cubics from p0 and v0 to p1 and v1 in T
+def _cubic_coeffs(p0, p1, v0, v1, T):
+    coeffs = np.empty(p0.shape + (4,))
+    coeffs[..., 0] = p0
+    coeffs[..., 1] = v0
+    coeffs[..., 2] = (-3*p0 + 3*p1 - 2*T*v0 - T*v1) / T**2
+    coeffs[..., 3] = (2*p0 - 2*p1 + T*v0 + T*v1) / T**3
+    return coeffs
+
+# Returns the largest absolute velocity and acceleration of every joint
+# along cubics (segments x joints x 4) of durations T (segments x 1).
+# Velocities peak at the ends of a segment or where its acceleration is
+# zero, accelerations at the ends.
+def _cubic_peaks(coeffs, T):
+    b, c, d = coeffs[:, :, 1], coeffs[:, :, 2], coeffs[:, :, 3]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_peak = np.clip(np.where(d != 0, -c / (3 * d), 0.0), 0.0, T)
+    velocity = np.maximum(np.abs(b), np.maximum(np.abs(b + T*(2*c + 3*d*T)),
+                                                np.abs(b + t_peak*(2*c + 3*d*t_peak))))
+    acceleration = np.maximum(np.abs(2*c), np.abs(2*c + 6*d*T))
+    moving = T > 0
+    return (np.where(moving, velocity, 0.0).max(axis=0),
+            np.where(moving, acceleration, 0.0).max(axis=0))
+
+# A joint trajectory prepared for sampling at servo rate.
+#
+# The cubic (position and velocity matching) polynomial of every segment
+# is computed once, into coeffs (segments x joints x 4, constant term
+# first).  sample() finds the segment by bisecting the knot times and
+# evaluates all joints at once.
+#
+# Before its first point, a trajectory holds that point, unless it was
+# spliced() onto a start state: then it moves from that state at time 0
+# to the first point along one more cubic.
+class CompiledTrajectory(object):
+    def __init__(self, times, positions, velocities, accelerations=None):
+        self.times = np.asarray(times, dtype=float)
+        self.positions = np.asarray(positions, dtype=float)
+        self.velocities = np.asarray(velocities, dtype=float)
+        if accelerations is None:
+            self.accelerations = np.zeros_like(self.positions)
+        else:
+            self.accelerations = np.asarray(accelerations, dtype=float)
+        self.duration = self.times[-1]
+        self.__knots = self.times.tolist()
+        self.__start = None  # (q, qdot, qddot, coeffs) of the spliced start
+        self.__peaks = None
+
+        T = np.diff(self.times)
+        # Zero length segments are never sampled
+        T = np.where(T > 0, T, 1.0)[:, np.newaxis]
+        self.coeffs = _cubic_coeffs(self.positions[:-1], self.positions[1:],
+                                    self.velocities[:-1], self.velocities[1:], T)
+
+    @staticmethod
+    def from_msg(traj):
+        return CompiledTrajectory(*trajectory_arrays(traj))
+
+    def __len__(self):
+        return len(self.times)
+
+    # Returns this trajectory starting from q, qdot and qddot (e.g. the
+    # current setpoint) at time 0.  The result shares this trajectory's
+    # arrays, and only the cubic to the first point is computed, so
+    # splicing takes the same time however long the trajectory is.
+    def spliced(self, q, qdot, qddot):
+        traj = copy.copy(self)
+        coeffs = None
+        if self.times[0] > 0:
+            coeffs = _cubic_coeffs(np.asarray(q, dtype=float), self.positions[0],
+                                   np.asarray(qdot, dtype=float), self.velocities[0],
+                                   self.times[0])
+        traj.__start = (q, qdot, qddot, coeffs)
+        return traj
+
+    # Returns the largest absolute velocity and acceleration of every
+    # joint along the trajectory, as two arrays.  Those of the points are
+    # computed once, and shared with spliced trajectories.
+    def peak_rates(self):
+        if self.__peaks is None:
+            if len(self.coeffs) == 0:
+                self.__peaks = np.zeros_like(self.positions[0]), np.zeros_like(self.positions[0])
+            else:
+                self.__peaks = _cubic_peaks(self.coeffs, np.diff(self.times)[:, np.newaxis])
+        velocity, acceleration = self.__peaks
+        if self.__start and self.__start[3] is not None:
+            head = _cubic_peaks(self.__start[3][np.newaxis], np.array([[self.times[0]]]))
+            velocity, acceleration = np.maximum(velocity, head[0]), np.maximum(acceleration, head[1])
+        return velocity, acceleration
+
+    # Returns (q, qdot, qddot) for sampling the trajectory at time t,
+    # the time since the trajectory was started.  The returned arrays
+    # must not be modified.
+    def sample(self, t):
+        # First point, or the start it is spliced onto
+        if t <= 0.0:
+            if self.__start is None:
+                return self.positions[0], self.velocities[0], self.accelerations[0]
+            return self.__start[:3]
+        # Last point
+        if t >= self.duration:
+            return self.positions[-1], self.velocities[-1], self.accelerations[-1]
+        # Before the first point
+        if t <= self.__knots[0]:
+            if self.__start is None:
+                return self.positions[0], self.velocities[0], self.accelerations[0]
+            return self.__evaluate(self.__start[3], t)
+
+        # Finds the (middle) segment containing t
+        i = max(bisect.bisect_left(self.__knots, t) - 1, 0)
+        return self.__evaluate(self.coeffs[i], t - self.__knots[i])
+
+    @staticmethod
+    def __evaluate(coeffs, t):
+        a, b, c, d = coeffs.T
+        q = a + t*(b + t*(c + t*d))
+        qdot = b + t*(2*c + t*3*d)
+        qddot = 2*c + 6*d*t
+        return q, qdot, qddot
+
+    # Samples the trajectory at each of the times ts.  Returns (q, qdot,
+    # qddot) as (len(ts) x joints) arrays.
+    def sample_many(self, ts):
+        ts = np.asarray(ts, dtype=float)
+        if len(self.coeffs) == 0:
+            shape = (len(ts), 1)
+            q, qdot, qddot = (np.tile(self.positions[0], shape), np.tile(self.velocities[0], shape),
+                              np.tile(self.accelerations[0], shape))
+        else:
+            i = np.clip(np.searchsorted(self.times, ts) - 1, 0, len(self.coeffs) - 1)
+            t = np.clip(ts, self.times[0], self.duration) - self.times[i]
+            q, qdot, qddot = self.__evaluate_many(self.coeffs[i], t[:, np.newaxis])
+
+        # Before the first point, holds it or follows the spliced start;
+        # after the end, holds the last point
+        first, last = ts <= self.times[0], ts >= self.duration
+        if first.any():
+            if self.__start is None:
+                q[first], qdot[first], qddot[first] = \
+                    self.positions[0], self.velocities[0], self.accelerations[0]
+            else:
+                q0, qdot0, qddot0, coeffs = self.__start
+                if coeffs is not None:
+                    t = np.maximum(ts[first], 0.0)[:, np.newaxis]
+                    q[first], qdot[first], qddot[first] = self.__evaluate_many(coeffs, t)
+                before = ts <= 0.0 if coeffs is not None else first
+                q[before], qdot[before], qddot[before] = q0, qdot0, qddot0
+        if last.any():
+            q[last] = self.positions[-1]
+            qdot[last] = self.velocities[-1]
+            qddot[last] = self.accelerations[-1]
+        return q, qdot, qddot
+
+    @staticmethod
+    def __evaluate_many(coeffs, t):
+        a, b, c, d = coeffs[..., 0], coeffs[..., 1], coeffs[..., 2], coeffs[..., 3]
+        q = a + t*(b + t*(c + t*d))
+        qdot = b + t*(2*c + t*3*d)
+        qddot = 2*c + 6*d*t
+        return q, qdot, qddot
+
+# Returns how many times slower than it is timed a trajectory has to be
+# played (at least 1) to stay within max_velocity and max_acceleration
+def required_time_scale(trajectory, max_velocity=None, max_acceleration=None):
+    time_scale = 1.0
+    if max_velocity or max_acceleration:
+        velocity, acceleration = trajectory.peak_rates()
+        if max_velocity:
+            time_scale = max(time_scale, (velocity / max_velocity).max())
+        if max_acceleration:
+            time_scale = max(time_scale, np.sqrt((acceleration / max_acceleration).max()))
+    return time_scale
+
+# A trajectory resampled at the servo period: setpoint k, for time
+# k * period, is a row of a contiguous array of setpoints.  The last
+# setpoint is the end of the trajectory.  A time between two
+# setpoints is sampled by cubic Hermite interpolation of their rows,
+# which takes the same few operations wherever it falls, and is exact
+# for the trajectory's cubics between knots: servo ticks need not line
+# up with the setpoints, so wakeup jitter doesn't make them skip or
+# repeat one.
+#
+# With max_velocity and/or max_acceleration, the trajectory is played
+# uniformly slower (time_scale times as long) if it would exceed them;
+# a time_scale given explicitly is used as it is.
+#
+# Setpoints are tabulated in chunks of chunk_size, ahead of the ones
+# that are sampled, into arrays of at most two chunks: long trajectories
+# take bounded memory, and the first chunk is ready when the table is
+# made.  Sampling may tabulate setpoints, so a table must not be sampled
+# from several threads at once.
+class SetpointTable(object):
+    CHUNK_SIZE = 1024
+
+    def __init__(self, trajectory, period, max_velocity=None, max_acceleration=None,
+                 chunk_size=CHUNK_SIZE, time_scale=None):
+        self.trajectory = trajectory
+        self.period = period
+        if time_scale is None:
+            time_scale = required_time_scale(trajectory, max_velocity, max_acceleration)
+        self.time_scale = time_scale
+        self.duration = trajectory.duration * self.time_scale
+        self.length = int(np.ceil(self.duration / period - 1e-9)) + 1
+        self.final_position = trajectory.positions[-1]
+        self.final_velocity = trajectory.velocities[-1] / self.time_scale
+        self.chunk_size = chunk_size
+
+        # Row r holds q, qdot and qddot of a setpoint, one above the other
+        shape = (min(self.length, 2 * chunk_size), 3, trajectory.positions.shape[1])
+        self.__rows = np.empty(shape)
+        self.__first = 0  # Setpoint in row 0
+        self.__end = 0    # Setpoints before this one are tabulated
+        self.__fill(0, 1)
+
+    def __len__(self):
+        return self.length
+
+    # Returns (k, s, h) for time t: t lies s (from 0 to 1) of the way from
+    # setpoint k to setpoint k + 1, which are h apart (the last interval
+    # may be shorter than the period).  Times at or past the end are the
+    # last setpoint.
+    def locate(self, t):
+        if t >= self.duration:
+            return self.length - 1, 0.0, 0.0
+        t = max(t, 0.0)
+        k = int(t / self.period)
+        t0 = k * self.period
+        h = min(t0 + self.period, self.duration) - t0
+        return k, min((t - t0) / h, 1.0), h
+
+    # Returns (q, qdot, qddot) of the setpoint for time t, as new arrays:
+    # later samples may move the table's window and overwrite its rows.
+    def sample(self, t):
+        k, s, h = self.locate(t)
+        self.__fill(k, min(k + max(self.chunk_size // 2, 2), self.length))
+        i = k - self.__first
+        if s == 0.0:
+            q, qdot, qddot = self.__rows[i]
+            return q.copy(), qdot.copy(), qddot.copy()
+        h00, h10, h01, h11 = self.hermite(s, h)
+        weights = np.array([[h00, h10, 0.0, h01, h11, 0.0],
+                            [0.0, h00, h10, 0.0, h01, h11],
+                            [0.0, 0.0, 1 - s, 0.0, 0.0, s]])
+        return tuple(np.dot(weights, self.__rows[i:i + 2].reshape(6, -1)))
+
+    # Returns (q, qdot, qddot) of the setpoints for each of the times ts,
+    # as (len(ts) x joints) arrays.  The times must span at most two
+    # chunks.
+    def sample_many(self, ts):
+        ts = np.asarray(ts, dtype=float)
+        end = ts >= self.duration
+        ts = np.clip(ts, 0.0, self.duration)
+        k = (ts / self.period).astype(int)
+        k[end] = self.length - 1
+        t0 = k * self.period
+        h = np.where(end, 1.0, np.minimum(t0 + self.period, self.duration) - t0)
+        s = np.where(end, 0.0, np.minimum((ts - t0) / h, 1.0))
+        if len(k) and min(k.max() + 2, self.length) - k.min() > len(self.__rows):
+            raise ValueError("Sampled times span more than two chunks of setpoints")
+        self.__fill(k.min(), min(k.max() + max(self.chunk_size // 2, 2), self.length))
+        i = k - self.__first
+        a = self.__rows[i]
+        b = self.__rows[np.minimum(i + 1, self.length - 1 - self.__first)]
+        h00, h10, h01, h11 = self.hermite(s[:, np.newaxis, np.newaxis],
+                                          h[:, np.newaxis, np.newaxis])
+        # q and qdot together, each from its own values and derivatives
+        q_qdot = h00*a[:, :2] + h10*a[:, 1:] + h01*b[:, :2] + h11*b[:, 1:]
+        s = s[:, np.newaxis]
+        return q_qdot[:, 0], q_qdot[:, 1], (1 - s)*a[:, 2] + s*b[:, 2]
+
+    # Returns (q, qdot, qddot) of the n setpoints one period apart after
+    # time t (for t + period to t + n * period), as (n x joints) arrays,
+    # as sample_many does.  Away from the end of the table, all of them
+    # lie the same fraction of the way between consecutive rows, so they
+    # are interpolated from two runs of rows with the same weights.
+    def sample_ahead(self, t, n):
+        k, s, h = self.locate(t + self.period)
+        if k + n > self.length - 2:
+            return self.sample_many(t + self.period * np.arange(1, n + 1))
+        self.__fill(k, min(k + max(self.chunk_size // 2, n + 1), self.length))
+        i = k - self.__first
+        a = self.__rows[i:i + n]
+        b = self.__rows[i + 1:i + n + 1]
+        h00, h10, h01, h11 = self.hermite(s, h)
+        q_qdot = h00*a[:, :2] + h10*a[:, 1:] + h01*b[:, :2] + h11*b[:, 1:]
+        return q_qdot[:, 0], q_qdot[:, 1], (1 - s)*a[:, 2] + s*b[:, 2]
+
+    # The weights of a value and its derivative at two setpoints h apart,
+    # in the cubic Hermite interpolation s (from 0 to 1) of the way from
+    # the first to the second.  qddot is interpolated linearly.
+    @staticmethod
+    def hermite(s, h):
+        s2 = s * s
+        s3 = s2 * s
+        h00 = 2*s3 - 3*s2 + 1
+        return h00, (s3 - 2*s2 + s) * h, 1 - h00, (s3 - s2) * h
+
+    # Tabulates setpoints, if needed, so that k0 to k1 - 1 are available
+    def __fill(self, k0, k1):
+        if self.__first <= k0 and k1 <= self.__end:
+            return
+        capacity = len(self.__rows)
+        if k0 < self.__first or k1 > self.__first + capacity:
+            # Moves the window to start at k0, keeping the setpoints after
+            # k0 that are already tabulated
+            keep = max(min(self.__end, k0 + capacity) - k0, 0) if k0 >= self.__first else 0
+            if keep:
+                self.__rows[:keep] = self.__rows[k0 - self.__first:k0 - self.__first + keep]
+            self.__first = k0
+            self.__end = k0 + keep
+
+        end = min(max(k1, self.__end + self.chunk_size), self.__first + capacity, self.length)
+        ks = np.arange(self.__end, end)
+        t = np.minimum(ks * self.period, self.duration) / self.time_scale
+        q, qd, qdd = self.trajectory.sample_many(t)
+        rows = self.__rows[self.__end - self.__first:end - self.__first]
+        rows[:, 0] = q
+        rows[:, 1] = qd / self.time_scale
+        rows[:, 2] = qdd / self.time_scale**2
+        self.__end = end
+
+# Splices trajectory onto the setpoint (q, qdot, qddot) and tabulates it
+# (see SetpointTable), slowed down to max_velocity and max_acceleration.
+#
+# The setpoint's rates are in wall-clock time, and a table plays its
+# trajectory time_scale times slower, so the start is given to the
+# trajectory sped up to match (qdot * time_scale, qddot * time_scale**2):
+# the first setpoint is then the current one.  As the cubic to the first
+# point depends on the scale, and the scale on that cubic, the two are
+# solved for together, by iterating.
+def splice_table(trajectory, q, qdot, qddot, period, max_velocity=None, max_acceleration=None,
+                 max_iterations=10):
+    qdot, qddot = np.asarray(qdot, dtype=float), np.asarray(qddot, dtype=float)
+    time_scale = 1.0
+    for i in range(max_iterations):
+        spliced = trajectory.spliced(q, qdot * time_scale, qddot * time_scale**2)
+        required = required_time_scale(spliced, max_velocity, max_acceleration)
+        if required <= time_scale * (1 + 1e-6):
+            break
+        time_scale = required
+    return SetpointTable(spliced, period, time_scale=time_scale)
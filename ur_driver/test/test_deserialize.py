@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+import os, sys
+import struct
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'ur_driver'))
+from deserialize import RobotState, RobotMode, PackageType
+from mock_controller import pack_robot_state, HEADER, ROBOT_STATE
+
+DH_A = [0.0, -0.425, -0.39225, 0.0, 0.0, 0.0]
+DH_D = [0.089159, 0.0, 0.0, 0.10915, 0.09465, 0.0823]
+
+# A ConfigurationData sub-package with the given D-H parameters
+def configuration_package(dh_a, dh_d):
+    body = struct.pack("!%dd" % (4 * 6 + 5), *([0.0] * (4 * 6 + 5)))
+    body += struct.pack("!24d", *(list(dh_a) + list(dh_d) + [0.0] * 12))
+    body += struct.pack("!iiii", 0, 0, 0, 0)
+    return HEADER.pack(HEADER.size + len(body), PackageType.CONFIGURATION_DATA) + body
+
+# A RobotState packet with robot mode, joint and configuration data, and
+# a sub-package of an unknown type
+def robot_state_packet(q, qd, q_target, unknown_ptype=99):
+    state = pack_robot_state(q, qd, q_target, RobotMode.RUNNING, timestamp=1234)
+    body = (state[HEADER.size:] + configuration_package(DH_A, DH_D) +
+            HEADER.pack(HEADER.size + 3, unknown_ptype) + "\0" * 3)
+    return HEADER.pack(HEADER.size + len(body), ROBOT_STATE) + body
+
+class TestRobotState(unittest.TestCase):
+    q = np.array([0.1, -1.2, 1.4, -0.3, 1.57, 0.2])
+    qd = np.array([0.01, 0.02, -0.03, 0.0, 0.5, -0.5])
+    q_target = q + 0.001
+
+    def check(self, state):
+        self.assertEqual(state.robot_mode_data.robot_mode, RobotMode.RUNNING)
+        self.assertEqual(state.robot_mode_data.timestamp, 1234)
+        np.testing.assert_array_equal(state.joints['q_actual'], self.q)
+        np.testing.assert_array_equal(state.joints['qd_actual'], self.qd)
+        np.testing.assert_array_equal(state.joints['q_target'], self.q_target)
+        # The structured array and the JointData objects agree
+        for i, jd in enumerate(state.joint_data):
+            self.assertEqual(jd.q_actual, state.joints['q_actual'][i])
+            self.assertEqual(jd.qd_actual, state.joints['qd_actual'][i])
+            self.assertEqual(jd.q_target, state.joints['q_target'][i])
+            self.assertEqual(jd.V_actual, state.joints['V_actual'][i])
+
+    def test_unpack_str(self):
+        state = RobotState.unpack(robot_state_packet(self.q, self.qd, self.q_target))
+        self.check(state)
+        self.assertEqual(state.configuration_data.dh_a, DH_A)
+        self.assertEqual(state.configuration_data.dh_d, DH_D)
+        self.assertEqual(state.unknown_ptypes, [99])
+        self.assertRaises(AttributeError, lambda: state.tool_data)
+
+    # A view of a buffer that is reused right after unpacking, as
+    # PacketFramer's are
+    def test_unpack_reused_view(self):
+        packet = robot_state_packet(self.q, self.qd, self.q_target)
+        buf = bytearray(packet)
+        state = RobotState.unpack(memoryview(buf))
+        buf[:] = "\0" * len(buf)
+        self.check(state)
+        self.assertEqual(state.configuration_data.dh_d, DH_D)
+
+    def test_unpack_selected_packages(self):
+        packet = robot_state_packet(self.q, self.qd, self.q_target)
+        buf = bytearray(packet)
+        state = RobotState.unpack(memoryview(buf), frozenset([PackageType.ROBOT_MODE_DATA,
+                                                              PackageType.JOINT_DATA]))
+        buf[:] = "\0" * len(buf)
+        self.check(state)
+        self.assertRaises(AttributeError, lambda: state.configuration_data)
+
+    def test_bad_length(self):
+        packet = robot_state_packet(self.q, self.qd, self.q_target)
+        self.assertRaises(Exception, RobotState.unpack, packet[:-1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import os, sys
+import socket
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'ur_driver'))
+from framing import PacketFramer, MessageParser
+
+# A primary interface packet of the given length and type, with a body
+# that tells it apart from the others
+def packet(length, ptype=16, fill='x'):
+    return PacketFramer.HEADER.pack(length, ptype) + fill * (length - PacketFramer.HEADER.size)
+
+class TestPacketFramer(unittest.TestCase):
+    def framed(self, framer, data, chunk):
+        packets = []
+        for i in range(0, len(data), chunk):
+            framer.feed(data[i:i + chunk])
+            packets.extend(p.tobytes() for p in framer.packets())
+        return packets
+
+    def test_split_packets(self):
+        data = [packet(60, fill='a'), packet(200, fill='b'), packet(5)]
+        for chunk in [1, 3, 7, 64]:
+            self.assertEqual(self.framed(PacketFramer(), "".join(data), chunk), data)
+
+    def test_merged_packets(self):
+        data = [packet(20 + i, fill=chr(ord('a') + i)) for i in range(10)]
+        framer = PacketFramer()
+        framer.feed("".join(data))
+        self.assertEqual([p.tobytes() for p in framer.packets()], data)
+        self.assertEqual(framer.pending(), 0)
+
+    # A small buffer is compacted, and grown for packets that do not fit
+    def test_small_buffer(self):
+        data = [packet(100, fill='a'), packet(3000, fill='b'), packet(700, fill='c')] * 3
+        framer = PacketFramer(capacity=256, recv_size=64)
+        self.assertEqual(self.framed(framer, "".join(data), 100), data)
+
+    def test_recv_from(self):
+        data = [packet(1000, fill='a'), packet(10, fill='b')]
+        a, b = socket.socketpair()
+        try:
+            a.sendall("".join(data))
+            a.close()
+            framer = PacketFramer(capacity=512, recv_size=128)
+            packets = []
+            while framer.recv_from(b):
+                packets.extend(p.tobytes() for p in framer.packets())
+            self.assertEqual(packets, data)
+        finally:
+            b.close()
+
+    def test_bad_length(self):
+        framer = PacketFramer()
+        framer.feed(PacketFramer.HEADER.pack(2, 16))
+        self.assertRaises(Exception, list, framer.packets())
+
+MSG_OUT = 1
+MSG_WAYPOINT_FINISHED = 4
+
+class TestMessageParser(unittest.TestCase):
+    def setUp(self):
+        self.received = []
+        self.parser = MessageParser(
+            {MSG_OUT: None, MSG_WAYPOINT_FINISHED: struct.Struct("!i")},
+            {MSG_OUT: lambda s: self.received.append(('out', s)),
+             MSG_WAYPOINT_FINISHED: lambda t: self.received.append(('finished', t[0]))})
+
+    def parsed(self, data, chunk):
+        for i in range(0, len(data), chunk):
+            self.parser.feed(data[i:i + chunk])
+            self.parser.parse()
+        return self.received
+
+    def test_split_messages(self):
+        data = (struct.pack("!i", MSG_OUT) + "Hello~" +
+                struct.pack("!ii", MSG_WAYPOINT_FINISHED, 42) +
+                struct.pack("!i", MSG_OUT) + "~" +
+                struct.pack("!i", MSG_OUT) + "x" * 500 + "~")
+        expected = [('out', 'Hello'), ('finished', 42), ('out', ''), ('out', 'x' * 500)]
+        for chunk in [1, 2, 5, 13, len(data)]:
+            del self.received[:]
+            self.parser.reset()
+            self.assertEqual(self.parsed(data, chunk), expected)
+            self.assertEqual(self.parser.pending(), 0)
+
+    def test_unknown_type(self):
+        self.parser.feed(struct.pack("!i", 99))
+        self.assertRaises(Exception, self.parser.parse)
+
+    def test_unterminated_string(self):
+        self.parser.feed(struct.pack("!i", MSG_OUT) + "x" * (MessageParser.MAX_STRING + 1))
+        self.assertRaises(Exception, self.parser.parse)
+
+if __name__ == '__main__':
+    unittest.main()
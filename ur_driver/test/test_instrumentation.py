@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+import os, sys
+import time, threading
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'ur_driver'))
+from instrumentation import LatencyHistogram, RateCounter, EchoTracker, Metrics
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(LatencyHistogram().percentile(50), None)
+
+    # Percentiles are the upper bounds of their buckets, capped at the
+    # largest sample
+    def test_percentiles(self):
+        h = LatencyHistogram()
+        now = time.time()
+        for i in range(90):
+            h.add(1e-4, now)
+        for i in range(10):
+            h.add(0.05, now)
+        self.assertAlmostEqual(h.percentile(50), 1e-4)
+        self.assertAlmostEqual(h.percentile(90), 1e-4)
+        self.assertAlmostEqual(h.percentile(99), 0.05)
+        self.assertAlmostEqual(h.percentile(100), 0.05)
+        h.add(2e-4, now)
+        self.assertAlmostEqual(h.percentile(99), 0.05)
+        self.assertAlmostEqual(h.percentile(90.05), 10 ** -3.5)
+        d = h.as_dict()
+        self.assertEqual(d['count'], 101)
+        self.assertEqual(d['max'], 0.05)
+
+    def test_beyond_bounds(self):
+        h = LatencyHistogram()
+        h.add(100.0)
+        self.assertEqual(h.percentile(50), 100.0)
+
+    # Statistics cover the current and the previous window only
+    def test_windows(self):
+        h = LatencyHistogram(window=10.0)
+        now = time.time()
+        for i in range(10):
+            h.add(1.0, now + 1)
+        for i in range(10):
+            h.add(1e-3, now + 12)
+        self.assertEqual(sum(h.counts()), 20)
+        self.assertAlmostEqual(h.percentile(100), 1.0)
+        h.add(1e-3, now + 23)
+        self.assertEqual(sum(h.counts()), 11)
+        self.assertAlmostEqual(h.percentile(100), 1e-3, places=4)
+        # The maximum and the count are since the start
+        self.assertEqual(h.max, 1.0)
+        self.assertEqual(h.count, 21)
+
+class TestRateCounter(unittest.TestCase):
+    def test_rates(self):
+        r = RateCounter(window=10.0)
+        now = time.time()
+        for i in range(50):
+            r.add(100, now + i * 0.1)
+        per_sec, bytes_per_sec = r.rates(now + 5.0)
+        self.assertAlmostEqual(per_sec, 10.0, places=2)
+        self.assertAlmostEqual(bytes_per_sec, 1000.0, places=0)
+        self.assertEqual((r.count, r.bytes), (50, 5000))
+
+    # Rates cover the current and the previous window only
+    def test_windows(self):
+        r = RateCounter(window=10.0)
+        now = time.time()
+        for i in range(100):
+            r.add(1, now + i * 0.1)
+        for i in range(10):
+            r.add(1, now + 10.5 + i * 0.1)
+        self.assertAlmostEqual(r.rates(now + 15.0)[0], 110 / 15.0, places=2)
+        # A third window drops the first
+        r.add(1, now + 21.0)
+        self.assertAlmostEqual(r.rates(now + 21.0)[0], 11 / 10.5, places=2)
+        self.assertEqual(r.count, 111)
+
+class TestEchoTracker(unittest.TestCase):
+    def test_latency(self):
+        echo = EchoTracker()
+        for i in range(5):
+            echo.sent([0.1 * i] * 6, now=float(i))
+        # Repeats of the last setpoint are not tracked
+        echo.sent([0.4] * 6, now=10.0)
+        self.assertEqual(echo.observed([0.05] * 6, now=5.0), None)
+        self.assertAlmostEqual(echo.observed([0.2] * 6, now=5.0), 3.0)
+        # Older setpoints are forgotten once a newer one is reached
+        self.assertEqual(echo.observed([0.1] * 6, now=6.0), None)
+        self.assertAlmostEqual(echo.observed([0.4] * 6, now=6.0), 2.0)
+        self.assertEqual(echo.observed([0.4] * 6, now=7.0), None)
+
+    def test_capacity(self):
+        echo = EchoTracker(capacity=4)
+        for i in range(10):
+            echo.sent([0.1 * i] * 6, now=float(i))
+        self.assertEqual(echo.observed([0.5] * 6, now=20.0), None)
+        self.assertAlmostEqual(echo.observed([0.6] * 6, now=20.0), 14.0)
+
+    # Setpoints sent on one thread while positions are observed on
+    # another are neither lost nor given each other's times
+    def test_threads(self):
+        echo = EchoTracker(capacity=16)
+        latencies = []
+        done = []
+        last_sent = [0]
+
+        def servo():
+            for i in range(1, 20000):
+                echo.sent([1e-2 * i] * 6, now=float(i))
+                last_sent[0] = i
+            done.append(True)
+
+        # Switches threads as often as possible
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            thread = threading.Thread(target=servo)
+            thread.start()
+            observed = 0
+            while not done:
+                # The newest setpoint that was sent is still pending
+                i = last_sent[0]
+                if i > observed:
+                    latencies.append(echo.observed([1e-2 * i] * 6, now=i + 0.5))
+                    observed = i
+            thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertTrue(latencies)
+        self.assertEqual(latencies, [0.5] * len(latencies))
+
+class TestMetrics(unittest.TestCase):
+    def test_snapshot(self):
+        m = Metrics()
+        m.incr('a')
+        m.incr('a', 2)
+        m.rate('r').add(10)
+        m.histogram('h').add(1e-3)
+        m.add_source('s', lambda: {'x': 1})
+        snapshot = m.snapshot()
+        self.assertEqual(snapshot['a'], 3)
+        self.assertEqual(snapshot['r.count'], 1)
+        self.assertEqual(snapshot['h.count'], 1)
+        self.assertEqual(snapshot['s.x'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import os, sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'ur_driver'))
+try:
+    from publisher import JointStateSnapshot, _Topic
+except ImportError:  # Outside of a ROS environment
+    _Topic = None
+
+# Stands in for a rospy.Publisher, recording what is published
+class RecordingPublisher(object):
+    name = 'joint_states'
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, msg):
+        self.messages.append(msg)
+
+@unittest.skipIf(_Topic is None, "rospy is not available")
+class TestTopic(unittest.TestCase):
+    def offer(self, topic, n, period, t0=1000.0):
+        for i in range(n):
+            topic.offer(i, t0 + i * period)
+        return topic.publisher.messages
+
+    def test_all(self):
+        topic = _Topic(RecordingPublisher(), 0.0, 1)
+        self.assertEqual(self.offer(topic, 10, 0.008), range(10))
+        self.assertEqual((topic.offered, topic.published), (10, 10))
+
+    def test_decimation(self):
+        topic = _Topic(RecordingPublisher(), 0.0, 3)
+        self.assertEqual(self.offer(topic, 10, 0.008), [2, 5, 8])
+        self.assertEqual((topic.offered, topic.published), (10, 3))
+
+    def test_max_rate(self):
+        topic = _Topic(RecordingPublisher(), 10.0, 1)
+        published = self.offer(topic, 125, 0.008)
+        # At most one state per 0.1 s: every 13th at 125 Hz
+        self.assertEqual(published, range(0, 125, 13))
+
+    # Decimation picks the states, and the rate cap thins them further
+    def test_decimation_and_max_rate(self):
+        topic = _Topic(RecordingPublisher(), 50.0, 2)
+        published = self.offer(topic, 20, 0.008)
+        self.assertEqual(published, [1, 5, 9, 13, 17])
+        self.assertEqual(topic.offered, 20)
+
+class Header(object):
+    stamp = 12.5
+
+class Message(object):
+    def __init__(self, q):
+        self.header = Header()
+        self.name = ['a', 'b']
+        self.position = np.array(q, dtype=float)
+        self.velocity = -np.array(q, dtype=float)
+        self.effort = np.zeros(len(q))
+
+@unittest.skipIf(_Topic is None, "rospy is not available")
+class TestJointStateSnapshot(unittest.TestCase):
+    # A snapshot keeps its values when the pooled message is reused
+    def test_copies(self):
+        msg = Message([1.0, 2.0])
+        snapshot = JointStateSnapshot(msg)
+        msg.position[:] = 5.0
+        msg.velocity[:] = 6.0
+        np.testing.assert_array_equal(snapshot.position, [1.0, 2.0])
+        np.testing.assert_array_equal(snapshot.velocity, [-1.0, -2.0])
+        self.assertEqual(snapshot.stamp, 12.5)
+        self.assertEqual(snapshot.name, ['a', 'b'])
+
+if __name__ == '__main__':
+    unittest.main()
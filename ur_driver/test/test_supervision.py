@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+import os, sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'ur_driver'))
+from supervision import Liveness, Backoff, EventSource
+
+PERIOD = 0.008
+
+class TestLiveness(unittest.TestCase):
+    def test_silent_until_first_state(self):
+        liveness = Liveness(0.1)
+        self.assertEqual(liveness.age(5.0), None)
+        self.assertFalse(liveness.expired(5.0))
+
+    # States arriving on time keep the stream alive however long it runs
+    def test_steady_stream(self):
+        liveness = Liveness(0.1)
+        for i in range(10000):
+            now = 100.0 + i * PERIOD
+            liveness.heard(now, i)
+            self.assertFalse(liveness.expired(now + PERIOD))
+        self.assertEqual(liveness.gaps, 0)
+
+    def test_stall_and_recovery(self):
+        liveness = Liveness(0.1)
+        for i in range(10):
+            liveness.heard(i * PERIOD, i)
+        last = 9 * PERIOD
+        self.assertFalse(liveness.expired(last + 0.1))
+        self.assertTrue(liveness.expired(last + 0.1 + 1e-3))
+        self.assertAlmostEqual(liveness.age(last + 0.5), 0.5)
+        # The states held up by the stall arrive together, and the stream
+        # is alive again from the first of them
+        now = last + 0.5
+        for i in range(10, 80):
+            liveness.heard(now, i)
+        self.assertFalse(liveness.expired(now))
+        self.assertEqual(liveness.gaps, 0)
+
+    def test_gaps(self):
+        liveness = Liveness(0.1)
+        self.assertEqual(liveness.heard(0.0, 7), 0)
+        self.assertEqual(liveness.heard(0.008, 8), 0)
+        self.assertEqual(liveness.heard(0.016, 12), 3)
+        self.assertEqual(liveness.heard(0.024, 13), 0)
+        self.assertEqual(liveness.heard(0.032, 15), 1)
+        self.assertEqual(liveness.gaps, 4)
+        self.assertEqual(liveness.last_seq, 15)
+
+    # A stream without sequence numbers is judged by arrival alone
+    def test_without_seq(self):
+        liveness = Liveness(0.1)
+        self.assertEqual(liveness.heard(1.0), 0)
+        self.assertEqual(liveness.heard(1.05), 0)
+        self.assertFalse(liveness.expired(1.15))
+        self.assertTrue(liveness.expired(1.16))
+        self.assertEqual(liveness.gaps, 0)
+
+class TestBackoff(unittest.TestCase):
+    def test_doubles_up_to_maximum(self):
+        backoff = Backoff(initial=1.0, maximum=10.0, jitter=0.0)
+        self.assertEqual([backoff.next() for i in range(6)], [1.0, 2.0, 4.0, 8.0, 10.0, 10.0])
+        self.assertEqual(backoff.attempts, 6)
+        backoff.reset()
+        self.assertEqual(backoff.next(), 1.0)
+
+    def test_jitter_shortens(self):
+        backoff = Backoff(initial=1.0, maximum=4.0, jitter=0.25)
+        for i in range(200):
+            backoff.reset()
+            for nominal in [1.0, 2.0, 4.0, 4.0]:
+                delay = backoff.next()
+                self.assertTrue(0.75 * nominal <= delay <= nominal)
+
+class TestEventSource(unittest.TestCase):
+    def test_listeners(self):
+        events = []
+        source = EventSource()
+        listener = lambda event, details: events.append((event, details['reason']))
+        source.subscribe(listener)
+        source.emit('lost', reason='test')
+        source.unsubscribe(listener)
+        source.emit('lost', reason='again')
+        self.assertEqual(events, [('lost', 'test')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import os, sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'ur_driver'))
+from trajectory import CompiledTrajectory, SetpointTable, splice_table
+
+# A smooth trajectory through n points, dt apart from start
+def make_trajectory(n=200, dt=0.1, start=0.0):
+    times = start + dt * np.arange(n)
+    rates = np.arange(1, 7) * 0.3
+    positions = np.sin(np.outer(times, rates))
+    velocities = np.cos(np.outer(times, rates)) * rates
+    return CompiledTrajectory(times, positions, velocities)
+
+class TestSetpointTable(unittest.TestCase):
+    def test_matches_trajectory_across_windows(self):
+        traj = make_trajectory()
+        table = SetpointTable(traj, 0.008, chunk_size=64)
+        for k in range(len(table)):
+            t = k * table.period
+            expected = traj.sample(min(t, traj.duration))
+            for a, b in zip(table.sample(t), expected):
+                np.testing.assert_allclose(a, b, atol=1e-12)
+
+    def test_sample_many_matches_sample(self):
+        traj = make_trajectory()
+        table = SetpointTable(traj, 0.008, chunk_size=64)
+        ts = np.arange(300, 400) * 0.008
+        q, qd, qdd = table.sample_many(ts)
+        for i, t in enumerate(ts):
+            np.testing.assert_allclose(q[i], traj.sample(t)[0], atol=1e-12)
+
+    # A sample must not change when a later one moves the window (as
+    # on_cancel does, looking ahead from the current setpoint)
+    def test_sample_survives_window_shift(self):
+        traj = make_trajectory()
+        table = SetpointTable(traj, 0.02, chunk_size=64)
+        for k in range(0, len(table) - 25, 7):
+            t = k * table.period
+            q0, qd0, qdd0 = table.sample(t)
+            table.sample(t + 0.5)
+            expected = traj.sample(t)
+            np.testing.assert_allclose(q0, expected[0], atol=1e-12)
+            np.testing.assert_allclose(qd0, expected[1], atol=1e-12)
+            np.testing.assert_allclose(qdd0, expected[2], atol=1e-12)
+
+    # Between setpoints, positions follow the trajectory closely, and
+    # everything is exact where no knot lies between the two setpoints
+    def test_samples_between_setpoints(self):
+        traj = make_trajectory()
+        table = SetpointTable(traj, 0.008, chunk_size=64)
+        for t in np.sort(np.random.RandomState(0).uniform(0.0, traj.duration, 2000)):
+            q, qd, qdd = table.sample(t)
+            expected = traj.sample(t)
+            np.testing.assert_allclose(q, expected[0], atol=1e-8)
+            k = int(t / table.period)
+            knots = traj.times[(traj.times > k * table.period - 1e-9) &
+                               (traj.times < (k + 1) * table.period + 1e-9)]
+            if not len(knots):
+                np.testing.assert_allclose(qd, expected[1], atol=1e-9)
+                np.testing.assert_allclose(qdd, expected[2], atol=1e-9)
+
+    # Ticks jittering around the middle of two setpoints get setpoints
+    # that move as little as the ticks do, instead of alternating
+    # between the two
+    def test_jitter_between_setpoints(self):
+        traj = make_trajectory()
+        table = SetpointTable(traj, 0.008, chunk_size=64)
+        step = np.abs(table.sample(1.008)[0] - table.sample(1.0)[0]).max()
+        t = 1.0 + table.period / 2
+        qs = [table.sample(t + dt)[0] for dt in [-1e-5, 1e-5, -1e-5, 1e-5]]
+        for a, b in zip(qs, qs[1:]):
+            self.assertLess(np.abs(a - b).max(), step / 100)
+
+    def test_sample_ahead_matches_sample_many(self):
+        traj = make_trajectory()
+        table = SetpointTable(traj, 0.008, chunk_size=64)
+        for t in [0.0, 0.0031, 5.5, traj.duration - 0.05, traj.duration - 0.0013,
+                  traj.duration + 1.0]:
+            ts = t + table.period * np.arange(1, 9)
+            for a, b in zip(table.sample_ahead(t, 8), table.sample_many(ts)):
+                np.testing.assert_allclose(a, b, atol=1e-12)
+
+    def test_time_scaling_limits_velocity(self):
+        traj = make_trajectory()
+        table = SetpointTable(traj, 0.008, max_velocity=0.5)
+        self.assertGreater(table.time_scale, 1.0)
+        ts = np.arange(len(table)) * table.period
+        qd = np.vstack([table.sample_many(ts[i:i + 512])[1] for i in range(0, len(ts), 512)])
+        self.assertLessEqual(np.abs(qd).max(), 0.5 + 1e-9)
+        np.testing.assert_allclose(table.sample(table.duration)[0], traj.positions[-1])
+
+class TestSplicing(unittest.TestCase):
+    q = np.array([0.1, -0.2, 0.3, -0.4, 0.5, -0.6])
+    qd = np.array([0.5, -0.3, 0.2, 0.0, 0.1, -0.5])
+    qdd = np.array([0.2, 0.0, -0.1, 0.3, 0.0, 0.1])
+
+    def test_starts_from_setpoint(self):
+        traj = make_trajectory(20, start=0.5)
+        spliced = traj.spliced(self.q, self.qd, self.qdd)
+        self.assertEqual(len(spliced), len(traj))
+        for a, b in zip(spliced.sample(0.0), (self.q, self.qd, self.qdd)):
+            np.testing.assert_allclose(a, b)
+        # Continuous into the cubic to the first point...
+        q, qd, qdd = spliced.sample(1e-6)
+        np.testing.assert_allclose(q, self.q, atol=1e-5)
+        np.testing.assert_allclose(qd, self.qd, atol=1e-4)
+        # ...and then follows the trajectory
+        t = traj.times[5] + 0.03
+        for a, b in zip(spliced.sample(t), traj.sample(t)):
+            np.testing.assert_allclose(a, b)
+        # The original is unchanged
+        np.testing.assert_allclose(traj.sample(0.0)[0], traj.positions[0])
+
+    def test_batch_matches_sample(self):
+        spliced = make_trajectory(20, 0.2, 0.5).spliced(self.q, self.qd, self.qdd)
+        ts = np.linspace(-0.1, spliced.duration + 0.1, 97)
+        q, qd, qdd = spliced.sample_many(ts)
+        for i, t in enumerate(ts):
+            for a, b in zip((q[i], qd[i], qdd[i]), spliced.sample(t)):
+                np.testing.assert_allclose(a, b, atol=1e-12)
+
+    # With time scaling, the table starts from the setpoint (in wall-clock
+    # time) and stays within the limits
+    def test_scaled_table_is_continuous(self):
+        traj = make_trajectory(20, 0.02, 0.1)  # Far too fast
+        table = splice_table(traj, self.q, self.qd, self.qdd, 0.008, 1.0, 5.0)
+        self.assertGreater(table.time_scale, 4.0)
+        q, qd, qdd = table.sample(0.0)
+        np.testing.assert_allclose(q, self.q)
+        np.testing.assert_allclose(qd, self.qd)
+        np.testing.assert_allclose(qdd, self.qdd)
+        q1, qd1, qdd1 = table.sample(table.period)
+        self.assertLess(np.abs(qd1 - self.qd).max(), 10.0 * table.period)
+        qd = table.sample_many(np.arange(len(table)) * table.period)[1]
+        self.assertLessEqual(np.abs(qd).max(), 1.0 + 1e-3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import os, sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'ur_driver'))
+from trajectory import InvalidTrajectory, validate_trajectory
+
+JOINT_NAMES = ['shoulder_pan_joint', 'shoulder_lift_joint', 'elbow_joint',
+               'wrist_1_joint', 'wrist_2_joint', 'wrist_3_joint']
+
+# Stand-ins for the JointTrajectory message fields validate_trajectory()
+# reads
+class Duration(object):
+    def __init__(self, secs):
+        self.secs = secs
+    def to_sec(self):
+        return self.secs
+
+class Point(object):
+    def __init__(self, positions, velocities, t, accelerations=()):
+        self.positions = list(positions)
+        self.velocities = list(velocities)
+        self.accelerations = list(accelerations)
+        self.time_from_start = Duration(t)
+
+class Trajectory(object):
+    def __init__(self, joint_names, points):
+        self.joint_names = joint_names
+        self.points = points
+
+def validate(traj):
+    return validate_trajectory(traj, JOINT_NAMES, 3.0, (-2 * np.pi, 2 * np.pi))
+
+class TestValidateTrajectory(unittest.TestCase):
+    def test_reorders_joints(self):
+        order = [2, 0, 1, 5, 3, 4]
+        q = np.arange(6) * 0.1
+        traj = Trajectory([JOINT_NAMES[j] for j in order],
+                          [Point(q[order], np.zeros(6), 1.0, q[order])])
+        times, positions, velocities, accelerations = validate(traj)
+        np.testing.assert_allclose(times, [1.0])
+        np.testing.assert_allclose(positions[0], q)
+        np.testing.assert_allclose(accelerations[0], q)
+
+    def test_missing_accelerations_are_zero(self):
+        traj = Trajectory(JOINT_NAMES, [Point(np.zeros(6), np.zeros(6), 0.5),
+                                        Point(np.ones(6), np.zeros(6), 1.0, np.ones(6))])
+        accelerations = validate(traj)[3]
+        np.testing.assert_allclose(accelerations, [np.zeros(6), np.ones(6)])
+
+    def assertInvalid(self, traj):
+        self.assertRaises(InvalidTrajectory, validate, traj)
+
+    def test_empty_goal(self):
+        self.assertInvalid(Trajectory(JOINT_NAMES, []))
+
+    def test_wrong_joint_names(self):
+        self.assertInvalid(Trajectory(JOINT_NAMES[:5] + ['x'], [Point(np.zeros(6), np.zeros(6), 1.0)]))
+
+    def test_wrong_sizes(self):
+        self.assertInvalid(Trajectory(JOINT_NAMES, [Point(np.zeros(5), np.zeros(5), 1.0)]))
+        self.assertInvalid(Trajectory(JOINT_NAMES, [Point(np.zeros(6), np.zeros(6), 0.5),
+                                                    Point(np.zeros(5), np.zeros(6), 1.0)]))
+
+    def test_missing_velocities(self):
+        self.assertInvalid(Trajectory(JOINT_NAMES, [Point(np.zeros(6), [], 1.0)]))
+
+    def test_non_finite(self):
+        self.assertInvalid(Trajectory(JOINT_NAMES, [Point([np.nan] + [0.0] * 5, np.zeros(6), 1.0)]))
+
+    def test_limits(self):
+        self.assertInvalid(Trajectory(JOINT_NAMES, [Point(np.zeros(6), [4.0] + [0.0] * 5, 1.0)]))
+        self.assertInvalid(Trajectory(JOINT_NAMES, [Point([7.0] + [0.0] * 5, np.zeros(6), 1.0)]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -44,26 +44,6 @@
 #define SIGN(x) ( ( (x) > 0 ) - ( (x) < 0 ) )
 #define PI M_PI
 
-//#define UR10_PARAMS
-#ifdef UR10_PARAMS
-#define d1  0.1273
-#define a2 -0.612
-#define a3 -0.5723
-#define d4  0.163941
-#define d5  0.1157
-#define d6  0.0922
-#endif
-
-//#define UR5_PARAMS
-#ifdef UR5_PARAMS
-#define d1  0.089159
-#define a2 -0.42500
-#define a3 -0.39225
-#define d4  0.10915
-#define d5  0.09465
-#define d6  0.0823
-#endif
-
 // These kinematics find the tranfrom from the base link to the end effector.
 // Though the raw D-H parameters specify a transform from the 0th link to the 6th link,
 // offset transforms are specified in this formulation.
@@ -82,16 +62,147 @@
 //  0,  0,  0,  1
 
 namespace ur_kinematics {
-  // @param q       The 6 joint values 
-  // @param T       The 4x4 end effector pose in row-major ordering
+  // Flags of the samples of Kinematics::inverse_path
+  enum PathStatus {
+    PATH_OK = 0,
+    PATH_BRANCH_CHANGED = 1,  // The solution is on another branch than the previous one
+    PATH_SINGULAR = 2,        // Two branches are within the singularity threshold
+    PATH_UNREACHABLE = 4,     // No solution (the joint values are NaN)
+    PATH_JUMP = 8             // A joint moved more than max_step since the previous sample
+  };
+
+  // Forward and inverse kinematics of a UR arm with the given D-H parameters
+  // (d1, a2, a3, d4, d5, d6; the others are zero).  Any UR model, and
+  // calibrated parameters, can be used; UR5() and UR10() have the nominal
+  // parameters of those models.  All methods are const, so one object can
+  // be used from several threads at once.
+  class Kinematics {
+  public:
+    Kinematics(double d1, double a2, double a3, double d4, double d5, double d6);
+
+    static Kinematics UR5();
+    static Kinematics UR10();
+
+    // @param q       The 6 joint values 
+    // @param T       The 4x4 end effector pose in row-major ordering
+    void forward(const double* q, double* T) const;
+
+    // @param T       The 4x4 end effector pose in row-major ordering
+    // @param q_sols  An 8x6 array of doubles returned, all angles should be in [0,2*PI)
+    // @param q6_des  An optional parameter which designates what the q6 value should take
+    //                in case of an infinite solution on that joint.
+    // @return        Number of solutions found (maximum of 8)
+    int inverse(const double* T, double* q_sols, double q6_des=0.0) const;
+
+    // Batched versions of the above, for many poses at once.  Separate
+    // ranges of a batch can be computed on separate threads.
+
+    // @param q       n sets of 6 joint values, one after the other
+    // @param T       n 4x4 end effector poses in row-major ordering, returned
+    // @param n       Number of poses
+    void forward_batch(const double* q, double* T, int n) const;
+
+    // @param T        n 4x4 end effector poses in row-major ordering
+    // @param q_sols   An n x 8 x 6 array of doubles returned; the rows past
+    //                 each pose's number of solutions are set to NaN
+    // @param num_sols The n numbers of solutions found, returned
+    // @param n        Number of poses
+    // @param q6_des   An optional array of n values of q6 for the infinite
+    //                 solution case (see inverse); 0.0 for all if NULL
+    void inverse_batch(const double* T, double* q_sols, int* num_sols, int n,
+                       const double* q6_des=NULL) const;
+
+    // Finds the inverse kinematics solution nearest to a seed configuration.
+    // Every joint of every solution is wrapped by multiples of 2*PI to the
+    // value within the joint limits nearest to the seed; the solution with
+    // the least weighted squared distance to the seed is returned.
+    // @param T       The 4x4 end effector pose in row-major ordering
+    // @param q_seed  The 6 joint values to stay near to; q_seed[5] is also
+    //                used for q6 in case of an infinite solution
+    // @param q_sol   The 6 joint values of the nearest solution, returned;
+    //                set to NaN if there is none
+    // @param weights Optional 6 weights of the joint distances (1.0 if NULL)
+    // @param limits  Optional 2x6 lower and upper joint limits, in row-major
+    //                ordering ([-2*PI, 2*PI] if NULL)
+    // @return        Whether a solution within the limits was found
+    bool inverse_nearest(const double* T, const double* q_seed, double* q_sol,
+                         const double* weights=NULL, const double* limits=NULL) const;
+
+    // @param T       n 4x4 end effector poses in row-major ordering
+    // @param q_seed  n sets of 6 seed joint values
+    // @param q_sols  n sets of 6 joint values, returned (see inverse_nearest)
+    // @param found   n flags of whether a solution was found, returned
+    // @param n       Number of poses
+    void inverse_nearest_batch(const double* T, const double* q_seed, double* q_sols,
+                               bool* found, int n, const double* weights=NULL,
+                               const double* limits=NULL) const;
+
+    // Solves the inverse kinematics along a densely sampled path, staying
+    // on one branch (shoulder, elbow and wrist configuration) for as long
+    // as it is possible.  The branch is that of q_start; every sample is
+    // solved for that branch only, and wrapped by multiples of 2*PI to be
+    // continuous with the previous sample.  Only when the branch has no
+    // solution, or its solution moves a joint by more than max_step, are
+    // all branches solved and the nearest solution taken.
+    // @param T        n 4x4 end effector poses in row-major ordering
+    // @param n        Number of poses
+    // @param q_start  The 6 joint values the path starts from (e.g. the
+    //                 last solution of the previous part of the path)
+    // @param q_path   n sets of 6 joint values, returned
+    // @param status   n combinations of PathStatus flags, returned
+    // @param branches Optional n branch indices, returned: shoulder*4 +
+    //                 wrist*2 + elbow (the order of inverse's solutions
+    //                 when there are 8), -1 when unreachable
+    // @param max_step        Largest joint change between samples (rad)
+    // @param singular_thresh Samples whose branch is closer than this to
+    //                        another one are flagged PATH_SINGULAR; the
+    //                        closeness is the sine of half the angle
+    //                        between the two values of a joint
+    // @return         The index of the first sample that is not PATH_OK,
+    //                 or n if there is none
+    int inverse_path(const double* T, int n, const double* q_start, double* q_path,
+                     int* status, int* branches=NULL, double max_step=0.5,
+                     double singular_thresh=0.01) const;
+
+    const double d1, a2, a3, d4, d5, d6;
+
+  private:
+    // Terms of the inverse kinematics that only depend on the parameters
+    const double d4_sq, a2_sq_a3_sq, two_a2_a3;
+
+    // The steps of the inverse kinematics, which inverse() takes for every
+    // branch and inverse_path() for one
+    struct Pose;
+    bool solve_shoulder(const Pose& P, double* q1) const;
+    void solve_wrist_2(const Pose& P, double q1, double* q5) const;
+    double solve_wrist_3(const Pose& P, double q1, double q5, double q6_des) const;
+    bool solve_rrr(const Pose& P, double q1, double q5, double q6,
+                   double* q2, double* q3, double* q4) const;
+    bool inverse_branch(const Pose& P, int branch, double q6_des, double* q,
+                        double* separation) const;
+    int nearest_branch(const Pose& P, const double* q_near, double* q, 
+                       double* separation) const;
+  };
+
+  // The functions below use the parameters of the robot the library they
+  // are linked from was built for (ur5_kin or ur10_kin); see Kinematics
+  // for their documentation.
+
   void forward(const double* q, double* T);
 
-  // @param T       The 4x4 end effector pose in row-major ordering
-  // @param q_sols  An 8x6 array of doubles returned, all angles should be in [0,2*PI)
-  // @param q6_des  An optional parameter which designates what the q6 value should take
-  //                in case of an infinite solution on that joint.
-  // @return        Number of solutions found (maximum of 8)
   int inverse(const double* T, double* q_sols, double q6_des=0.0);
+
+  void forward_batch(const double* q, double* T, int n);
+
+  void inverse_batch(const double* T, double* q_sols, int* num_sols, int n,
+                     const double* q6_des=NULL);
+
+  bool inverse_nearest(const double* T, const double* q_seed, double* q_sol,
+                       const double* weights=NULL, const double* limits=NULL);
+
+  void inverse_nearest_batch(const double* T, const double* q_seed, double* q_sols,
+                             bool* found, int n, const double* weights=NULL,
+                             const double* limits=NULL);
 };
 
 #endif //UR_KIN_H
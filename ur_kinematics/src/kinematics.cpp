@@ -0,0 +1,391 @@
+#include <ur_kinematics/ur_kin.h>
+#include <algorithm>
+
+namespace ur_kinematics {
+
+  Kinematics::Kinematics(double d1, double a2, double a3, double d4, double d5, double d6)
+    : d1(d1), a2(a2), a3(a3), d4(d4), d5(d5), d6(d6),
+      d4_sq(d4*d4), a2_sq_a3_sq(a2*a2 + a3*a3), two_a2_a3(2.0*a2*a3) {
+  }
+
+  Kinematics Kinematics::UR5() {
+    return Kinematics(0.089159, -0.42500, -0.39225, 0.10915, 0.09465, 0.0823);
+  }
+
+  Kinematics Kinematics::UR10() {
+    return Kinematics(0.1273, -0.612, -0.5723, 0.163941, 0.1157, 0.0922);
+  }
+
+  void Kinematics::forward(const double* q, double* T) const {
+    double s1 = sin(*q), c1 = cos(*q); q++;
+    double q234 = *q, s2 = sin(*q), c2 = cos(*q); q++;
+    double s3 = sin(*q), c3 = cos(*q); q234 += *q; q++;
+    q234 += *q; q++;
+    double s5 = sin(*q), c5 = cos(*q); q++;
+    double s6 = sin(*q), c6 = cos(*q); 
+    double s234 = sin(q234), c234 = cos(q234);
+    *T = ((c1*c234-s1*s234)*s5)/2.0 - c5*s1 + ((c1*c234+s1*s234)*s5)/2.0; T++;
+    *T = (c6*(s1*s5 + ((c1*c234-s1*s234)*c5)/2.0 + ((c1*c234+s1*s234)*c5)/2.0) - 
+          (s6*((s1*c234+c1*s234) - (s1*c234-c1*s234)))/2.0); T++;
+    *T = (-(c6*((s1*c234+c1*s234) - (s1*c234-c1*s234)))/2.0 - 
+          s6*(s1*s5 + ((c1*c234-s1*s234)*c5)/2.0 + ((c1*c234+s1*s234)*c5)/2.0)); T++;
+    *T = ((d5*(s1*c234-c1*s234))/2.0 - (d5*(s1*c234+c1*s234))/2.0 - 
+          d4*s1 + (d6*(c1*c234-s1*s234)*s5)/2.0 + (d6*(c1*c234+s1*s234)*s5)/2.0 - 
+          a2*c1*c2 - d6*c5*s1 - a3*c1*c2*c3 + a3*c1*s2*s3); T++;
+    *T = c1*c5 + ((s1*c234+c1*s234)*s5)/2.0 + ((s1*c234-c1*s234)*s5)/2.0; T++;
+    *T = (c6*(((s1*c234+c1*s234)*c5)/2.0 - c1*s5 + ((s1*c234-c1*s234)*c5)/2.0) + 
+          s6*((c1*c234-s1*s234)/2.0 - (c1*c234+s1*s234)/2.0)); T++;
+    *T = (c6*((c1*c234-s1*s234)/2.0 - (c1*c234+s1*s234)/2.0) - 
+          s6*(((s1*c234+c1*s234)*c5)/2.0 - c1*s5 + ((s1*c234-c1*s234)*c5)/2.0)); T++;
+    *T = ((d5*(c1*c234-s1*s234))/2.0 - (d5*(c1*c234+s1*s234))/2.0 + d4*c1 + 
+          (d6*(s1*c234+c1*s234)*s5)/2.0 + (d6*(s1*c234-c1*s234)*s5)/2.0 + d6*c1*c5 - 
+          a2*c2*s1 - a3*c2*c3*s1 + a3*s1*s2*s3); T++;
+    *T = ((c234*c5-s234*s5)/2.0 - (c234*c5+s234*s5)/2.0); T++;
+    *T = ((s234*c6-c234*s6)/2.0 - (s234*c6+c234*s6)/2.0 - s234*c5*c6); T++;
+    *T = (s234*c5*s6 - (c234*c6+s234*s6)/2.0 - (c234*c6-s234*s6)/2.0); T++;
+    *T = (d1 + (d6*(c234*c5-s234*s5))/2.0 + a3*(s2*c3+c2*s3) + a2*s2 - 
+         (d6*(c234*c5+s234*s5))/2.0 - d5*c234); T++;
+    *T = 0.0; T++; *T = 0.0; T++; *T = 0.0; T++; *T = 1.0;
+  }
+
+  // The elements of a pose that the inverse kinematics use, with the
+  // base and end effector offset transforms applied
+  struct Kinematics::Pose {
+    double T00, T01, T02, T03, T10, T11, T12, T13, T20, T21, T22, T23;
+
+    Pose(const double* T) {
+      T02 = -*T; T++; T00 =  *T; T++; T01 =  *T; T++; T03 = -*T; T++; 
+      T12 = -*T; T++; T10 =  *T; T++; T11 =  *T; T++; T13 = -*T; T++; 
+      T22 =  *T; T++; T20 = -*T; T++; T21 = -*T; T++; T23 =  *T;
+    }
+  };
+
+  ////////////////////////////// shoulder rotate joint (q1) //////////////////////////////
+  bool Kinematics::solve_shoulder(const Pose& P, double* q1) const {
+    double A = d6*P.T12 - P.T13;
+    double B = d6*P.T02 - P.T03;
+    double R = A*A + B*B;
+    if(fabs(A) < ZERO_THRESH) {
+      double div;
+      if(fabs(fabs(d4) - fabs(B)) < ZERO_THRESH)
+        div = -SIGN(d4)*SIGN(B);
+      else
+        div = -d4/B;
+      double arcsin = asin(div);
+      if(fabs(arcsin) < ZERO_THRESH)
+        arcsin = 0.0;
+      if(arcsin < 0.0)
+        q1[0] = arcsin + 2.0*PI;
+      else
+        q1[0] = arcsin;
+      q1[1] = PI - arcsin;
+    }
+    else if(fabs(B) < ZERO_THRESH) {
+      double div;
+      if(fabs(fabs(d4) - fabs(A)) < ZERO_THRESH)
+        div = SIGN(d4)*SIGN(A);
+      else
+        div = d4/A;
+      double arccos = acos(div);
+      q1[0] = arccos;
+      q1[1] = 2.0*PI - arccos;
+    }
+    else if(d4_sq > R) {
+      return false;
+    }
+    else {
+      double arccos = acos(d4 / sqrt(R)) ;
+      double arctan = atan2(-B, A);
+      double pos = arccos + arctan;
+      double neg = -arccos + arctan;
+      if(fabs(pos) < ZERO_THRESH)
+        pos = 0.0;
+      if(fabs(neg) < ZERO_THRESH)
+        neg = 0.0;
+      if(pos >= 0.0)
+        q1[0] = pos;
+      else
+        q1[0] = 2.0*PI + pos;
+      if(neg >= 0.0)
+        q1[1] = neg; 
+      else
+        q1[1] = 2.0*PI + neg;
+    }
+    return true;
+  }
+  ////////////////////////////////////////////////////////////////////////////////
+
+  ////////////////////////////// wrist 2 joint (q5) //////////////////////////////
+  void Kinematics::solve_wrist_2(const Pose& P, double q1, double* q5) const {
+    double numer = (P.T03*sin(q1) - P.T13*cos(q1)-d4);
+    double div;
+    if(fabs(fabs(numer) - fabs(d6)) < ZERO_THRESH)
+      div = SIGN(numer) * SIGN(d6);
+    else
+      div = numer / d6;
+    double arccos = acos(div);
+    q5[0] = arccos;
+    q5[1] = 2.0*PI - arccos;
+  }
+  ////////////////////////////////////////////////////////////////////////////////
+
+  ////////////////////////////// wrist 3 joint (q6) //////////////////////////////
+  double Kinematics::solve_wrist_3(const Pose& P, double q1, double q5, double q6_des) const {
+    double c1 = cos(q1), s1 = sin(q1);
+    double s5 = sin(q5);
+    double q6;
+    if(fabs(s5) < ZERO_THRESH)
+      q6 = q6_des;
+    else {
+      q6 = atan2(SIGN(s5)*-(P.T01*s1 - P.T11*c1), 
+                 SIGN(s5)*(P.T00*s1 - P.T10*c1));
+      if(fabs(q6) < ZERO_THRESH)
+        q6 = 0.0;
+      if(q6 < 0.0)
+        q6 += 2.0*PI;
+    }
+    return q6;
+  }
+  ////////////////////////////////////////////////////////////////////////////////
+
+  ///////////////////////////// RRR joints (q2,q3,q4) ////////////////////////////
+  bool Kinematics::solve_rrr(const Pose& P, double q1, double q5, double q6,
+                             double* q2, double* q3, double* q4) const {
+    double c1 = cos(q1), s1 = sin(q1);
+    double c5 = cos(q5), s5 = sin(q5);
+    double c6 = cos(q6), s6 = sin(q6);
+    double x04x = -s5*(P.T02*c1 + P.T12*s1) - c5*(s6*(P.T01*c1 + P.T11*s1) - c6*(P.T00*c1 + P.T10*s1));
+    double x04y = c5*(P.T20*c6 - P.T21*s6) - P.T22*s5;
+    double p13x = d5*(s6*(P.T00*c1 + P.T10*s1) + c6*(P.T01*c1 + P.T11*s1)) - d6*(P.T02*c1 + P.T12*s1) + 
+                  P.T03*c1 + P.T13*s1;
+    double p13y = P.T23 - d1 - d6*P.T22 + d5*(P.T21*c6 + P.T20*s6);
+
+    double c3 = (p13x*p13x + p13y*p13y - a2_sq_a3_sq) / two_a2_a3;
+    if(fabs(fabs(c3) - 1.0) < ZERO_THRESH)
+      c3 = SIGN(c3);
+    else if(fabs(c3) > 1.0) {
+      // TODO NO SOLUTION
+      return false;
+    }
+    double arccos = acos(c3);
+    q3[0] = arccos;
+    q3[1] = 2.0*PI - arccos;
+    double denom = a2_sq_a3_sq + two_a2_a3*c3;
+    double s3 = sin(arccos);
+    double A = (a2 + a3*c3), B = a3*s3;
+    q2[0] = atan2((A*p13y - B*p13x) / denom, (A*p13x + B*p13y) / denom);
+    q2[1] = atan2((A*p13y + B*p13x) / denom, (A*p13x - B*p13y) / denom);
+    double c23_0 = cos(q2[0]+q3[0]);
+    double s23_0 = sin(q2[0]+q3[0]);
+    double c23_1 = cos(q2[1]+q3[1]);
+    double s23_1 = sin(q2[1]+q3[1]);
+    q4[0] = atan2(c23_0*x04y - s23_0*x04x, x04x*c23_0 + x04y*s23_0);
+    q4[1] = atan2(c23_1*x04y - s23_1*x04x, x04x*c23_1 + x04y*s23_1);
+    for(int k=0;k<2;k++) {
+      if(fabs(q2[k]) < ZERO_THRESH)
+        q2[k] = 0.0;
+      else if(q2[k] < 0.0) q2[k] += 2.0*PI;
+      if(fabs(q4[k]) < ZERO_THRESH)
+        q4[k] = 0.0;
+      else if(q4[k] < 0.0) q4[k] += 2.0*PI;
+    }
+    return true;
+  }
+  ////////////////////////////////////////////////////////////////////////////////
+
+  int Kinematics::inverse(const double* T, double* q_sols, double q6_des) const {
+    int num_sols = 0;
+    Pose P(T);
+    double q1[2];
+    if(!solve_shoulder(P, q1))
+      return num_sols;
+    double q5[2][2];
+    for(int i=0;i<2;i++)
+      solve_wrist_2(P, q1[i], q5[i]);
+
+    for(int i=0;i<2;i++) {
+      for(int j=0;j<2;j++) {
+        double q6 = solve_wrist_3(P, q1[i], q5[i][j], q6_des);
+        double q2[2], q3[2], q4[2];
+        if(!solve_rrr(P, q1[i], q5[i][j], q6, q2, q3, q4))
+          continue;
+        for(int k=0;k<2;k++) {
+          q_sols[num_sols*6+0] = q1[i];    q_sols[num_sols*6+1] = q2[k]; 
+          q_sols[num_sols*6+2] = q3[k];    q_sols[num_sols*6+3] = q4[k]; 
+          q_sols[num_sols*6+4] = q5[i][j]; q_sols[num_sols*6+5] = q6; 
+          num_sols++;
+        }
+      }
+    }
+    return num_sols;
+  }
+
+  // Wraps q by a multiple of 2*PI to the value nearest to q_near
+  static double unwrap(double q, double q_near) {
+    return q + 2.0*PI*round((q_near - q) / (2.0*PI));
+  }
+
+  // Solves one branch (see inverse_path).  separation is how close the
+  // solution is to the neighbouring branches: the least of the sines of
+  // half the angles between the two shoulder, wrist 2 and elbow values.
+  bool Kinematics::inverse_branch(const Pose& P, int branch, double q6_des, double* q,
+                                  double* separation) const {
+    int i = (branch >> 2) & 1, j = (branch >> 1) & 1, k = branch & 1;
+    double q1[2], q5[2], q2[2], q3[2], q4[2];
+    if(!solve_shoulder(P, q1))
+      return false;
+    solve_wrist_2(P, q1[i], q5);
+    double q6 = solve_wrist_3(P, q1[i], q5[j], q6_des);
+    if(!solve_rrr(P, q1[i], q5[j], q6, q2, q3, q4))
+      return false;
+    q[0] = q1[i]; q[1] = q2[k]; q[2] = q3[k]; q[3] = q4[k]; q[4] = q5[j]; q[5] = q6;
+    *separation = std::min(fabs(sin((q1[0] - q1[1]) / 2.0)), 
+                           std::min(fabs(sin(q5[j])), fabs(sin(q3[k]))));
+    return true;
+  }
+
+  // Solves every branch and returns the one whose solution (unwrapped) is
+  // nearest to q_near, or -1 if there is none
+  int Kinematics::nearest_branch(const Pose& P, const double* q_near, double* q,
+                                 double* separation) const {
+    int best = -1;
+    double best_dist = INFINITY;
+    for(int branch=0;branch<8;branch++) {
+      double q_branch[6], sep, dist = 0.0;
+      if(!inverse_branch(P, branch, q_near[5], q_branch, &sep))
+        continue;
+      for(int j=0;j<6;j++) {
+        q_branch[j] = unwrap(q_branch[j], q_near[j]);
+        dist += (q_branch[j] - q_near[j])*(q_branch[j] - q_near[j]);
+      }
+      // NaNs (no wrist solution) are never less
+      if(dist < best_dist) {
+        best = branch;
+        best_dist = dist;
+        *separation = sep;
+        for(int j=0;j<6;j++)
+          q[j] = q_branch[j];
+      }
+    }
+    return best;
+  }
+
+  int Kinematics::inverse_path(const double* T, int n, const double* q_start, double* q_path,
+                               int* status, int* branches, double max_step,
+                               double singular_thresh) const {
+    double q_prev[6], q[6], sep;
+    for(int j=0;j<6;j++)
+      q_prev[j] = q_start[j];
+    double T_start[16];
+    forward(q_start, T_start);
+    int branch = nearest_branch(Pose(T_start), q_start, q, &sep);
+
+    int first_flagged = n;
+    for(int s=0;s<n;s++) {
+      Pose P(T + s*16);
+      int flags = PATH_OK;
+      bool tracked = branch >= 0 && inverse_branch(P, branch, q_prev[5], q, &sep);
+      for(int j=0;j<6 && tracked;j++) {
+        q[j] = unwrap(q[j], q_prev[j]);
+        tracked = fabs(q[j] - q_prev[j]) <= max_step;  // Also false for NaN
+      }
+      if(!tracked) {
+        int nearest = nearest_branch(P, q_prev, q, &sep);
+        if(nearest < 0)
+          flags = PATH_UNREACHABLE;
+        else {
+          if(nearest != branch)
+            flags |= PATH_BRANCH_CHANGED;
+          for(int j=0;j<6;j++)
+            if(fabs(q[j] - q_prev[j]) > max_step)
+              flags |= PATH_JUMP;
+          branch = nearest;
+        }
+      }
+
+      double* q_out = q_path + s*6;
+      if(flags & PATH_UNREACHABLE) {
+        for(int j=0;j<6;j++)
+          q_out[j] = NAN;
+      }
+      else {
+        if(sep < singular_thresh)
+          flags |= PATH_SINGULAR;
+        for(int j=0;j<6;j++)
+          q_out[j] = q_prev[j] = q[j];
+      }
+      status[s] = flags;
+      if(branches)
+        branches[s] = (flags & PATH_UNREACHABLE) ? -1 : branch;
+      if(flags != PATH_OK && first_flagged == n)
+        first_flagged = s;
+    }
+    return first_flagged;
+  }
+
+  void Kinematics::forward_batch(const double* q, double* T, int n) const {
+    for(int i=0;i<n;i++)
+      forward(q + i*6, T + i*16);
+  }
+
+  void Kinematics::inverse_batch(const double* T, double* q_sols, int* num_sols, int n,
+                                 const double* q6_des) const {
+    for(int i=0;i<n;i++) {
+      double* sols = q_sols + i*8*6;
+      num_sols[i] = inverse(T + i*16, sols, q6_des ? q6_des[i] : 0.0);
+      for(int j=num_sols[i]*6;j<8*6;j++)
+        sols[j] = NAN;
+    }
+  }
+
+  // Wraps q by a multiple of 2*PI to the value nearest to q_seed within
+  // [lower, upper].  Returns false if no multiple is within the limits.
+  static bool wrap_nearest(double q, double q_seed, double lower, double upper, 
+                           double* q_wrapped) {
+    q += 2.0*PI*round((q_seed - q) / (2.0*PI));
+    if(q < lower)
+      q += 2.0*PI*ceil((lower - q) / (2.0*PI));
+    else if(q > upper)
+      q -= 2.0*PI*ceil((q - upper) / (2.0*PI));
+    *q_wrapped = q;
+    return q >= lower && q <= upper;
+  }
+
+  bool Kinematics::inverse_nearest(const double* T, const double* q_seed, double* q_sol,
+                                   const double* weights, const double* limits) const {
+    double q_sols[8*6];
+    int num_sols = inverse(T, q_sols, q_seed[5]);
+    double best_dist = INFINITY;
+    for(int i=0;i<num_sols;i++) {
+      double q[6], dist = 0.0;
+      bool valid = true;
+      for(int j=0;j<6 && valid;j++) {
+        double lower = limits ? limits[j] : -2.0*PI;
+        double upper = limits ? limits[6+j] : 2.0*PI;
+        valid = wrap_nearest(q_sols[i*6+j], q_seed[j], lower, upper, &q[j]);
+        double diff = (weights ? weights[j] : 1.0) * (q[j] - q_seed[j]);
+        dist += diff*diff;
+        // Gives up on a solution as soon as it can't be the nearest
+        valid = valid && dist < best_dist;
+      }
+      if(valid) {
+        best_dist = dist;
+        for(int j=0;j<6;j++)
+          q_sol[j] = q[j];
+      }
+    }
+    if(best_dist == INFINITY) {
+      for(int j=0;j<6;j++)
+        q_sol[j] = NAN;
+      return false;
+    }
+    return true;
+  }
+
+  void Kinematics::inverse_nearest_batch(const double* T, const double* q_seed,
+                                         double* q_sols, bool* found, int n,
+                                         const double* weights, const double* limits) const {
+    for(int i=0;i<n;i++)
+      found[i] = inverse_nearest(T + i*16, q_seed + i*6, q_sols + i*6, weights, limits);
+  }
+};
@@ -38,13 +38,15 @@
 
 #include <boost/numpy.hpp>
 #include <boost/scoped_array.hpp>
+#include <algorithm>
+#include <vector>
 
 #include <ur_kinematics/ur_kin.h>
 
 namespace p = boost::python;
 namespace np = boost::numpy;
 
-np::ndarray forward_wrapper(np::ndarray const & q_arr) {
+np::ndarray forward_wrapper(ur_kinematics::Kinematics const & kin, np::ndarray const & q_arr) {
   if(q_arr.get_dtype() != np::dtype::get_builtin<double>()) {
     PyErr_SetString(PyExc_TypeError, "Incorrect array data type");
     p::throw_error_already_set();
@@ -59,12 +61,12 @@ np::ndarray forward_wrapper(np::ndarray const & q_arr) {
   }
   Py_intptr_t shape[2] = { 4, 4 };
   np::ndarray result = np::zeros(2,shape,np::dtype::get_builtin<double>()); 
-  ur_kinematics::forward(reinterpret_cast<double*>(q_arr.get_data()), 
-                         reinterpret_cast<double*>(result.get_data()));
+  kin.forward(reinterpret_cast<double*>(q_arr.get_data()), 
+              reinterpret_cast<double*>(result.get_data()));
   return result;
 }
 
-np::ndarray inverse_wrapper(np::ndarray const & array, PyObject * q6_des_py) {
+np::ndarray inverse_wrapper(ur_kinematics::Kinematics const & kin, np::ndarray const & array, PyObject * q6_des_py) {
   if(array.get_dtype() != np::dtype::get_builtin<double>()) {
     PyErr_SetString(PyExc_TypeError, "Incorrect array data type");
     p::throw_error_already_set();
@@ -78,15 +80,305 @@ np::ndarray inverse_wrapper(np::ndarray const & array, PyObject * q6_des_py) {
     p::throw_error_already_set();
   }
   double* T = reinterpret_cast<double*>(array.get_data());
-  double* q_sols = (double*) malloc(8*6*sizeof(double));
+  double q_sols[8*6];
   double q6_des = PyFloat_AsDouble(q6_des_py);
-  int num_sols = ur_kinematics::inverse(T, q_sols, q6_des);
-  q_sols = (double*) realloc(q_sols, num_sols*6*sizeof(double));
-  return np::from_data(q_sols, np::dtype::get_builtin<double>() , p::make_tuple(num_sols, 6), p::make_tuple(6*sizeof(double), sizeof(double)), p::object());
+  int num_sols = kin.inverse(T, q_sols, q6_des);
+  Py_intptr_t shape[2] = { num_sols, 6 };
+  np::ndarray result = np::empty(2,shape,np::dtype::get_builtin<double>());
+  std::copy(q_sols, q_sols + num_sols*6, reinterpret_cast<double*>(result.get_data()));
+  return result;
+}
+
+// Releases the GIL for its lifetime; no Python objects may be touched
+// while it exists.
+class ScopedGILRelease {
+public:
+  ScopedGILRelease() { state_ = PyEval_SaveThread(); }
+  ~ScopedGILRelease() { PyEval_RestoreThread(state_); }
+private:
+  PyThreadState* state_;
+};
+
+// Checks that array is a C-contiguous array of doubles with the given
+// trailing dimensions (after the batch dimension)
+void check_batch(np::ndarray const & array, int nd, const Py_intptr_t* shape, 
+                 const char* shape_error) {
+  if(array.get_dtype() != np::dtype::get_builtin<double>()) {
+    PyErr_SetString(PyExc_TypeError, "Incorrect array data type");
+    p::throw_error_already_set();
+  }
+  if(array.get_nd() != nd) {
+    PyErr_SetString(PyExc_TypeError, "Incorrect number of dimensions");
+    p::throw_error_already_set();
+  }
+  for(int i=1;i<nd;i++) {
+    if(array.shape(i) != shape[i-1]) {
+      PyErr_SetString(PyExc_TypeError, shape_error);
+      p::throw_error_already_set();
+    }
+  }
+  if(!(array.get_flags() & np::ndarray::C_CONTIGUOUS)) {
+    PyErr_SetString(PyExc_TypeError, "Array is not C-contiguous");
+    p::throw_error_already_set();
+  }
+}
+
+// q: N x 6 array of joint values.  Returns the N x 4 x 4 poses.
+np::ndarray forward_batch_wrapper(ur_kinematics::Kinematics const & kin, np::ndarray const & q_arr) {
+  Py_intptr_t q_shape[1] = { 6 };
+  check_batch(q_arr, 2, q_shape, "Incorrect shape (should be Nx6)");
+  int n = q_arr.shape(0);
+  Py_intptr_t shape[3] = { n, 4, 4 };
+  np::ndarray result = np::empty(3,shape,np::dtype::get_builtin<double>());
+  const double* q = reinterpret_cast<const double*>(q_arr.get_data());
+  double* T = reinterpret_cast<double*>(result.get_data());
+  {
+    ScopedGILRelease release;
+    kin.forward_batch(q, T, n);
+  }
+  return result;
+}
+
+// T: N x 4 x 4 array of poses.  q6_des is a float, or an array of N
+// floats.  Returns (q_sols, num_sols): the N x 8 x 6 solutions (rows past
+// num_sols[i] are NaN) and the N numbers of solutions.
+p::tuple inverse_batch_wrapper(ur_kinematics::Kinematics const & kin, np::ndarray const & T_arr, p::object q6_des_obj) {
+  Py_intptr_t T_shape[2] = { 4, 4 };
+  check_batch(T_arr, 3, T_shape, "Incorrect shape (should be Nx4x4)");
+  int n = T_arr.shape(0);
+
+  std::vector<double> q6_des(n, 0.0);
+  p::extract<double> q6_des_scalar(q6_des_obj);
+  if(q6_des_scalar.check())
+    std::fill(q6_des.begin(), q6_des.end(), q6_des_scalar());
+  else {
+    np::ndarray q6_arr = np::from_object(q6_des_obj, np::dtype::get_builtin<double>(), 1, 1,
+                                         np::ndarray::CARRAY_RO);
+    if(q6_arr.shape(0) != n) {
+      PyErr_SetString(PyExc_TypeError, "Incorrect shape of q6_des (should be N)");
+      p::throw_error_already_set();
+    }
+    const double* q6 = reinterpret_cast<const double*>(q6_arr.get_data());
+    std::copy(q6, q6 + n, q6_des.begin());
+  }
+
+  Py_intptr_t sols_shape[3] = { n, 8, 6 };
+  np::ndarray q_sols = np::empty(3,sols_shape,np::dtype::get_builtin<double>());
+  Py_intptr_t num_shape[1] = { n };
+  np::ndarray num_sols = np::empty(1,num_shape,np::dtype::get_builtin<int>());
+  const double* T = reinterpret_cast<const double*>(T_arr.get_data());
+  double* sols = reinterpret_cast<double*>(q_sols.get_data());
+  int* nums = reinterpret_cast<int*>(num_sols.get_data());
+  {
+    ScopedGILRelease release;
+    kin.inverse_batch(T, sols, nums, n, n ? &q6_des[0] : NULL);
+  }
+  return p::make_tuple(q_sols, num_sols);
+}
+
+// Copies the values of obj, an array-like of size numbers of any shape,
+// into values.  Returns false if obj is None.
+bool optional_values(p::object const & obj, int size, std::vector<double> & values,
+                     const char* size_error) {
+  if(obj.is_none())
+    return false;
+  np::ndarray array = np::from_object(obj, np::dtype::get_builtin<double>(),
+                                      np::ndarray::CARRAY_RO);
+  int array_size = 1;
+  for(int i=0;i<array.get_nd();i++)
+    array_size *= array.shape(i);
+  if(array_size != size) {
+    PyErr_SetString(PyExc_TypeError, size_error);
+    p::throw_error_already_set();
+  }
+  const double* data = reinterpret_cast<const double*>(array.get_data());
+  values.assign(data, data + size);
+  return true;
+}
+
+// T: 4x4 pose, q_seed: 6 joint values, weights: None or 6 values,
+// joint_limits: None or 2x6 (lower, upper).  Returns (q_sol, found),
+// where q_sol is NaN unless found.
+p::tuple inverse_nearest_wrapper(ur_kinematics::Kinematics const & kin, np::ndarray const & T_arr,
+                                 p::object q_seed_obj, p::object weights_obj, p::object limits_obj) {
+  Py_intptr_t T_shape[1] = { 4 };
+  check_batch(T_arr, 2, T_shape, "Incorrect shape (should be 4x4)");
+  if(T_arr.shape(0) != 4) {
+    PyErr_SetString(PyExc_TypeError, "Incorrect shape (should be 4x4)");
+    p::throw_error_already_set();
+  }
+  std::vector<double> q_seed, weights, limits;
+  optional_values(q_seed_obj, 6, q_seed, "Incorrect shape of q_seed (should be 6)");
+  if(q_seed.empty()) {
+    PyErr_SetString(PyExc_TypeError, "q_seed is required");
+    p::throw_error_already_set();
+  }
+  bool has_weights = optional_values(weights_obj, 6, weights, 
+                                     "Incorrect shape of weights (should be 6)");
+  bool has_limits = optional_values(limits_obj, 12, limits, 
+                                    "Incorrect shape of joint_limits (should be 2x6)");
+
+  Py_intptr_t shape[1] = { 6 };
+  np::ndarray q_sol = np::empty(1,shape,np::dtype::get_builtin<double>());
+  bool found = kin.inverse_nearest(
+      reinterpret_cast<const double*>(T_arr.get_data()), &q_seed[0], 
+      reinterpret_cast<double*>(q_sol.get_data()),
+      has_weights ? &weights[0] : NULL, has_limits ? &limits[0] : NULL);
+  return p::make_tuple(q_sol, found);
+}
+
+// T: N x 4 x 4 poses, q_seed: N x 6 seeds, weights and joint_limits as
+// for inverse_nearest.  Returns (q_sols, found): N x 6 and N booleans.
+p::tuple inverse_nearest_batch_wrapper(ur_kinematics::Kinematics const & kin, np::ndarray const & T_arr,
+                                       np::ndarray const & q_seed_arr, p::object weights_obj,
+                                       p::object limits_obj) {
+  Py_intptr_t T_shape[2] = { 4, 4 };
+  check_batch(T_arr, 3, T_shape, "Incorrect shape (should be Nx4x4)");
+  Py_intptr_t q_shape[1] = { 6 };
+  check_batch(q_seed_arr, 2, q_shape, "Incorrect shape of q_seed (should be Nx6)");
+  int n = T_arr.shape(0);
+  if(q_seed_arr.shape(0) != n) {
+    PyErr_SetString(PyExc_TypeError, "T and q_seed have different lengths");
+    p::throw_error_already_set();
+  }
+  std::vector<double> weights, limits;
+  bool has_weights = optional_values(weights_obj, 6, weights, 
+                                     "Incorrect shape of weights (should be 6)");
+  bool has_limits = optional_values(limits_obj, 12, limits, 
+                                    "Incorrect shape of joint_limits (should be 2x6)");
+
+  Py_intptr_t sols_shape[2] = { n, 6 };
+  np::ndarray q_sols = np::empty(2,sols_shape,np::dtype::get_builtin<double>());
+  Py_intptr_t found_shape[1] = { n };
+  np::ndarray found = np::empty(1,found_shape,np::dtype::get_builtin<bool>());
+  const double* T = reinterpret_cast<const double*>(T_arr.get_data());
+  const double* q_seed = reinterpret_cast<const double*>(q_seed_arr.get_data());
+  double* sols = reinterpret_cast<double*>(q_sols.get_data());
+  bool* found_data = reinterpret_cast<bool*>(found.get_data());
+  {
+    ScopedGILRelease release;
+    kin.inverse_nearest_batch(T, q_seed, sols, found_data, n,
+                              has_weights ? &weights[0] : NULL, has_limits ? &limits[0] : NULL);
+  }
+  return p::make_tuple(q_sols, found);
+}
+
+// T: N x 4 x 4 poses along a path, q_start: 6 joint values.  Returns
+// (q_path, status, branches): N x 6 joint values, and N PathStatus flags
+// and branch indices (see Kinematics::inverse_path).
+p::tuple inverse_path_wrapper(ur_kinematics::Kinematics const & kin, np::ndarray const & T_arr,
+                              p::object q_start_obj, double max_step, double singular_threshold) {
+  Py_intptr_t T_shape[2] = { 4, 4 };
+  check_batch(T_arr, 3, T_shape, "Incorrect shape (should be Nx4x4)");
+  int n = T_arr.shape(0);
+  std::vector<double> q_start;
+  if(!optional_values(q_start_obj, 6, q_start, "Incorrect shape of q_start (should be 6)")) {
+    PyErr_SetString(PyExc_TypeError, "q_start is required");
+    p::throw_error_already_set();
+  }
+
+  Py_intptr_t path_shape[2] = { n, 6 };
+  np::ndarray q_path = np::empty(2,path_shape,np::dtype::get_builtin<double>());
+  Py_intptr_t flags_shape[1] = { n };
+  np::ndarray status = np::empty(1,flags_shape,np::dtype::get_builtin<int>());
+  np::ndarray branches = np::empty(1,flags_shape,np::dtype::get_builtin<int>());
+  const double* T = reinterpret_cast<const double*>(T_arr.get_data());
+  double* q = reinterpret_cast<double*>(q_path.get_data());
+  int* status_data = reinterpret_cast<int*>(status.get_data());
+  int* branches_data = reinterpret_cast<int*>(branches.get_data());
+  {
+    ScopedGILRelease release;
+    kin.inverse_path(T, n, &q_start[0], q, status_data, branches_data, 
+                     max_step, singular_threshold);
+  }
+  return p::make_tuple(q_path, status, branches);
+}
+
+// The module level functions use the UR5 parameters, as ur_kin_py did
+// before Kinematics objects were added
+ur_kinematics::Kinematics const & ur5() {
+  static const ur_kinematics::Kinematics kin = ur_kinematics::Kinematics::UR5();
+  return kin;
+}
+
+np::ndarray ur5_forward(np::ndarray const & q_arr) {
+  return forward_wrapper(ur5(), q_arr);
+}
+
+np::ndarray ur5_inverse(np::ndarray const & array, PyObject * q6_des_py) {
+  return inverse_wrapper(ur5(), array, q6_des_py);
+}
+
+np::ndarray ur5_forward_batch(np::ndarray const & q_arr) {
+  return forward_batch_wrapper(ur5(), q_arr);
+}
+
+p::tuple ur5_inverse_batch(np::ndarray const & T_arr, p::object q6_des_obj) {
+  return inverse_batch_wrapper(ur5(), T_arr, q6_des_obj);
+}
+
+p::tuple ur5_inverse_nearest(np::ndarray const & T_arr, p::object q_seed_obj,
+                             p::object weights_obj, p::object limits_obj) {
+  return inverse_nearest_wrapper(ur5(), T_arr, q_seed_obj, weights_obj, limits_obj);
+}
+
+p::tuple ur5_inverse_nearest_batch(np::ndarray const & T_arr, np::ndarray const & q_seed_arr,
+                                   p::object weights_obj, p::object limits_obj) {
+  return inverse_nearest_batch_wrapper(ur5(), T_arr, q_seed_arr, weights_obj, limits_obj);
+}
+
+p::tuple ur5_inverse_path(np::ndarray const & T_arr, p::object q_start_obj, double max_step,
+                          double singular_threshold) {
+  return inverse_path_wrapper(ur5(), T_arr, q_start_obj, max_step, singular_threshold);
 }
 
 BOOST_PYTHON_MODULE(ur_kin_py) {
   np::initialize();  // have to put this in any module that uses Boost.NumPy
-  p::def("forward", forward_wrapper);
-  p::def("inverse", inverse_wrapper);
+
+  p::class_<ur_kinematics::Kinematics>("Kinematics", 
+      p::init<double, double, double, double, double, double>(
+          (p::arg("d1"), p::arg("a2"), p::arg("a3"), p::arg("d4"), p::arg("d5"), p::arg("d6"))))
+    .def_readonly("d1", &ur_kinematics::Kinematics::d1)
+    .def_readonly("a2", &ur_kinematics::Kinematics::a2)
+    .def_readonly("a3", &ur_kinematics::Kinematics::a3)
+    .def_readonly("d4", &ur_kinematics::Kinematics::d4)
+    .def_readonly("d5", &ur_kinematics::Kinematics::d5)
+    .def_readonly("d6", &ur_kinematics::Kinematics::d6)
+    .def("forward", forward_wrapper)
+    .def("inverse", inverse_wrapper)
+    .def("forward_batch", forward_batch_wrapper)
+    .def("inverse_batch", inverse_batch_wrapper, 
+         (p::arg("T"), p::arg("q6_des")=0.0))
+    .def("inverse_nearest", inverse_nearest_wrapper,
+         (p::arg("T"), p::arg("q_seed"), p::arg("weights")=p::object(),
+          p::arg("joint_limits")=p::object()))
+    .def("inverse_nearest_batch", inverse_nearest_batch_wrapper,
+         (p::arg("T"), p::arg("q_seed"), p::arg("weights")=p::object(),
+          p::arg("joint_limits")=p::object()))
+    .def("inverse_path", inverse_path_wrapper,
+         (p::arg("T"), p::arg("q_start"), p::arg("max_step")=0.5,
+          p::arg("singular_threshold")=0.01));
+  p::scope().attr("UR5") = ur_kinematics::Kinematics::UR5();
+  p::scope().attr("UR10") = ur_kinematics::Kinematics::UR10();
+
+  p::def("forward", ur5_forward);
+  p::def("inverse", ur5_inverse);
+  p::def("forward_batch", ur5_forward_batch);
+  p::def("inverse_batch", ur5_inverse_batch, 
+         (p::arg("T"), p::arg("q6_des")=0.0));
+  p::def("inverse_nearest", ur5_inverse_nearest,
+         (p::arg("T"), p::arg("q_seed"), p::arg("weights")=p::object(),
+          p::arg("joint_limits")=p::object()));
+  p::def("inverse_nearest_batch", ur5_inverse_nearest_batch,
+         (p::arg("T"), p::arg("q_seed"), p::arg("weights")=p::object(),
+          p::arg("joint_limits")=p::object()));
+  p::def("inverse_path", ur5_inverse_path,
+         (p::arg("T"), p::arg("q_start"), p::arg("max_step")=0.5,
+          p::arg("singular_threshold")=0.01));
+
+  p::scope().attr("PATH_OK") = int(ur_kinematics::PATH_OK);
+  p::scope().attr("PATH_BRANCH_CHANGED") = int(ur_kinematics::PATH_BRANCH_CHANGED);
+  p::scope().attr("PATH_SINGULAR") = int(ur_kinematics::PATH_SINGULAR);
+  p::scope().attr("PATH_UNREACHABLE") = int(ur_kinematics::PATH_UNREACHABLE);
+  p::scope().attr("PATH_JUMP") = int(ur_kinematics::PATH_JUMP);
 }
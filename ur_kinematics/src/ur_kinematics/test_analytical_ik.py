@@ -1,66 +1,258 @@
+#!/usr/bin/env python
+import time, sys
+import json
+import optparse
+import multiprocessing
 import numpy as np
-import sys
 import roslib
 roslib.load_manifest("ur_kinematics")
-from ur_kin_py import forward, inverse
-
-def best_sol(sols, q_guess, weights):
-    valid_sols = []
-    for sol in sols:
-        test_sol = np.ones(6)*9999.
-        for i in range(6):
-            for add_ang in [-2.*np.pi, 0, 2.*np.pi]:
-                test_ang = sol[i] + add_ang
-                if (abs(test_ang) <= 2.*np.pi and 
-                    abs(test_ang - q_guess[i]) < abs(test_sol[i] - q_guess[i])):
-                    test_sol[i] = test_ang
-        if np.all(test_sol != 9999.):
-            valid_sols.append(test_sol)
-    if len(valid_sols) == 0:
-        return None
-    best_sol_ind = np.argmin(np.sum((weights*(valid_sols - np.array(q_guess)))**2,1))
-    return valid_sols[best_sol_ind]
-
-def test_q(q):
-    x = forward(q)
-    sols = inverse(np.array(x), float(q[5]))
-
-    qsol = best_sol(sols, q, [1.]*6)
-    if qsol is None:
-        qsol = [999.]*6
-    diff = np.sum(np.abs(np.array(qsol) - q))
-    if diff > 0.001:
-        print np.array(sols)
-        print 'Best q:', qsol
-        print 'Actual:', np.array(q)
-        print 'Diff:  ', q - qsol
-        print 'Difdiv:', (q - qsol)/np.pi
-        print i1-3, i2-3, i3-3, i4-3, i5-3, i6-3
-        if raw_input() == 'q':
-            sys.exit()
+import ur_kin_py
+
+# Verifies the analytical inverse kinematics against the forward
+# kinematics, for any kinematic parameters:
+#
+#   test_analytical_ik.py                      # UR5: grid and random sets
+#   test_analytical_ik.py -m ur10 --sweep 10 -o report.json
+#   test_analytical_ik.py -d 0.0892,-0.425,-0.392,0.1093,0.0947,0.0823
+#
+# Every configuration of a set is moved to its pose by forward kinematics
+# and solved back; the solutions should include the configuration (up to
+# multiples of 2*pi) and all of them should have the same pose.  Sets are
+# split into chunks that are computed with the batched functions of
+# ur_kin_py on a pool of processes.  The report has the round trip errors
+# (maximum and percentiles), the configurations per branch, the poses per
+# number of solutions, the singular configurations and the throughput;
+# the exit status is 1 if any configuration was not recovered.
+#
+# The sets are:
+#   grid    the 5^6 configurations of multiples of pi/2 in [0, 2*pi]
+#   random  uniformly random configurations in [-2*pi, 2*pi)
+#   sweep   a grid of n^6 configurations over [-pi, pi) (n = --sweep)
+
+PERCENTILES = [50, 90, 99, 99.9]
+MAX_EXAMPLES = 10
+
+# Returns the joint values of each of the axes' grid points, for the
+# configurations with flat indices i0 to i1
+def grid_configurations(values, i0, i1):
+    indices = np.unravel_index(np.arange(i0, i1), (len(values),) * 6)
+    return np.array(values)[np.column_stack(indices)]
+
+# Returns the configurations i0 to i1 of a set; random ones are drawn from
+# a generator seeded per chunk, so the set doesn't depend on the number
+# of processes
+def configurations(set_name, set_arg, seed, i0, i1):
+    if set_name == 'grid':
+        return grid_configurations(np.pi / 2 * np.arange(5), i0, i1)
+    if set_name == 'sweep':
+        return grid_configurations(np.linspace(-np.pi, np.pi, set_arg, endpoint=False), i0, i1)
+    rng = np.random.RandomState([seed, i0])
+    return (rng.rand(i1 - i0, 6) - .5) * 4 * np.pi
+
+def set_size(set_name, set_arg):
+    if set_name == 'grid':
+        return 5 ** 6
+    if set_name == 'sweep':
+        return set_arg ** 6
+    return set_arg
+
+# The Kinematics of the worker process, made once by init_worker
+_kin = None
+
+def init_worker(params):
+    global _kin
+    _kin = ur_kin_py.Kinematics(*params)
+
+# Checks the configurations i0 to i1 of a set, and returns the chunk's
+# results (see merge_results)
+def check_chunk(task):
+    set_name, set_arg, seed, i0, i1, tolerance, singular_threshold = task
+    q = configurations(set_name, set_arg, seed, i0, i1)
+    n = len(q)
+    t0 = time.time()
+    T = _kin.forward_batch(q)
+    t1 = time.time()
+    sols, num_sols = _kin.inverse_batch(T, np.ascontiguousarray(q[:, 5]))
+    t2 = time.time()
+
+    # The error of the solution nearest to the configuration, with the
+    # joints wrapped to (-pi, pi]
+    diff = np.abs((sols - q[:, np.newaxis, :] + np.pi) % (2 * np.pi) - np.pi).max(axis=2)
+    solved = ~np.isnan(diff)
+    nearest = np.where(solved, diff, np.inf).argmin(axis=1)
+    joint_error = np.where(num_sols > 0, diff[np.arange(n), nearest], np.inf)
+
+    # The pose errors of all the solutions
+    position_error = np.zeros((n, 8))
+    rotation_error = np.zeros((n, 8))
+    rows, cols = np.nonzero(solved)
+    T_sols = _kin.forward_batch(np.ascontiguousarray(sols[rows, cols]))
+    position_error[rows, cols] = np.sqrt(((T_sols[:, :3, 3] - T[rows, :3, 3]) ** 2).sum(axis=1))
+    rotation_error[rows, cols] = np.abs(T_sols[:, :3, :3] - T[rows, :3, :3]).max(axis=(1, 2))
+    position_error = position_error.max(axis=1)
+    rotation_error = rotation_error.max(axis=1)
+
+    # The branches of the recovered configurations, numbered as for
+    # Kinematics::inverse_path: shoulder*4 + wrist*2 + elbow.  The wrist
+    # and elbow solutions are arccos in [0, pi] or its complement; the two
+    # shoulder solutions lie on either side of atan2(-B, A).
+    A = _kin.d6 * T[:, 1, 2] - T[:, 1, 3]
+    B = _kin.d6 * T[:, 0, 2] - T[:, 0, 3]
+    shoulder_bit = np.sin(q[:, 0] - np.arctan2(-B, A)) < 0
+    wrist_bit = q[:, 4] % (2 * np.pi) > np.pi
+    elbow_bit = q[:, 2] % (2 * np.pi) > np.pi
+    branch = 4 * shoulder_bit + 2 * wrist_bit + elbow_bit
+    # A NaN error compares false either way, so it counts as a failure
+    ok = joint_error <= tolerance
+    branches = np.bincount(branch[ok], minlength=8)
+
+    # How close the configurations are to the shoulder, elbow and wrist
+    # singularities, measured as inverse_path does
+    shoulder = np.abs(np.sin((np.fmax.reduce(sols[:, :, 0], axis=1) -
+                              np.fmin.reduce(sols[:, :, 0], axis=1)) / 2))
+    singular = {'shoulder': shoulder < singular_threshold,
+                'elbow': np.abs(np.sin(q[:, 2])) < singular_threshold,
+                'wrist': np.abs(np.sin(q[:, 4])) < singular_threshold}
+    singular['any'] = singular['shoulder'] | singular['elbow'] | singular['wrist']
+
+    failed = np.flatnonzero(~ok)
+    return {
+        'set': set_name,
+        'poses': n,
+        'failures': len(failed),
+        'solutions': np.bincount(num_sols, minlength=9),
+        'branches': branches,
+        'singular': dict((k, int(v.sum())) for k, v in singular.items()),
+        'joint_error': joint_error,
+        'position_error': position_error,
+        'rotation_error': rotation_error,
+        'examples': q[failed[:MAX_EXAMPLES]].tolist(),
+        'fk_time': t1 - t0,
+        'ik_time': t2 - t1,
+        'time': time.time() - t0,
+    }
+
+def error_stats(errors):
+    finite = errors[np.isfinite(errors)]
+    stats = {'max': float(errors.max()) if len(errors) else 0.0}
+    for p in PERCENTILES:
+        stats['p%g' % p] = float(np.percentile(finite, p)) if len(finite) else None
+    return stats
+
+# Combines the results of the chunks of one set
+def merge_results(chunks, elapsed):
+    poses = sum(c['poses'] for c in chunks)
+    ik_time = sum(c['ik_time'] for c in chunks)
+    result = {
+        'poses': poses,
+        'failures': sum(c['failures'] for c in chunks),
+        'solutions': sum(c['solutions'] for c in chunks).tolist(),
+        'branches': sum(c['branches'] for c in chunks).tolist(),
+        'singular': dict((k, sum(c['singular'][k] for c in chunks))
+                         for k in chunks[0]['singular']),
+        'examples': sum((c['examples'] for c in chunks), [])[:MAX_EXAMPLES],
+        'elapsed': elapsed,
+        'poses_per_sec': poses / elapsed,
+        'ik_poses_per_sec': poses / ik_time if ik_time > 0 else None,
+        'cpu_time': sum(c['time'] for c in chunks),
+    }
+    for name in ['joint_error', 'position_error', 'rotation_error']:
+        result[name] = error_stats(np.concatenate([c[name] for c in chunks]))
+    return result
+
+def parse_params(options, parser):
+    if options.dh:
+        try:
+            params = tuple(float(v) for v in options.dh.split(','))
+        except ValueError:
+            params = ()
+        if len(params) != 6:
+            parser.error("--dh takes six comma separated values: d1,a2,a3,d4,d5,d6")
+        return params
+    if options.model not in ('ur5', 'ur10'):
+        parser.error("Unknown model: %s" % options.model)
+    kin = getattr(ur_kin_py, options.model.upper())
+    return (kin.d1, kin.a2, kin.a3, kin.d4, kin.d5, kin.d6)
 
 def main():
-    np.set_printoptions(precision=3)
-    print "Testing multiples of pi/2..."
-    for i1 in range(0,5):
-        for i2 in range(0,5):
-            print i1, i2
-            for i3 in range(0,5):
-                for i4 in range(0,5):
-                    for i5 in range(0,5):
-                        for i6 in range(0,5):
-                            q = np.array([i1*np.pi/2., i2*np.pi/2., i3*np.pi/2., 
-                                          i4*np.pi/2., i5*np.pi/2., i6*np.pi/2.])
-                            test_q(q)
-    print "Testing random configurations..."
-    for i in range(10000):
-        q = (np.random.rand(6)-.5)*4*np.pi
-        test_q(q)
-    print "Done!"
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-m", "--model", default="ur5",
+                      help="nominal parameters of ur5 or ur10 [default: %default]")
+    parser.add_option("-d", "--dh", metavar="D1,A2,A3,D4,D5,D6",
+                      help="kinematic parameters to verify instead of a model's")
+    parser.add_option("-s", "--sets", default="grid,random",
+                      help="comma separated sets to run: grid, random, sweep [default: %default]")
+    parser.add_option("-n", "--random", type="int", default=10000,
+                      help="number of random configurations [default: %default]")
+    parser.add_option("--sweep", type="int", default=10,
+                      help="grid points per joint of the sweep set [default: %default]")
+    parser.add_option("--seed", type="int", default=0,
+                      help="seed of the random set [default: %default]")
+    parser.add_option("-j", "--processes", type="int", default=multiprocessing.cpu_count(),
+                      help="worker processes [default: %default]")
+    parser.add_option("-c", "--chunk-size", type="int", default=10000,
+                      help="configurations per chunk [default: %default]")
+    parser.add_option("-t", "--tolerance", type="float", default=1e-3,
+                      help="largest joint error of a recovered configuration [default: %default]")
+    parser.add_option("--singular-threshold", type="float", default=0.01,
+                      help="sine of the angle to a singularity that counts as singular [default: %default]")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="write the report to FILE as JSON")
+    (options, args) = parser.parse_args()
 
-if __name__ == "__main__":
-    if False:
-        import cProfile
-        cProfile.run('main()', 'ik_prof')
+    params = parse_params(options, parser)
+    set_args = {'grid': None, 'random': options.random, 'sweep': options.sweep}
+    sets = [s for s in options.sets.split(',') if s]
+    for s in sets:
+        if s not in set_args:
+            parser.error("Unknown set: %s" % s)
+
+    if options.processes > 1:
+        pool = multiprocessing.Pool(options.processes, init_worker, (params,))
+        imap = pool.imap_unordered
     else:
-        main()
+        pool = None
+        init_worker(params)
+        imap = map
+
+    report = {
+        'timestamp': time.time(),
+        'params': params,
+        'processes': options.processes,
+        'chunk_size': options.chunk_size,
+        'tolerance': options.tolerance,
+        'singular_threshold': options.singular_threshold,
+        'sets': {},
+    }
+    try:
+        for s in sets:
+            size = set_size(s, set_args[s])
+            tasks = [(s, set_args[s], options.seed, i0, min(i0 + options.chunk_size, size),
+                      options.tolerance, options.singular_threshold)
+                     for i0 in range(0, size, options.chunk_size)]
+            t0 = time.time()
+            chunks = list(imap(check_chunk, tasks))
+            if not chunks:
+                continue
+            result = merge_results(chunks, time.time() - t0)
+            report['sets'][s] = result
+            print "%-7s %9d poses  %7d failed  max error %.2e  %10.0f poses/s  (ik %.0f poses/s/process)" % \
+                (s, result['poses'], result['failures'], result['joint_error']['max'],
+                 result['poses_per_sec'], result['ik_poses_per_sec'] or 0.0)
+            print "        branches %s  singular %d  poses by number of solutions %s" % \
+                (result['branches'], result['singular']['any'], result['solutions'])
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    failures = sum(r['failures'] for r in report['sets'].values())
+    if failures:
+        print "%d configuration(s) not recovered" % failures
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()